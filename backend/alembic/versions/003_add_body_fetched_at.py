@@ -0,0 +1,28 @@
+"""Add body_fetched_at to email_messages (metadata-first sync)
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "003"
+down_revision: Union[str, None] = "002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "email_messages",
+        sa.Column("body_fetched_at", sa.DateTime, nullable=True),
+    )
+    # 既有信件都是用 format=full 同步，內文已經在 DB
+    op.execute("UPDATE email_messages SET body_fetched_at = created_at")
+
+
+def downgrade() -> None:
+    op.drop_column("email_messages", "body_fetched_at")
@@ -0,0 +1,41 @@
+"""Add adaptive sync schedule columns to email_accounts
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "005"
+down_revision: Union[str, None] = "004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("email_accounts", sa.Column("next_sync_at", sa.DateTime, nullable=True))
+    op.add_column("email_accounts", sa.Column("sync_interval_seconds", sa.Integer, nullable=True))
+    op.add_column(
+        "email_accounts",
+        sa.Column("sync_failures", sa.Integer, nullable=False, server_default="0"),
+    )
+    op.add_column("email_accounts", sa.Column("quarantined_at", sa.DateTime, nullable=True))
+    op.execute("UPDATE email_accounts SET next_sync_at = now()")
+    # 排程只掃描「可同步」的帳號，用 partial index 讓到期查詢走索引
+    op.create_index(
+        "ix_email_accounts_next_sync_at",
+        "email_accounts",
+        ["next_sync_at"],
+        postgresql_where=sa.text("is_active AND sync_enabled AND quarantined_at IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_email_accounts_next_sync_at", table_name="email_accounts")
+    op.drop_column("email_accounts", "quarantined_at")
+    op.drop_column("email_accounts", "sync_failures")
+    op.drop_column("email_accounts", "sync_interval_seconds")
+    op.drop_column("email_accounts", "next_sync_at")
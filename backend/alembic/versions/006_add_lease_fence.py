@@ -0,0 +1,26 @@
+"""Add lease_fence to email_sync_states (sync lease fencing)
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "006"
+down_revision: Union[str, None] = "005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "email_sync_states",
+        sa.Column("lease_fence", sa.BigInteger, nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("email_sync_states", "lease_fence")
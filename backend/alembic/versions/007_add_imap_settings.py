@@ -0,0 +1,35 @@
+"""Add IMAP connection settings and CONDSTORE modseq
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "007"
+down_revision: Union[str, None] = "006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("email_accounts", sa.Column("imap_host", sa.String(255), nullable=True))
+    op.add_column("email_accounts", sa.Column("imap_port", sa.Integer, nullable=True))
+    op.add_column(
+        "email_accounts",
+        sa.Column("imap_use_ssl", sa.Boolean, nullable=False, server_default=sa.true()),
+    )
+    op.add_column(
+        "email_sync_states",
+        sa.Column("last_modseq", sa.BigInteger, nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("email_sync_states", "last_modseq")
+    op.drop_column("email_accounts", "imap_use_ssl")
+    op.drop_column("email_accounts", "imap_port")
+    op.drop_column("email_accounts", "imap_host")
@@ -0,0 +1,27 @@
+"""Add analysis_text to email_messages (normalized content for LLM analysis)
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "008"
+down_revision: Union[str, None] = "007"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # 既有信件留 NULL，分析時再由原始內文補算
+    op.add_column(
+        "email_messages",
+        sa.Column("analysis_text", sa.Text, nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("email_messages", "analysis_text")
@@ -0,0 +1,134 @@
+"""Move message bodies to compressed, content-addressed email_bodies
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-17
+
+"""
+import hashlib
+import zlib
+from datetime import datetime
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision: str = "009"
+down_revision: Union[str, None] = "008"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+_BATCH = 500
+
+
+def _encode(text: str | None) -> bytes:
+    return (text or "").encode("utf-8", errors="surrogatepass")
+
+
+def _compress(text: str | None) -> bytes | None:
+    return zlib.compress(_encode(text), 6) if text else None
+
+
+def _inflate(data: bytes | None) -> str | None:
+    if data is None:
+        return None
+    return zlib.decompress(data).decode("utf-8", errors="surrogatepass")
+
+
+def upgrade() -> None:
+    op.create_table(
+        "email_bodies",
+        sa.Column("content_hash", sa.String(64), primary_key=True),
+        sa.Column("plain_z", sa.LargeBinary, nullable=True),
+        sa.Column("html_z", sa.LargeBinary, nullable=True),
+        sa.Column("raw_size", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+    )
+    # 已經是 zlib 壓縮過的資料，不需要 TOAST 再壓縮一次
+    op.execute("ALTER TABLE email_bodies ALTER COLUMN plain_z SET STORAGE EXTERNAL")
+    op.execute("ALTER TABLE email_bodies ALTER COLUMN html_z SET STORAGE EXTERNAL")
+
+    op.add_column(
+        "email_messages",
+        sa.Column(
+            "body_hash", sa.String(64),
+            sa.ForeignKey("email_bodies.content_hash"), nullable=True,
+        ),
+    )
+    op.create_index("ix_email_messages_body_hash", "email_messages", ["body_hash"])
+
+    # 以 id keyset 分批搬移既有內文
+    conn = op.get_bind()
+    bodies = sa.table(
+        "email_bodies",
+        sa.column("content_hash", sa.String),
+        sa.column("plain_z", sa.LargeBinary),
+        sa.column("html_z", sa.LargeBinary),
+        sa.column("raw_size", sa.Integer),
+        sa.column("created_at", sa.DateTime),
+    )
+    last_id = None
+    while True:
+        rows = conn.execute(
+            sa.text(
+                "SELECT id, body_plain, body_html FROM email_messages "
+                "WHERE (body_plain IS NOT NULL OR body_html IS NOT NULL) "
+                + ("AND id > :last_id " if last_id else "")
+                + "ORDER BY id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": _BATCH} if last_id else {"limit": _BATCH},
+        ).all()
+        if not rows:
+            break
+
+        now = datetime.utcnow()
+        packed, assignments = {}, []
+        for row in rows:
+            digest = hashlib.sha256(
+                _encode(row.body_plain) + b"\0" + _encode(row.body_html)
+            ).hexdigest()
+            assignments.append({"b_id": row.id, "b_hash": digest})
+            packed.setdefault(digest, {
+                "content_hash": digest,
+                "plain_z": _compress(row.body_plain),
+                "html_z": _compress(row.body_html),
+                "raw_size": len(row.body_plain or "") + len(row.body_html or ""),
+                "created_at": now,
+            })
+
+        conn.execute(
+            postgresql.insert(bodies).values(list(packed.values()))
+            .on_conflict_do_nothing(index_elements=["content_hash"])
+        )
+        conn.execute(
+            sa.text("UPDATE email_messages SET body_hash = :b_hash WHERE id = :b_id"),
+            assignments,
+        )
+        last_id = rows[-1].id
+
+    op.drop_column("email_messages", "body_plain")
+    op.drop_column("email_messages", "body_html")
+
+
+def downgrade() -> None:
+    op.add_column("email_messages", sa.Column("body_plain", sa.Text, nullable=True))
+    op.add_column("email_messages", sa.Column("body_html", sa.Text, nullable=True))
+
+    conn = op.get_bind()
+    rows = conn.execute(sa.text("SELECT content_hash, plain_z, html_z FROM email_bodies")).all()
+    for row in rows:
+        conn.execute(
+            sa.text(
+                "UPDATE email_messages SET body_plain = :plain, body_html = :html "
+                "WHERE body_hash = :hash"
+            ),
+            {
+                "plain": _inflate(row.plain_z),
+                "html": _inflate(row.html_z),
+                "hash": row.content_hash,
+            },
+        )
+
+    op.drop_index("ix_email_messages_body_hash", table_name="email_messages")
+    op.drop_column("email_messages", "body_hash")
+    op.drop_table("email_bodies")
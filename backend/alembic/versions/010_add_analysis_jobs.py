@@ -0,0 +1,50 @@
+"""Add analysis_jobs (durable LLM analysis queue)
+
+Revision ID: 010
+Revises: 009
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision: str = "010"
+down_revision: Union[str, None] = "009"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "analysis_jobs",
+        sa.Column(
+            "message_id", postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("email_messages.id"), primary_key=True,
+        ),
+        sa.Column("priority", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("status", sa.String(20), nullable=False, server_default="pending"),
+        sa.Column("attempts", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("run_after", sa.DateTime, nullable=False),
+        sa.Column("locked_at", sa.DateTime, nullable=True),
+        sa.Column("last_error", sa.Text, nullable=True),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+    )
+    op.create_index(
+        "ix_analysis_jobs_pending", "analysis_jobs", ["priority", "run_after"],
+        postgresql_where=sa.text("status = 'pending'"),
+    )
+
+    # 取代舊的「每次同步補跑 20 封」：所有尚無摘要的信件一次排入（低優先）
+    op.execute("""
+        INSERT INTO analysis_jobs (message_id, priority, status, attempts, run_after, created_at)
+        SELECT m.id, 0, 'pending', 0, now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc'
+        FROM email_messages m
+        WHERE NOT EXISTS (SELECT 1 FROM email_summaries s WHERE s.message_id = m.id)
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_analysis_jobs_pending", table_name="analysis_jobs")
+    op.drop_table("analysis_jobs")
@@ -0,0 +1,36 @@
+"""Add Gmail history backfill checkpoint to email_sync_states
+
+Revision ID: 011
+Revises: 010
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "011"
+down_revision: Union[str, None] = "010"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "email_sync_states", sa.Column("backfill_page_token", sa.String(500), nullable=True)
+    )
+    op.add_column(
+        "email_sync_states",
+        sa.Column("backfill_count", sa.Integer, nullable=False, server_default="0"),
+    )
+    op.add_column(
+        "email_sync_states", sa.Column("backfill_completed_at", sa.DateTime, nullable=True)
+    )
+    op.add_column("email_sync_states", sa.Column("backfill_fence", sa.BigInteger, nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("email_sync_states", "backfill_fence")
+    op.drop_column("email_sync_states", "backfill_completed_at")
+    op.drop_column("email_sync_states", "backfill_count")
+    op.drop_column("email_sync_states", "backfill_page_token")
@@ -0,0 +1,36 @@
+"""Add llm_cache_entries (Postgres fallback for the LLM result cache)
+
+Revision ID: 012
+Revises: 011
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "012"
+down_revision: Union[str, None] = "011"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm_cache_entries",
+        sa.Column("cache_key", sa.String(64), primary_key=True),
+        sa.Column("result", sa.JSON, nullable=False),
+        sa.Column("model", sa.String(100), nullable=True),
+        sa.Column("hit_count", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+        sa.Column("last_hit_at", sa.DateTime, nullable=False),
+        sa.Column("expires_at", sa.DateTime, nullable=False),
+    )
+    op.create_index("ix_llm_cache_entries_last_hit_at", "llm_cache_entries", ["last_hit_at"])
+    op.create_index("ix_llm_cache_entries_expires_at", "llm_cache_entries", ["expires_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_llm_cache_entries_expires_at", table_name="llm_cache_entries")
+    op.drop_index("ix_llm_cache_entries_last_hit_at", table_name="llm_cache_entries")
+    op.drop_table("llm_cache_entries")
@@ -0,0 +1,26 @@
+"""Add pre-triage columns (email_messages.is_list_mail, users.pretriage_rules)
+
+Revision ID: 013
+Revises: 012
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "013"
+down_revision: Union[str, None] = "012"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # 既有信件留 NULL（同步時未取得 List-* 標頭），只影響新信件的分流
+    op.add_column("email_messages", sa.Column("is_list_mail", sa.Boolean, nullable=True))
+    op.add_column("users", sa.Column("pretriage_rules", sa.JSON, nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("users", "pretriage_rules")
+    op.drop_column("email_messages", "is_list_mail")
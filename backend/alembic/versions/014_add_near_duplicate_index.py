@@ -0,0 +1,70 @@
+"""Add simhash_entries and near_duplicate_matches (near-duplicate analysis reuse)
+
+Revision ID: 014
+Revises: 013
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision: str = "014"
+down_revision: Union[str, None] = "013"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "simhash_entries",
+        sa.Column(
+            "message_id", postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("email_messages.id"), primary_key=True,
+        ),
+        sa.Column(
+            "user_id", postgresql.UUID(as_uuid=True), sa.ForeignKey("users.id"), nullable=False
+        ),
+        sa.Column("sender_domain", sa.String(255), nullable=True),
+        sa.Column("simhash", sa.BigInteger, nullable=False),
+        sa.Column("band0", sa.Integer, nullable=False),
+        sa.Column("band1", sa.Integer, nullable=False),
+        sa.Column("band2", sa.Integer, nullable=False),
+        sa.Column("band3", sa.Integer, nullable=False),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+    )
+    for band in range(4):
+        op.create_index(
+            f"ix_simhash_entries_band{band}", "simhash_entries", ["user_id", f"band{band}"]
+        )
+
+    op.create_table(
+        "near_duplicate_matches",
+        sa.Column("id", postgresql.UUID(as_uuid=True), primary_key=True),
+        sa.Column(
+            "message_id", postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("email_messages.id"), nullable=False,
+        ),
+        sa.Column(
+            "source_message_id", postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("email_messages.id"), nullable=False,
+        ),
+        sa.Column("distance", sa.Integer, nullable=False),
+        sa.Column("scope", sa.String(20), nullable=False),
+        sa.Column("adapted", sa.Boolean, nullable=False, server_default=sa.false()),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+    )
+    for column in ("message_id", "source_message_id", "created_at"):
+        op.create_index(
+            f"ix_near_duplicate_matches_{column}", "near_duplicate_matches", [column]
+        )
+
+
+def downgrade() -> None:
+    for column in ("created_at", "source_message_id", "message_id"):
+        op.drop_index(f"ix_near_duplicate_matches_{column}", table_name="near_duplicate_matches")
+    op.drop_table("near_duplicate_matches")
+    for band in range(4):
+        op.drop_index(f"ix_simhash_entries_band{band}", table_name="simhash_entries")
+    op.drop_table("simhash_entries")
@@ -0,0 +1,37 @@
+"""Match analysis_jobs indexes to the split pending / stale-running claims
+
+Revision ID: 015
+Revises: 014
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "015"
+down_revision: Union[str, None] = "014"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # 認領查詢是 ORDER BY priority DESC, run_after，索引方向要一致才能直接依序掃描
+    op.drop_index("ix_analysis_jobs_pending", table_name="analysis_jobs")
+    op.create_index(
+        "ix_analysis_jobs_pending", "analysis_jobs", [sa.text("priority DESC"), "run_after"],
+        postgresql_where=sa.text("status = 'pending'"),
+    )
+    op.create_index(
+        "ix_analysis_jobs_running", "analysis_jobs", ["locked_at"],
+        postgresql_where=sa.text("status = 'running'"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_analysis_jobs_running", table_name="analysis_jobs")
+    op.drop_index("ix_analysis_jobs_pending", table_name="analysis_jobs")
+    op.create_index(
+        "ix_analysis_jobs_pending", "analysis_jobs", ["priority", "run_after"],
+        postgresql_where=sa.text("status = 'pending'"),
+    )
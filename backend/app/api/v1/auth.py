@@ -1,12 +1,15 @@
 """
-認證 API - Gmail OAuth 流程
+認證 API - Gmail OAuth 流程 / IMAP 帳號連接
 """
+import asyncio
+import logging
 import secrets
 import uuid
 from datetime import datetime, timedelta
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from fastapi.responses import RedirectResponse
 from jose import jwt, JWTError
+from pydantic import BaseModel
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -14,9 +17,10 @@ from app.core.config import get_settings
 from app.core.database import get_db
 from app.models.user import User
 from app.models.email import EmailAccount, EmailSyncState
-from app.services import gmail_service, crypto_service
+from app.services import gmail_service, crypto_service, imap_service, sync_queue
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/auth")
 
 ALGORITHM = "HS256"
@@ -110,12 +114,16 @@ async def gmail_callback(
     account.token_expires_at = token_data.get("expires_at")
     account.is_active = True
 
+    # 重新授權後解除隔離並立即排入同步
+    account.quarantined_at = None
+    account.sync_failures = 0
+    account.sync_error = None
+    account.next_sync_at = datetime.utcnow()
+
     await db.commit()
 
-    # 立即觸發一次同步
-    from app.workers.email_sync import sync_account
-    import asyncio
-    asyncio.create_task(sync_account(account.id))
+    # 立即排入同步佇列（由 Worker 在 lease 保護下執行，不在 API process 內同步）
+    await sync_queue.request_sync(account.id, user.id)
 
     # 設定 JWT Cookie
     access_token = create_access_token({"sub": str(user.id)})
@@ -130,6 +138,69 @@ async def gmail_callback(
     return redirect
 
 
+class ImapAccountCreate(BaseModel):
+    email_address: str
+    password: str  # 建議使用 app password
+    host: str
+    port: int = 993
+    use_ssl: bool = True
+
+
+@router.post("/imap")
+async def connect_imap(
+    data: ImapAccountCreate,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """連接 IMAP 信箱（先驗證帳密，密碼加密存入 encrypted_access_token）"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(
+            None, imap_service.verify_login,
+            data.host, data.port, data.use_ssl, data.email_address, data.password,
+        )
+    except Exception:
+        # 錯誤細節（連線被拒、逾時、TLS 錯誤等）只寫 log，避免回應內容被用來探測網路
+        logger.warning(
+            f"IMAP 登入失敗（user={current_user.id}, host={data.host}:{data.port}）",
+            exc_info=True,
+        )
+        raise HTTPException(status_code=400, detail="IMAP 登入失敗")
+
+    result = await db.execute(
+        select(EmailAccount).where(
+            EmailAccount.user_id == current_user.id,
+            EmailAccount.email_address == data.email_address,
+            EmailAccount.provider == "imap",
+        )
+    )
+    account = result.scalar_one_or_none()
+
+    if not account:
+        account = EmailAccount(
+            user_id=current_user.id,
+            provider="imap",
+            email_address=data.email_address,
+            display_name=data.email_address,
+        )
+        db.add(account)
+
+    account.imap_host = data.host
+    account.imap_port = data.port
+    account.imap_use_ssl = data.use_ssl
+    account.encrypted_access_token = crypto_service.encrypt(data.password)
+    account.is_active = True
+    account.quarantined_at = None
+    account.sync_failures = 0
+    account.sync_error = None
+    account.next_sync_at = datetime.utcnow()
+
+    await db.commit()
+    await sync_queue.request_sync(account.id, current_user.id)
+
+    return {"id": str(account.id), "email_address": account.email_address, "provider": "imap"}
+
+
 @router.get("/me")
 async def get_me(current_user: User = Depends(get_current_user)):
     return {
@@ -1,12 +1,14 @@
 """
 Email API - 取得信件清單、摘要、Thread
 """
+import json
+import logging
 import uuid
 from typing import Optional
 from fastapi import APIRouter, Depends, Query, HTTPException
 from fastapi.responses import StreamingResponse
 from sqlalchemy import select, and_, or_, func, desc
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, undefer
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.database import get_db
@@ -14,9 +16,11 @@ from app.models.email import EmailMessage, EmailAccount
 from app.models.summary import EmailSummary
 from app.models.user import User
 from app.api.v1.auth import get_current_user
+from app.services import llm_cache, message_body
 from app.services.llm_service import LLMService
 
 router = APIRouter(prefix="/emails")
+logger = logging.getLogger(__name__)
 
 
 @router.get("")
@@ -168,6 +172,7 @@ async def get_email(
         .options(
             selectinload(EmailMessage.summary),
             selectinload(EmailMessage.account),
+            selectinload(EmailMessage.body),
         )
     )
     msg = result.scalar_one_or_none()
@@ -175,6 +180,9 @@ async def get_email(
     if not msg or msg.account.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="信件不存在")
 
+    # metadata-first 同步：第一次開啟時才下載內文並寫回 DB
+    await message_body.ensure_body(db, msg)
+
     return _format_email(msg, include_body=True)
 
 
@@ -190,26 +198,42 @@ async def summarize_email(
     result = await db.execute(
         select(EmailMessage)
         .where(EmailMessage.id == email_id)
-        .options(selectinload(EmailMessage.account))
+        .options(
+            selectinload(EmailMessage.account),
+            selectinload(EmailMessage.body),
+            undefer(EmailMessage.analysis_text),
+        )
     )
     msg = result.scalar_one_or_none()
 
     if not msg or msg.account.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="信件不存在")
 
-    content = msg.body_plain or msg.snippet or ""
+    await message_body.ensure_body(db, msg)
+    content = message_body.analysis_content(msg)
     if not content:
         raise HTTPException(status_code=400, detail="信件內容為空")
 
     llm = LLMService()
-    result_data = await llm.analyze_email(
+    # 相同內容 + 風格 + 模型 + 語言已分析過時直接使用快取結果
+    result_data = await llm_cache.analyze_email(
+        db,
+        llm,
         content,
         style=style,
         model=model or current_user.default_model,
         language=current_user.summary_language,
     )
 
-    # 更新或建立摘要
+    await _save_summary(db, email_id, style, result_data)
+    await db.commit()
+    return result_data
+
+
+async def _save_summary(
+    db: AsyncSession, email_id: uuid.UUID, style: str, result_data: dict
+) -> None:
+    """更新或建立摘要（summarize / summarize/stream?structured=true 共用）"""
     existing_result = await db.execute(
         select(EmailSummary).where(EmailSummary.message_id == email_id)
     )
@@ -232,33 +256,54 @@ async def summarize_email(
         )
         db.add(summary)
 
-    await db.commit()
-    return result_data
-
 
 @router.get("/{email_id}/summarize/stream")
 async def summarize_email_stream(
     email_id: uuid.UUID,
     style: str = "bullet_points",
     model: Optional[str] = None,
+    structured: bool = False,
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    """Streaming 摘要 - 即時顯示生成過程，完成後儲存至 DB"""
+    """
+    Streaming 摘要 - 即時顯示生成過程，完成後儲存至 DB
+
+    structured=true 時改為結構化分析（同 POST /summarize 的欄位），以具名 SSE 事件送出：
+      event: field          {"name": 欄位, "value": 值}，評分等分流欄位最先到達
+      event: summary_delta  {"text": 摘要新增的文字}
+      event: result         完整結果（已寫入 DB，格式同 POST /summarize）
+      event: error          {"detail": 錯誤訊息}
+    """
     result = await db.execute(
         select(EmailMessage)
         .where(EmailMessage.id == email_id)
-        .options(selectinload(EmailMessage.account))
+        .options(
+            selectinload(EmailMessage.account),
+            selectinload(EmailMessage.body),
+            undefer(EmailMessage.analysis_text),
+        )
     )
     msg = result.scalar_one_or_none()
 
     if not msg or msg.account.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="信件不存在")
 
-    content = msg.body_plain or msg.snippet or ""
+    await message_body.ensure_body(db, msg)
+    content = message_body.analysis_content(msg)
     llm = LLMService()
     used_model = model or current_user.default_model
 
+    if structured:
+        if not content:
+            raise HTTPException(status_code=400, detail="信件內容為空")
+        return StreamingResponse(
+            _structured_events(
+                db, llm, email_id, content, style, used_model, current_user.summary_language
+            ),
+            media_type="text/event-stream",
+        )
+
     async def generate():
         accumulated: list[str] = []
         async for chunk in llm.analyze_email_stream(
@@ -295,6 +340,57 @@ async def summarize_email_stream(
     return StreamingResponse(generate(), media_type="text/event-stream")
 
 
+# 快取命中時送出欄位的順序（與 MASTER_SYSTEM_PROMPT 一致，評分在前）
+_STREAM_FIELDS = (
+    "urgency_score", "importance_score", "action_required", "category",
+    "sentiment", "summary", "reply_suggestions",
+)
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+async def _structured_events(
+    db: AsyncSession,
+    llm: LLMService,
+    email_id: uuid.UUID,
+    content: str,
+    style: str,
+    model: str,
+    language: str,
+):
+    """結構化串流：快取命中時一次送出所有欄位；完成後與 POST /summarize 相同方式寫入 DB 與快取"""
+    key = llm_cache.cache_key(content, style, model, language)
+    cached = await llm_cache.get(db, key)
+    if cached is not None:
+        result_data = {**cached, "tokens_used": 0, "generation_ms": 0, "cached": True}
+        for name in _STREAM_FIELDS:
+            if name in result_data:
+                yield _sse("field", {"name": name, "value": result_data[name]})
+    else:
+        result_data = None
+        try:
+            async for event in llm.analyze_email_structured_stream(
+                content, style=style, model=model, language=language
+            ):
+                if event["event"] == "result":
+                    result_data = event["data"]
+                elif event["event"] == "field":
+                    yield _sse("field", {"name": event["name"], "value": event["value"]})
+                else:
+                    yield _sse("summary_delta", {"text": event["text"]})
+        except Exception as e:
+            logger.warning(f"信件 {email_id} 結構化串流分析失敗：{e}")
+            yield _sse("error", {"detail": "分析失敗，請稍後再試"})
+            return
+        await llm_cache.put(db, key, result_data)
+
+    await _save_summary(db, email_id, style, result_data)
+    await db.commit()
+    yield _sse("result", result_data)
+
+
 def _format_email(msg: EmailMessage, include_body: bool = False) -> dict:
     data = {
         "id": str(msg.id),
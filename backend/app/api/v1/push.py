@@ -0,0 +1,75 @@
+"""
+Push 通知 API - 接收 Gmail watch 經由 Pub/Sub push 送來的通知
+
+Pub/Sub push 格式：
+{
+  "message": {"data": base64({"emailAddress": "...", "historyId": 123}), "messageId": "..."},
+  "subscription": "projects/.../subscriptions/..."
+}
+
+收到通知只把對應帳號放進同步佇列，實際的增量同步由 Worker 執行。
+"""
+import base64
+import json
+import logging
+import secrets
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.database import get_db
+from app.models.email import EmailAccount
+from app.services import sync_queue
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/push")
+
+
+@router.post("/gmail")
+async def gmail_push(
+    request: Request,
+    token: str = "",
+    db: AsyncSession = Depends(get_db),
+):
+    """Gmail push 通知 → 將受影響的帳號加入同步佇列"""
+    expected = settings.gmail_push_verification_token
+    if not expected or not secrets.compare_digest(token, expected):
+        raise HTTPException(status_code=403, detail="驗證失敗")
+
+    try:
+        envelope = await request.json()
+        data = json.loads(base64.b64decode(envelope["message"]["data"]))
+        email_address = data["emailAddress"]
+        history_id = int(data["historyId"])
+    except Exception:
+        # 回傳 2xx，避免格式錯誤的訊息被 Pub/Sub 無限重送
+        logger.warning("無法解析 Gmail push 通知", exc_info=True)
+        return {"ok": False}
+
+    metrics.incr("push.gmail_notifications")
+
+    result = await db.execute(
+        select(EmailAccount)
+        .where(
+            EmailAccount.email_address == email_address,
+            EmailAccount.provider == "gmail",
+            EmailAccount.is_active == True,  # noqa: E712
+            EmailAccount.sync_enabled == True,  # noqa: E712
+        )
+        .options(selectinload(EmailAccount.sync_state))
+    )
+    queued = 0
+    for account in result.scalars().all():
+        state = account.sync_state
+        # 通知的 historyId 不比已同步的新，代表已經處理過
+        if state and state.last_history_id and history_id <= state.last_history_id:
+            continue
+        if await sync_queue.request_sync(account.id, account.user_id):
+            queued += 1
+
+    return {"ok": True, "queued": queued}
@@ -10,6 +10,7 @@ from app.core.database import get_db
 from app.models.user import User
 from app.models.digest import DigestSchedule
 from app.api.v1.auth import get_current_user
+from app.services import pretriage
 from app.services.llm_service import LLMService
 
 router = APIRouter(prefix="/settings")
@@ -39,6 +40,17 @@ class LLMPreferenceUpdate(BaseModel):
     summary_language: str | None = None
 
 
+class PretriageRulesUpdate(BaseModel):
+    enabled: bool | None = None
+    promotions: str | None = None
+    social: str | None = None
+    list_mail: str | None = None
+    no_reply: str | None = None
+    low_reputation: str | None = None
+    reputation_min_messages: int | None = None
+    reputation_max_importance: float | None = None
+
+
 class DigestScheduleUpdate(BaseModel):
     is_enabled: bool | None = None
     frequency: str | None = None
@@ -85,6 +97,29 @@ async def update_llm_preference(
     return {"message": "設定已更新", "model": current_user.default_model}
 
 
+@router.get("/pretriage")
+async def get_pretriage_rules(current_user: User = Depends(get_current_user)):
+    """取得分析前分流規則（系統預設 + 用戶覆寫）"""
+    return {"rules": pretriage.rules_for(current_user), "actions": list(pretriage.ACTIONS)}
+
+
+@router.put("/pretriage")
+async def update_pretriage_rules(
+    body: PretriageRulesUpdate,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """更新分析前分流規則（只儲存有指定的欄位）"""
+    updates = body.model_dump(exclude_none=True)
+    for signal in pretriage.SIGNALS:
+        if signal in updates and updates[signal] not in pretriage.ACTIONS:
+            raise HTTPException(status_code=400, detail=f"{signal} 只能是 full / cheap / skip")
+
+    current_user.pretriage_rules = {**(current_user.pretriage_rules or {}), **updates}
+    await db.commit()
+    return {"message": "設定已更新", "rules": pretriage.rules_for(current_user)}
+
+
 @router.get("/digest")
 async def get_digest_schedule(
     current_user: User = Depends(get_current_user),
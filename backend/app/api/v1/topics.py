@@ -8,7 +8,7 @@ from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from sqlalchemy import select, func, desc
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, undefer
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.database import get_db
@@ -16,6 +16,7 @@ from app.models.topic import Topic, EmailTopic
 from app.models.email import EmailMessage, EmailAccount
 from app.models.user import User
 from app.api.v1.auth import get_current_user
+from app.services import topic_matcher
 
 router = APIRouter(prefix="/topics")
 
@@ -104,6 +105,8 @@ async def create_topic(
     db.add(topic)
     await db.commit()
     await db.refresh(topic)
+    if topic.auto_rules:
+        await topic_matcher.invalidate(current_user.id)
     return _format_topic(topic, email_count=0)
 
 
@@ -179,6 +182,8 @@ async def update_topic(
 
     await db.commit()
     await db.refresh(topic)
+    if data.auto_rules is not None or data.is_active is not None:
+        await topic_matcher.invalidate(current_user.id)
 
     # 查詢最新 email count
     count_result = await db.execute(
@@ -200,6 +205,7 @@ async def delete_topic(
     topic = await _get_topic_or_404(topic_id, current_user.id, db)
     topic.is_active = False
     await db.commit()
+    await topic_matcher.invalidate(current_user.id)
     return {"ok": True}
 
 
@@ -218,7 +224,7 @@ async def summarize_topic(
         select(EmailMessage)
         .join(EmailTopic, EmailTopic.message_id == EmailMessage.id)
         .where(EmailTopic.topic_id == topic_id)
-        .options(selectinload(EmailMessage.summary))
+        .options(selectinload(EmailMessage.summary), undefer(EmailMessage.analysis_text))
         .order_by(desc(EmailMessage.received_at))
         .limit(limit)
     )
@@ -232,7 +238,7 @@ async def summarize_topic(
         f"主旨: {m.subject or '(無)'}\n"
         f"寄件人: {m.sender or '?'}\n"
         f"時間: {m.received_at.isoformat() if m.received_at else '?'}\n"
-        f"內容: {(m.summary.summary_text if m.summary else None) or m.snippet or (m.body_plain or '')[:400]}"
+        f"內容: {_digest_content(m)}"
         for m in messages
     ])
 
@@ -259,7 +265,8 @@ async def summarize_topic(
     llm = LLMService()
 
     start = time.time()
-    response = await llm.client.chat.completions.create(
+    # 經過該模型的並行控制（llm_limiter），與信件分析共用上限
+    response = await llm.chat_completion(
         model=model,
         messages=[
             {"role": "system", "content": aggregate_system},
@@ -392,6 +399,12 @@ def _format_topic(topic: Topic, email_count: int = 0) -> dict:
     }
 
 
+def _digest_content(msg: EmailMessage) -> str:
+    """Topic 摘要用的單封信件內容：優先用已產生的摘要，其次 snippet / 分析內容前段"""
+    summary_text = msg.summary.summary_text if msg.summary else None
+    return summary_text or msg.snippet or (msg.analysis_text or "")[:400]
+
+
 def _format_email(msg: EmailMessage) -> dict:
     return {
         "id": str(msg.id),
@@ -0,0 +1,47 @@
+"""
+簡易 in-process 指標（counter / gauge / timing）
+
+API 與 Worker 是不同 process，各自累積；Worker 會定期把 snapshot 寫進 log。
+"""
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters: dict[str, float] = defaultdict(float)
+_gauges: dict[str, float] = {}
+_timings: dict[str, dict[str, float]] = {}
+
+
+def incr(name: str, value: float = 1) -> None:
+    """累加 counter"""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value: float) -> None:
+    """設定 gauge 目前值"""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    """記錄一次耗時（秒）或數值分佈"""
+    with _lock:
+        t = _timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+        t["count"] += 1
+        t["total"] += value
+        t["max"] = max(t["max"], value)
+        t["last"] = value
+
+
+def snapshot() -> dict:
+    """取得目前所有指標"""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": {
+                name: {**t, "avg": t["total"] / t["count"] if t["count"] else 0.0}
+                for name, t in _timings.items()
+            },
+        }
@@ -0,0 +1,16 @@
+"""共用 Redis 連線（redis.asyncio）"""
+from redis.asyncio import Redis
+
+from app.core.config import get_settings
+
+settings = get_settings()
+
+_client: Redis | None = None
+
+
+def get_redis() -> Redis:
+    """取得 process 內共用的 Redis client（連線池由 redis-py 管理）"""
+    global _client
+    if _client is None:
+        _client = Redis.from_url(settings.redis_url, decode_responses=True)
+    return _client
@@ -1,13 +1,16 @@
 """
 MailCake - FastAPI 主程式
 """
+import secrets
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.core import metrics
 from app.core.config import get_settings
-from app.core.database import engine, Base
-from app.api.v1 import auth, emails, settings as settings_router, topics
+from app.core.database import AsyncSessionLocal, engine, Base
+from app.api.v1 import auth, emails, push, settings as settings_router, topics
+from app.services import analysis_queue, llm_cache, llm_limiter, sync_queue
 
 settings_config = get_settings()
 
@@ -43,6 +46,7 @@ app.include_router(auth.router, prefix="/api/v1", tags=["auth"])
 app.include_router(emails.router, prefix="/api/v1", tags=["emails"])
 app.include_router(settings_router.router, prefix="/api/v1", tags=["settings"])
 app.include_router(topics.router, prefix="/api/v1", tags=["topics"])
+app.include_router(push.router, prefix="/api/v1", tags=["push"])
 
 
 @app.get("/health")
@@ -50,6 +54,28 @@ async def health():
     return {"status": "ok", "service": "mailcake-api"}
 
 
+def _require_metrics_token(request: Request) -> None:
+    """/metrics 含各帳號的佇列與 LLM 用量，只給帶共用 token 的監控使用"""
+    expected = settings_config.metrics_token
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not expected or not secrets.compare_digest(token, expected):
+        raise HTTPException(status_code=403, detail="驗證失敗")
+
+
+@app.get("/metrics", dependencies=[Depends(_require_metrics_token)])
+async def get_metrics():
+    """佇列深度（跨 process）與 API process 指標"""
+    async with AsyncSessionLocal() as db:
+        analysis = await analysis_queue.stats(db)
+    return {
+        "analysis_queue": analysis,
+        "sync_queue_depth": await sync_queue.queue_depth(),
+        "llm_cache": await llm_cache.stats(),
+        "llm_concurrency": llm_limiter.stats(),
+        "process": metrics.snapshot(),
+    }
+
+
 @app.get("/")
 async def root():
     return {
@@ -1,17 +1,23 @@
 from app.models.user import User
-from app.models.email import EmailAccount, EmailMessage, EmailSyncState
+from app.models.email import EmailAccount, EmailBody, EmailMessage, EmailSyncState
 from app.models.summary import EmailSummary
 from app.models.topic import Topic, EmailTopic
 from app.models.digest import DigestSchedule, DigestLog
+from app.models.analysis import AnalysisJob, LLMCacheEntry, NearDuplicateMatch, SimhashEntry
 
 __all__ = [
     "User",
     "EmailAccount",
     "EmailMessage",
+    "EmailBody",
     "EmailSyncState",
     "EmailSummary",
     "Topic",
     "EmailTopic",
     "DigestSchedule",
     "DigestLog",
+    "AnalysisJob",
+    "LLMCacheEntry",
+    "SimhashEntry",
+    "NearDuplicateMatch",
 ]
@@ -0,0 +1,113 @@
+import uuid
+from datetime import datetime
+from sqlalchemy import (
+    String, DateTime, Text, Integer, BigInteger, Boolean, ForeignKey, Index, JSON, text,
+)
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.dialects.postgresql import UUID
+from app.core.database import Base
+
+
+class AnalysisJob(Base):
+    """LLM 分析佇列（Postgres FOR UPDATE SKIP LOCKED，成功後刪除）"""
+    __tablename__ = "analysis_jobs"
+
+    message_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("email_messages.id"), primary_key=True
+    )
+
+    # 數字越大越先處理
+    priority: Mapped[int] = mapped_column(Integer, default=0)
+    # pending → running →（成功刪除）/ pending（退避重試）/ dead（超過重試上限）
+    status: Mapped[str] = mapped_column(String(20), default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    run_after: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    locked_at: Mapped[datetime | None] = mapped_column(DateTime)
+    last_error: Mapped[str | None] = mapped_column(Text)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # 與認領查詢的 ORDER BY priority DESC, run_after 一致
+        Index(
+            "ix_analysis_jobs_pending",
+            text("priority DESC"), "run_after",
+            postgresql_where=text("status = 'pending'"),
+        ),
+        # 重新認領 / dead-letter 逾時的 running 工作
+        Index(
+            "ix_analysis_jobs_running",
+            "locked_at",
+            postgresql_where=text("status = 'running'"),
+        ),
+    )
+
+
+class LLMCacheEntry(Base):
+    """LLM 分析結果快取（Redis 的 Postgres 備援；依 last_hit_at 做 LRU 清理）"""
+    __tablename__ = "llm_cache_entries"
+
+    # sha256(正規化內容 + 風格 + 模型 + 語言 + prompt 版本)
+    cache_key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    result: Mapped[dict] = mapped_column(JSON, nullable=False)
+    model: Mapped[str] = mapped_column(String(100))
+    hit_count: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_hit_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+
+    __table_args__ = (
+        Index("ix_llm_cache_entries_last_hit_at", "last_hit_at"),
+        Index("ix_llm_cache_entries_expires_at", "expires_at"),
+    )
+
+
+class SimhashEntry(Base):
+    """近似重複索引：已由 LLM 分析過的信件 SimHash（64 bit 切成 4 段 16 bit 做 LSH 查詢）"""
+    __tablename__ = "simhash_entries"
+
+    message_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("email_messages.id"), primary_key=True
+    )
+    user_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("users.id"), nullable=False
+    )
+    sender_domain: Mapped[str | None] = mapped_column(String(255))
+
+    simhash: Mapped[int] = mapped_column(BigInteger, nullable=False)  # 以有號 64 bit 儲存
+    band0: Mapped[int] = mapped_column(Integer, nullable=False)
+    band1: Mapped[int] = mapped_column(Integer, nullable=False)
+    band2: Mapped[int] = mapped_column(Integer, nullable=False)
+    band3: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_simhash_entries_band0", "user_id", "band0"),
+        Index("ix_simhash_entries_band1", "user_id", "band1"),
+        Index("ix_simhash_entries_band2", "user_id", "band2"),
+        Index("ix_simhash_entries_band3", "user_id", "band3"),
+    )
+
+
+class NearDuplicateMatch(Base):
+    """稽核紀錄：哪封信沿用了哪封信的分析結果"""
+    __tablename__ = "near_duplicate_matches"
+
+    id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    message_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("email_messages.id"), nullable=False
+    )
+    source_message_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("email_messages.id"), nullable=False
+    )
+    distance: Mapped[int] = mapped_column(Integer, nullable=False)  # SimHash 漢明距離
+    scope: Mapped[str] = mapped_column(String(20), nullable=False)  # user / sender_domain
+    adapted: Mapped[bool] = mapped_column(Boolean, default=False)  # 摘要是否替換了數字 / 編號
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_near_duplicate_matches_message_id", "message_id"),
+        Index("ix_near_duplicate_matches_source_message_id", "source_message_id"),
+        Index("ix_near_duplicate_matches_created_at", "created_at"),
+    )
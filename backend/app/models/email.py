@@ -1,8 +1,9 @@
 import uuid
+import zlib
 from datetime import datetime
 from sqlalchemy import (
     String, DateTime, Boolean, Text, Integer, Float,
-    ForeignKey, Index, BigInteger
+    ForeignKey, Index, BigInteger, LargeBinary, text
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.dialects.postgresql import UUID, ARRAY, TSVECTOR
@@ -25,12 +26,23 @@ class EmailAccount(Base):
     encrypted_refresh_token: Mapped[str | None] = mapped_column(Text)
     token_expires_at: Mapped[datetime | None] = mapped_column(DateTime)
 
+    # IMAP 連線設定（密碼加密存在 encrypted_access_token）
+    imap_host: Mapped[str | None] = mapped_column(String(255))
+    imap_port: Mapped[int | None] = mapped_column(Integer)
+    imap_use_ssl: Mapped[bool] = mapped_column(Boolean, default=True)
+
     # 同步設定
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     sync_enabled: Mapped[bool] = mapped_column(Boolean, default=True)
     last_synced_at: Mapped[datetime | None] = mapped_column(DateTime)
     sync_error: Mapped[str | None] = mapped_column(Text)
 
+    # 自適應排程：有新信縮短間隔、閒置放寬；連續失敗指數退避，過多次則隔離
+    next_sync_at: Mapped[datetime | None] = mapped_column(DateTime, default=datetime.utcnow)
+    sync_interval_seconds: Mapped[int | None] = mapped_column(Integer)
+    sync_failures: Mapped[int] = mapped_column(Integer, default=0)
+    quarantined_at: Mapped[datetime | None] = mapped_column(DateTime)
+
     # 模型覆寫（此帳號可指定不同模型）
     model_override: Mapped[str | None] = mapped_column(String(100))
 
@@ -48,6 +60,11 @@ class EmailAccount(Base):
     __table_args__ = (
         Index("ix_email_accounts_user_id", "user_id"),
         Index("ix_email_accounts_email", "email_address"),
+        Index(
+            "ix_email_accounts_next_sync_at",
+            "next_sync_at",
+            postgresql_where=text("is_active AND sync_enabled AND quarantined_at IS NULL"),
+        ),
     )
 
 
@@ -65,6 +82,16 @@ class EmailSyncState(Base):
     # IMAP 專用
     last_uidvalidity: Mapped[int | None] = mapped_column(BigInteger)
     last_uidnext: Mapped[int | None] = mapped_column(BigInteger)
+    last_modseq: Mapped[int | None] = mapped_column(BigInteger)  # CONDSTORE HIGHESTMODSEQ
+    # Gmail push（users.watch）到期時間，到期前由 Worker 續約
+    watch_expires_at: Mapped[datetime | None] = mapped_column(DateTime)
+    # 最後一次寫入同步結果的 lease fencing token（擋掉過期 lease 持有者的寫入）
+    lease_fence: Mapped[int | None] = mapped_column(BigInteger)
+    # Gmail 歷史信件回填：下一頁的 messages.list pageToken（None 且未完成 = 從頭開始）
+    backfill_page_token: Mapped[str | None] = mapped_column(String(500))
+    backfill_count: Mapped[int] = mapped_column(Integer, default=0)  # 已回填的信件數
+    backfill_completed_at: Mapped[datetime | None] = mapped_column(DateTime)
+    backfill_fence: Mapped[int | None] = mapped_column(BigInteger)  # 回填 lease 的 fencing token
 
     updated_at: Mapped[datetime] = mapped_column(
         DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
@@ -97,13 +124,21 @@ class EmailMessage(Base):
     recipients: Mapped[list[str] | None] = mapped_column(ARRAY(Text))
     cc: Mapped[list[str] | None] = mapped_column(ARRAY(Text))
 
-    # 信件內容
-    body_plain: Mapped[str | None] = mapped_column(Text)
-    body_html: Mapped[str | None] = mapped_column(Text)
+    # 信件內容（內文壓縮存在 email_bodies，以內容 hash 去重）
+    body_hash: Mapped[str | None] = mapped_column(
+        String(64), ForeignKey("email_bodies.content_hash")
+    )
     snippet: Mapped[str | None] = mapped_column(Text)  # 前 200 字
+    # metadata-first 同步：內文在需要時才下載，下載後記錄時間（None = 尚未下載）
+    body_fetched_at: Mapped[datetime | None] = mapped_column(DateTime)
+    # 正規化後送給 LLM 的文字（HTML 轉文字、去除引用歷史 / 簽名 / 制式頁尾）
+    # deferred：只有分析時才 undefer 載入
+    analysis_text: Mapped[str | None] = mapped_column(Text, deferred=True)
 
     # 元資料
     has_attachments: Mapped[bool] = mapped_column(Boolean, default=False)
+    # 帶有 List-Unsubscribe / List-Id 或 Precedence: bulk 的大量寄送信件（pre-triage 用）
+    is_list_mail: Mapped[bool | None] = mapped_column(Boolean)
     labels: Mapped[list[str] | None] = mapped_column(ARRAY(String(100)))
     is_read: Mapped[bool] = mapped_column(Boolean, default=False)
     is_starred: Mapped[bool] = mapped_column(Boolean, default=False)
@@ -115,8 +150,8 @@ class EmailMessage(Base):
     ai_category: Mapped[str | None] = mapped_column(String(100))
     sentiment: Mapped[str | None] = mapped_column(String(20))      # positive/neutral/negative
 
-    # 全文搜尋向量
-    search_vector: Mapped[str | None] = mapped_column(TSVECTOR)
+    # 全文搜尋向量（由 trigger 維護，只在 SQL 內使用）
+    search_vector: Mapped[str | None] = mapped_column(TSVECTOR, deferred=True)
 
     # Workspace 預留
     workspace_id: Mapped[uuid.UUID | None] = mapped_column(UUID(as_uuid=True))
@@ -130,6 +165,16 @@ class EmailMessage(Base):
         "EmailSummary", back_populates="message", uselist=False
     )
     topics: Mapped[list["EmailTopic"]] = relationship("EmailTopic", back_populates="message")
+    # 內文只能明確 selectinload，避免列表查詢意外載入
+    body: Mapped["EmailBody | None"] = relationship("EmailBody", lazy="raise")
+
+    @property
+    def body_plain(self) -> str | None:
+        return self.body.body_plain if self.body else None
+
+    @property
+    def body_html(self) -> str | None:
+        return self.body.body_html if self.body else None
 
     __table_args__ = (
         Index("ix_email_messages_account_received", "account_id", "received_at"),
@@ -141,4 +186,31 @@ class EmailMessage(Base):
             "account_id", "provider_message_id",
             unique=True
         ),
+        Index("ix_email_messages_body_hash", "body_hash"),
     )
+
+
+class EmailBody(Base):
+    """信件內文（zlib 壓縮，以 SHA-256 內容 hash 為 key，跨帳號去重）"""
+    __tablename__ = "email_bodies"
+
+    content_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    plain_z: Mapped[bytes | None] = mapped_column(LargeBinary)
+    html_z: Mapped[bytes | None] = mapped_column(LargeBinary)
+    raw_size: Mapped[int] = mapped_column(Integer, default=0)  # 未壓縮字元數
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    @property
+    def body_plain(self) -> str | None:
+        return _inflate(self.plain_z)
+
+    @property
+    def body_html(self) -> str | None:
+        return _inflate(self.html_z)
+
+
+def _inflate(data: bytes | None) -> str | None:
+    if data is None:
+        return None
+    return zlib.decompress(data).decode("utf-8", errors="surrogatepass")
@@ -1,6 +1,6 @@
 import uuid
 from datetime import datetime
-from sqlalchemy import String, DateTime, Boolean, Text
+from sqlalchemy import String, DateTime, Boolean, Text, JSON
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.dialects.postgresql import UUID
 from app.core.database import Base
@@ -21,6 +21,8 @@ class User(Base):
     default_model: Mapped[str] = mapped_column(String(100), default="claude-haiku")
     default_summary_style: Mapped[str] = mapped_column(String(50), default="bullet_points")
     summary_language: Mapped[str] = mapped_column(String(10), default="zh-TW")
+    # 分析前分流規則的覆寫（None 時使用系統預設，見 app.services.pretriage）
+    pretriage_rules: Mapped[dict | None] = mapped_column(JSON, nullable=True)
 
     # Workspace（預留協作功能）
     workspace_id: Mapped[uuid.UUID | None] = mapped_column(UUID(as_uuid=True), nullable=True)
@@ -0,0 +1,188 @@
+"""
+LLM 分析佇列（Postgres analysis_jobs）
+
+  - 同步寫入新信件時在同一個 transaction 內 enqueue，信件與分析工作不會不一致
+  - 分析 worker 以 `FOR UPDATE SKIP LOCKED` 認領工作，任意數量的 worker 可同時消化
+  - 失敗以指數退避重試，超過 analysis_max_attempts 次進入 dead（不再自動重試）
+  - 認領後超過 analysis_lock_timeout_seconds 沒有完成（worker 當機）會被重新認領；
+    已用完重試次數的逾時工作直接進入 dead，不會無限重新認領
+  - 認領時寫入的 locked_at 即為持有者憑證：complete / fail 只更新 locked_at 相符、
+    仍在 running 的工作，逾時後被其他 worker 重新認領的工作不會被舊持有者覆寫
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from sqlalchemy import delete, func, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.database import AsyncSessionLocal
+from app.models.analysis import AnalysisJob
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+PRIORITY_NEW = 10  # 增量同步的新信件
+PRIORITY_BACKFILL = 0  # 首次 / 全量同步、歷史信件
+
+_NOW = "now() AT TIME ZONE 'utc'"
+_STALE = f"locked_at < {_NOW} - make_interval(secs => :lock_timeout)"
+
+# 先認領 pending（走 ix_analysis_jobs_pending，順序與索引一致）
+_CLAIM_PENDING_SQL = text(f"""
+    UPDATE analysis_jobs SET status = 'running', locked_at = {_NOW}, attempts = attempts + 1
+    WHERE message_id IN (
+        SELECT message_id FROM analysis_jobs
+        WHERE status = 'pending' AND run_after <= {_NOW}
+        ORDER BY priority DESC, run_after
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING message_id, attempts, locked_at
+""")
+
+# 名額有剩才重新認領逾時的 running 工作（走 ix_analysis_jobs_running）
+_CLAIM_STALE_SQL = text(f"""
+    UPDATE analysis_jobs SET locked_at = {_NOW}, attempts = attempts + 1
+    WHERE message_id IN (
+        SELECT message_id FROM analysis_jobs
+        WHERE status = 'running' AND {_STALE} AND attempts < :max_attempts
+        ORDER BY locked_at
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING message_id, attempts, locked_at
+""")
+
+# 逾時且已用完重試次數（每次認領都算一次）的工作移入 dead
+_DEAD_LETTER_STALE_SQL = text(f"""
+    UPDATE analysis_jobs SET status = 'dead', locked_at = NULL,
+        last_error = 'lock timeout after ' || attempts || ' attempts'
+    WHERE message_id IN (
+        SELECT message_id FROM analysis_jobs
+        WHERE status = 'running' AND {_STALE} AND attempts >= :max_attempts
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING message_id
+""")
+
+
+class ClaimedJob(NamedTuple):
+    message_id: object
+    attempts: int
+    locked_at: datetime  # 持有者憑證，complete / fail 時帶回
+
+
+async def enqueue(db: AsyncSession, message_ids: list, priority: int = PRIORITY_NEW) -> None:
+    """加入分析佇列（已在佇列中的信件略過；由呼叫端 commit）"""
+    if not message_ids:
+        return
+    await db.execute(
+        pg_insert(AnalysisJob)
+        .values([
+            {"message_id": mid, "priority": priority, "status": "pending", "attempts": 0,
+             "run_after": datetime.utcnow(), "created_at": datetime.utcnow()}
+            for mid in message_ids
+        ])
+        .on_conflict_do_nothing(index_elements=["message_id"])
+    )
+    metrics.incr("analysis_queue.enqueued", len(message_ids))
+
+
+async def claim(limit: int) -> list[ClaimedJob]:
+    """認領最多 limit 個可執行的工作（pending 優先，其次是逾時的 running）"""
+    params = {
+        "lock_timeout": settings.analysis_lock_timeout_seconds,
+        "max_attempts": settings.analysis_max_attempts,
+    }
+    async with AsyncSessionLocal() as db:
+        dead = (await db.execute(_DEAD_LETTER_STALE_SQL, params)).all()
+        if dead:
+            metrics.incr("analysis_queue.dead_lettered", len(dead))
+            logger.error(f"{len(dead)} 個分析工作多次逾時未完成，移入 dead")
+
+        result = await db.execute(_CLAIM_PENDING_SQL, {**params, "limit": limit})
+        jobs = [ClaimedJob(*row) for row in result.all()]
+        if len(jobs) < limit:
+            result = await db.execute(_CLAIM_STALE_SQL, {**params, "limit": limit - len(jobs)})
+            reclaimed = [ClaimedJob(*row) for row in result.all()]
+            if reclaimed:
+                metrics.incr("analysis_queue.reclaimed", len(reclaimed))
+            jobs.extend(reclaimed)
+        await db.commit()
+    return jobs
+
+
+def _owned(jobs: list[ClaimedJob]):
+    """只比對自己認領的那一次（message_id + locked_at）"""
+    return (
+        AnalysisJob.status == "running",
+        tuple_(AnalysisJob.message_id, AnalysisJob.locked_at).in_(
+            [(job.message_id, job.locked_at) for job in jobs]
+        ),
+    )
+
+
+async def complete(jobs: list[ClaimedJob]) -> None:
+    """分析成功（或不需分析）的工作直接刪除；已被重新認領的工作不動"""
+    if not jobs:
+        return
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(delete(AnalysisJob).where(*_owned(jobs)))
+        await db.commit()
+    metrics.incr("analysis_queue.completed", result.rowcount)
+    if result.rowcount < len(jobs):
+        metrics.incr("analysis_queue.lost_ownership", len(jobs) - result.rowcount)
+
+
+async def fail(job: ClaimedJob, error: Exception) -> None:
+    """記錄失敗：指數退避後重試，超過上限進入 dead；已被重新認領的工作不動"""
+    message_id, attempts = job.message_id, job.attempts
+    error_text = f"{type(error).__name__}: {error}"[:2000]
+    values = {"last_error": error_text, "locked_at": None}
+    dead = attempts >= settings.analysis_max_attempts
+    if dead:
+        values["status"] = "dead"
+    else:
+        delay = min(
+            settings.analysis_backoff_max_seconds,
+            settings.analysis_backoff_base_seconds * 2 ** (attempts - 1),
+        )
+        values["status"] = "pending"
+        values["run_after"] = datetime.utcnow() + timedelta(seconds=delay)
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(update(AnalysisJob).where(*_owned([job])).values(**values))
+        await db.commit()
+
+    if result.rowcount == 0:
+        metrics.incr("analysis_queue.lost_ownership")
+        logger.warning(f"信件 {message_id} 的分析工作已被重新認領，略過失敗紀錄")
+    elif dead:
+        metrics.incr("analysis_queue.dead_lettered")
+        logger.error(f"信件 {message_id} 分析失敗 {attempts} 次，移入 dead：{error_text}")
+    else:
+        metrics.incr("analysis_queue.retried")
+
+
+async def stats(db: AsyncSession) -> dict:
+    """各狀態的工作數與最舊可執行工作的等待秒數（同時更新 gauge）"""
+    result = await db.execute(
+        select(AnalysisJob.status, func.count()).group_by(AnalysisJob.status)
+    )
+    counts = {"pending": 0, "running": 0, "dead": 0, **dict(result.all())}
+
+    oldest = await db.scalar(
+        select(func.min(AnalysisJob.run_after)).where(AnalysisJob.status == "pending")
+    )
+    counts["oldest_pending_seconds"] = (
+        max(0.0, (datetime.utcnow() - oldest).total_seconds()) if oldest else 0.0
+    )
+
+    for name, value in counts.items():
+        metrics.set_gauge(f"analysis_queue.{name}", value)
+    return counts
+
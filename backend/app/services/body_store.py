@@ -0,0 +1,120 @@
+"""
+信件內文儲存（email_bodies）
+
+內文不放在 email_messages：
+  - 以 SHA-256(plain + html) 為 key，同一份電子報在不同帳號只存一份
+  - zlib 壓縮後存 bytea（欄位 STORAGE EXTERNAL，Postgres 不再重複壓縮）
+  - email_messages 只留 body_hash；列表 / Digest / Topic 查詢完全不會碰到內文，
+    只有 GET /emails/{id} 與 LLM 分析會 selectinload(EmailMessage.body)
+
+共用內文的寫入與刪除以列鎖互斥：save 對已存在的內文也會鎖住該列（直到 transaction
+結束），delete_orphans 先 FOR UPDATE 鎖住再確認沒有信件引用，避免刪掉另一個同步
+剛去重到、但信件列還沒 commit 的內文。
+"""
+import asyncio
+import hashlib
+import zlib
+from datetime import datetime
+
+from sqlalchemy import delete, exists, false, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import metrics
+from app.models.email import EmailBody, EmailMessage
+
+_COMPRESS_LEVEL = 6
+
+
+def content_hash(body_plain: str | None, body_html: str | None) -> str:
+    digest = hashlib.sha256()
+    digest.update((body_plain or "").encode("utf-8", errors="surrogatepass"))
+    digest.update(b"\0")
+    digest.update((body_html or "").encode("utf-8", errors="surrogatepass"))
+    return digest.hexdigest()
+
+
+def _compress(text: str | None) -> bytes | None:
+    if not text:
+        return None
+    return zlib.compress(text.encode("utf-8", errors="surrogatepass"), _COMPRESS_LEVEL)
+
+
+def _pack(bodies: list[tuple[str | None, str | None]]) -> tuple[list[str], list[dict]]:
+    now = datetime.utcnow()
+    hashes, rows, seen = [], [], set()
+    for plain, html in bodies:
+        h = content_hash(plain, html)
+        hashes.append(h)
+        if h in seen:
+            continue
+        seen.add(h)
+        rows.append({
+            "content_hash": h,
+            "plain_z": _compress(plain),
+            "html_z": _compress(html),
+            "raw_size": len(plain or "") + len(html or ""),
+            "created_at": now,
+        })
+    # 固定加鎖順序，併發寫入相同內文時不會互相死鎖
+    rows.sort(key=lambda row: row["content_hash"])
+    return hashes, rows
+
+
+async def save(db: AsyncSession, bodies: list[tuple[str | None, str | None]]) -> list[str]:
+    """
+    寫入內文（已存在的內容不會重寫），回傳與輸入順序對應的 content hash
+
+    已存在的內文用 `ON CONFLICT DO UPDATE ... WHERE false`：不更新，但會鎖住該列到
+    transaction 結束，讓 delete_orphans 等到引用它的信件列 commit 之後才判斷。
+    雜湊與壓縮在 thread 執行，不佔用 event loop。
+    """
+    if not bodies:
+        return []
+
+    hashes, rows = await asyncio.to_thread(_pack, bodies)
+    stmt = pg_insert(EmailBody).values(rows)
+    result = await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["content_hash"],
+            set_={"content_hash": stmt.excluded.content_hash},
+            where=false(),
+        ).returning(EmailBody.content_hash)
+    )
+    inserted = len(result.all())
+    metrics.incr("body_store.inserted", inserted)
+    metrics.incr("body_store.deduplicated", len(bodies) - inserted)
+    return hashes
+
+
+async def load(db: AsyncSession, hashes: list[str]) -> dict[str, EmailBody]:
+    if not hashes:
+        return {}
+    result = await db.execute(select(EmailBody).where(EmailBody.content_hash.in_(set(hashes))))
+    return {body.content_hash: body for body in result.scalars().all()}
+
+
+async def delete_orphans(db: AsyncSession, hashes: list[str]) -> None:
+    """
+    刪除已沒有任何信件引用的內文（只檢查給定的 hash）
+
+    先 FOR UPDATE 鎖住內文列：其他 transaction 剛用 save 去重到同一份內文時，
+    會等它 commit 後再檢查引用（此時已看得到它的信件列），不會刪掉正要被引用的內文。
+    """
+    if not hashes:
+        return
+    locked = await db.execute(
+        select(EmailBody.content_hash)
+        .where(EmailBody.content_hash.in_(set(hashes)))
+        .order_by(EmailBody.content_hash)
+        .with_for_update()
+    )
+    candidates = list(locked.scalars().all())
+    if not candidates:
+        return
+    await db.execute(
+        delete(EmailBody).where(
+            EmailBody.content_hash.in_(candidates),
+            ~exists().where(EmailMessage.body_hash == EmailBody.content_hash),
+        )
+    )
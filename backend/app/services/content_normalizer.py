@@ -0,0 +1,164 @@
+"""
+信件內容正規化（分析用文字）
+
+內文下載後產生 analysis_text，LLM 分析只送這份精簡過的文字：
+  - HTML 轉純文字（beautifulsoup4），去除 script / style / 隱藏元素 / 追蹤像素
+  - 去除引用的歷史對話（blockquote、Gmail / Outlook 的引用區塊、"On ... wrote:"、`>` 開頭的行）
+  - 去除簽名檔（`-- ` 分隔線、"Sent from my iPhone" 等）
+  - 去除制式頁尾（取消訂閱、保密聲明、在瀏覽器中檢視），長追蹤連結換成 [連結]
+
+只有 text/html 的信件也能得到完整內文，不再退回 300 字 snippet。
+另外提供 is_list_mail()：由標頭判斷是否為大量寄送的信件（pre-triage 用）。
+"""
+import re
+
+from bs4 import BeautifulSoup, Comment
+
+# 純文字部分太短（例如「請用 HTML 檢視」）時改用 HTML 轉出的文字
+_MIN_PLAIN_CHARS = 200
+
+_DROP_TAGS = ["script", "style", "head", "title", "meta", "noscript", "svg", "template"]
+
+# 各家信箱把引用歷史包起來的元素
+_QUOTE_SELECTORS = [
+    "blockquote",
+    "div.gmail_quote",
+    "div.gmail_extra",
+    "div.yahoo_quoted",
+    "div.moz-cite-prefix",
+    "div#divRplyFwdMsg",
+    "div#appendonsend",
+    "div#mail-editor-reference-message-container",
+]
+
+_BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "section"}
+
+# 出現後整段截斷：回覆 / 轉寄的歷史標頭
+_QUOTE_HEADER_RE = re.compile(
+    r"^\s*("
+    r"On .{0,200}wrote:\s*$"
+    r"|在?\s*.{0,100}(寫道|写道)\s*[:：]\s*$"
+    r"|-{2,}\s*(Original Message|Forwarded message|原始郵件|轉寄的郵件)\s*-{2,}"
+    r"|_{20,}\s*$"
+    r"|(From|寄件者|发件人)\s*[:：].+$(?=\n\s*(Sent|Date|寄件日期|日期|发送时间)\s*[:：])"
+    r")",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# 出現後整段截斷：簽名檔
+_SIGNATURE_RE = re.compile(
+    r"^(-- ?$"
+    r"|Sent from my \w+"
+    r"|Get Outlook for \w+"
+    r"|從我的 \S+ 傳送"
+    r"|从我的\S+发送)",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# 單行刪除：制式頁尾（取消訂閱、保密聲明、在瀏覽器中檢視、訂閱偏好設定）
+# 只比對行首（頁尾連結列則是 `|` 分隔的每一段開頭），內文中提到這些字詞不會被刪
+_BOILERPLATE_RE = re.compile(
+    r"^\W*(?:"
+    r"(?:click here to |to |you can )unsubscribe\b"
+    r"|unsubscribe(?:\s*$|\s+(?:here|now|from|at any time|anytime|below)\b"
+    r"|\s*[:：]?\s*(?:https?://|<|\[))"
+    r"|if you (?:no longer )?(?:wish|want) to (?:unsubscribe|stop receiving)"
+    r"|(?:view|read|open) (?:this (?:e-?mail|newsletter|message) )?"
+    r"(?:online|in (?:your |a )?(?:web )?browser)"
+    r"|this (?:e-?mail|message) (?:and any attachments )?(?:is|are|may be|contains?) "
+    r"(?:confidential|privileged)"
+    r"|(?:manage|update) (?:your )?(?:e-?mail |subscription |notification )?preferences"
+    r"|you(?:'re| are) receiving this"
+    r"|(?:如(?:欲|要|需|不想再收到.{0,20}?)|若要|點此|点此|按此|請點此)[，,]?\s*"
+    r"(?:取消訂閱|取消订阅|退訂)"
+    r"|(?:取消訂閱|取消订阅|退訂)(?:\s*$|\s*[:：]?\s*(?:https?://|<|\[)"
+    r"|\s*(?:請|请)?(?:點此|点此|按此|點選|点击))"
+    r"|在(?:瀏覽器|浏览器)中(?:檢視|查看)"
+    r"|本(?:郵件|信件|邮件).{0,20}(?:機密|保密|机密)"
+    r")",
+    re.IGNORECASE,
+)
+_SEGMENT_SPLIT_RE = re.compile(r"[|·•]")
+
+# 頁尾行的長度上限（保密聲明常是一整段，放寬到 300 字）
+_BOILERPLATE_MAX_CHARS = 300
+# 只在信件開頭幾行（在瀏覽器中檢視）與結尾幾行（頁尾）找制式文字
+_HEADER_LINES = 3
+_FOOTER_LINES = 12
+
+_URL_RE = re.compile(r"https?://\S{60,}")
+
+
+def html_to_text(html: str) -> str:
+    """HTML → 純文字（不含引用歷史、隱藏元素與追蹤像素）"""
+    soup = BeautifulSoup(html, "html.parser")
+
+    for tag in soup(_DROP_TAGS):
+        tag.decompose()
+    for comment in soup.find_all(string=lambda s: isinstance(s, Comment)):
+        comment.extract()
+    for selector in _QUOTE_SELECTORS:
+        for tag in soup.select(selector):
+            tag.decompose()
+    for tag in soup.find_all(style=re.compile(r"display\s*:\s*none", re.IGNORECASE)):
+        tag.decompose()
+    for img in soup.find_all("img"):
+        img.decompose()
+
+    # 區塊元素前後補換行，get_text 才不會把段落黏在一起
+    for tag in soup.find_all(_BLOCK_TAGS):
+        tag.insert_before("\n")
+        tag.insert_after("\n")
+
+    return soup.get_text()
+
+
+def _cut_at(pattern: re.Pattern, text: str) -> str:
+    match = pattern.search(text)
+    # 第一行就命中（整封都是轉寄內容）時保留原文
+    if match and text[:match.start()].strip():
+        return text[:match.start()]
+    return text
+
+
+def _is_boilerplate(line: str) -> bool:
+    """短的、以制式文字開頭的行；問句一定是內文"""
+    if len(line) > _BOILERPLATE_MAX_CHARS or line.endswith(("?", "？")):
+        return False
+    return any(_BOILERPLATE_RE.match(seg.strip()) for seg in _SEGMENT_SPLIT_RE.split(line))
+
+
+def clean_text(text: str) -> str:
+    """去除引用歷史、簽名檔與制式頁尾，壓縮空白"""
+    text = text.replace("\r\n", "\n").replace("\xa0", " ")
+    text = _cut_at(_QUOTE_HEADER_RE, text)
+    text = _cut_at(_SIGNATURE_RE, text)
+
+    stripped_lines = [line.strip() for line in text.split("\n")]
+    content = [i for i, line in enumerate(stripped_lines) if line]
+    edges = set(content[:_HEADER_LINES] + content[-_FOOTER_LINES:])
+
+    lines = []
+    for i, stripped in enumerate(stripped_lines):
+        if stripped.startswith(">") or (i in edges and _is_boilerplate(stripped)):
+            continue
+        lines.append(_URL_RE.sub("[連結]", re.sub(r"[ \t]+", " ", stripped)))
+
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def is_list_mail(headers: dict) -> bool:
+    """大量寄送的信件（電子報 / 郵件列表）；headers 的 key 為小寫"""
+    if headers.get("list-unsubscribe") or headers.get("list-id"):
+        return True
+    return (headers.get("precedence") or "").strip().lower() in ("bulk", "list", "junk")
+
+
+def normalize(body_plain: str | None, body_html: str | None) -> str:
+    """由原始內文產生 analysis_text"""
+    plain = clean_text(body_plain) if body_plain else ""
+    if len(plain) >= _MIN_PLAIN_CHARS or not body_html:
+        return plain
+
+    from_html = clean_text(html_to_text(body_html))
+    return from_html if len(from_html) > len(plain) else plain
@@ -0,0 +1,231 @@
+"""
+非同步 Gmail Client
+
+googleapiclient / httplib2 都是同步 I/O，直接在 coroutine 裡呼叫會卡住
+整個 worker event loop（包含進行中的 LLM 分析）。
+
+這裡用「有上限的 thread pool」包裝 gmail_service：
+  - 所有 Gmail round trip（含 token refresh）都在 pool thread 執行
+  - 每個 pool thread 持有自己的 httplib2.Http，keep-alive 連線在 thread 內重用
+    （httplib2.Http 不是 thread-safe，所以不能跨 thread 共用）
+  - Worker 只透過 AsyncGmailClient 與 Gmail 溝通
+  - 每個帳號的 client（Credentials + Service）快取在 process 內，穩定狀態下的同步
+    不需要重新解密 Token 或建立 Service；重新授權或閒置過久時淘汰
+  - refresh 後的 Token 經 token_manager 寫回 DB
+  - 每個 HTTP 請求送出前經 gmail_quota 扣除配額（Redis token bucket，跨 replica 共用），
+    rate limit 時退避後自動重試
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import httplib2
+from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.services import gmail_quota, gmail_service, token_manager
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.gmail_max_workers,
+    thread_name_prefix="gmail",
+)
+_local = threading.local()
+
+
+def _thread_http() -> httplib2.Http:
+    """取得目前 pool thread 專屬的 Http（連線池，跨呼叫重用）"""
+    http = getattr(_local, "http", None)
+    if http is None:
+        http = httplib2.Http(timeout=settings.gmail_http_timeout)
+        _local.http = http
+    return http
+
+
+async def run_in_gmail_pool(fn, *args, **kwargs):
+    """在 Gmail thread pool 執行同步函式"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+@dataclass
+class _CachedClient:
+    client: "AsyncGmailClient"
+    refresh_fingerprint: str | None  # 建立時的加密 refresh token（重新授權後淘汰）
+    last_used: float
+
+
+_clients: dict = {}
+_refresh_locks: dict = defaultdict(asyncio.Lock)
+
+
+def _evict_idle(now: float) -> None:
+    idle = [
+        aid for aid, c in _clients.items()
+        if now - c.last_used > settings.gmail_client_idle_seconds
+    ]
+    for account_id in idle:
+        del _clients[account_id]
+
+
+async def _refresh(account_id, creds, margin_seconds: int = 0) -> bool:
+    """
+    在 thread pool refresh Token 並寫回 DB，回傳是否有 refresh
+
+    同一帳號同時只有一個 refresh；等到鎖時別人已經 refresh 過就直接返回。
+    """
+    async with _refresh_locks[account_id]:
+        if not creds.refresh_token or not token_manager.expires_within(creds, margin_seconds):
+            return False
+        previous_refresh_token = creds.refresh_token
+        await run_in_gmail_pool(creds.refresh, Request())
+        await token_manager.persist(account_id, creds, previous_refresh_token)
+        metrics.incr("gmail.token_refreshes")
+        return True
+
+
+async def client_for_account(account) -> "AsyncGmailClient | None":
+    """
+    取得帳號的已連線 client（沒有 Token 時回傳 None）
+
+    以帳號 id 快取；refresh token 與快取建立時相同才重用。DB 中的 access token
+    比快取新（其他 process 已 refresh）時直接換上，不重建 Service。
+    Token 正常情況下由 Worker 在到期前背景 refresh；只有已經過期時才在這裡同步 refresh。
+    """
+    if not account.encrypted_access_token:
+        return None
+
+    now = time.monotonic()
+    _evict_idle(now)
+
+    cached = _clients.get(account.id)
+    if cached and cached.refresh_fingerprint == account.encrypted_refresh_token:
+        metrics.incr("gmail.client_cache_hits")
+        cached.last_used = now
+        client = cached.client
+        creds = client.credentials
+        if account.token_expires_at and (
+            creds.expiry is None or account.token_expires_at > creds.expiry
+        ):
+            creds.token = token_manager.decrypt(account.encrypted_access_token)
+            creds.expiry = account.token_expires_at
+    else:
+        metrics.incr("gmail.client_cache_misses")
+        access_token = token_manager.decrypt(account.encrypted_access_token)
+        if not access_token:
+            return None
+        client = AsyncGmailClient(
+            access_token,
+            token_manager.decrypt(account.encrypted_refresh_token),
+            expiry=account.token_expires_at,
+            quota_key=account.id,
+        )
+        await client.connect()
+        _clients[account.id] = _CachedClient(client, account.encrypted_refresh_token, now)
+
+    if client.credentials.expired:
+        metrics.incr("gmail.token_inline_refreshes")
+        await _refresh(account.id, client.credentials)
+    return client
+
+
+async def refresh_account_token(account) -> bool:
+    """Token 將在 token_refresh_margin_seconds 內到期時預先 refresh（Worker 背景任務用）"""
+    client = await client_for_account(account)
+    if not client:
+        return False
+    return await _refresh(account.id, client.credentials, settings.token_refresh_margin_seconds)
+
+
+class AsyncGmailClient:
+    """gmail_service 的非同步介面（thread pool adapter）"""
+
+    def __init__(
+        self, access_token: str, refresh_token: str | None = None, expiry=None, quota_key=None
+    ):
+        self.credentials = gmail_service.build_credentials(access_token, refresh_token, expiry)
+        self.quota_key = quota_key  # per-user 配額 bucket（帳號 id）；None 時不經 limiter
+        self._service = None
+
+    async def connect(self) -> "AsyncGmailClient":
+        """建立 Gmail API Service（Token refresh 由 client_for_account 負責）"""
+        await run_in_gmail_pool(self._connect)
+        return self
+
+    def _connect(self) -> None:
+        if self._service is None:
+            self._service = gmail_service.build_service("gmail", "v1", self.credentials)
+
+    def _http(self) -> AuthorizedHttp:
+        return AuthorizedHttp(self.credentials, http=_thread_http())
+
+    async def _call(self, fn, *args, **kwargs):
+        if self._service is None:
+            await self.connect()
+        quota = None
+        if self.quota_key is not None:
+            quota = gmail_quota.QuotaCharger(self.quota_key, asyncio.get_running_loop())
+
+        for attempt in range(settings.gmail_rate_limit_retries + 1):
+            try:
+                return await run_in_gmail_pool(
+                    lambda: fn(self._service, *args, http=self._http(), quota=quota, **kwargs)
+                )
+            except Exception as e:
+                retryable = gmail_service.is_rate_limit_error(e)
+                if attempt >= settings.gmail_rate_limit_retries or not retryable:
+                    raise
+                base = settings.gmail_rate_limit_backoff_base_seconds
+                backoff = base * 2 ** attempt
+                if quota is not None:
+                    # 共用退避：期間所有 replica 對此用戶的呼叫都會在 limiter 等待；
+                    # 寫入失敗時仍照本地退避，不會立刻重打 Gmail
+                    try:
+                        backoff = max(base, await gmail_quota.report_rate_limited(self.quota_key))
+                    except Exception:
+                        logger.warning("回報 Gmail rate limit 失敗，改用本地退避", exc_info=True)
+                await asyncio.sleep(backoff)
+
+    async def fetch_changes(
+        self,
+        max_results: int = 50,
+        after_history_id: Optional[int] = None,
+    ) -> gmail_service.HistoryChanges:
+        return await self._call(
+            gmail_service.fetch_changes,
+            max_results=max_results,
+            after_history_id=after_history_id,
+        )
+
+    async def list_messages_page(
+        self, page_token: str | None = None, page_size: int = 100, query: str = ""
+    ) -> tuple[list[str], str | None]:
+        return await self._call(
+            gmail_service.list_messages_page, page_token, page_size=page_size, query=query
+        )
+
+    async def get_message_detail(self, message_id: str, format: str = "full") -> dict:
+        return await self._call(gmail_service.get_message_detail, message_id, format=format)
+
+    async def get_message_details_batch(
+        self, message_ids: list[str], format: str = "full"
+    ) -> tuple[list[dict], list[str]]:
+        return await self._call(
+            gmail_service.get_message_details_batch, message_ids, format=format
+        )
+
+    async def get_latest_history_id(self) -> int:
+        return await self._call(gmail_service.get_latest_history_id)
+
+    async def watch(self, topic_name: str) -> dict:
+        return await self._call(gmail_service.watch, topic_name)
@@ -0,0 +1,151 @@
+"""
+Gmail API 配額 limiter（Redis token bucket，所有 API / Worker replica 共用）
+
+Gmail 以 quota units 計算配額：per-user（每個信箱）與 per-project（整個 OAuth client）
+各有一個上限，不同方法的成本不同（gmail_service.QUOTA_UNITS）。
+  - 每個 Gmail 呼叫在送出前向兩個 bucket 各扣除自己的 units；任一不足就等待
+  - 單次成本超過 bucket 容量（例如 100 封的 batch）時，bucket 滿即放行並允許扣成負值，
+    後續呼叫自然被延後
+  - 收到 rateLimitExceeded 時對該用戶設定指數退避，期間所有 replica 的呼叫都會等待
+  - Redis 無法使用時不擋呼叫（fail-open），只記錄 metric
+"""
+import asyncio
+import logging
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.redis import get_redis
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_USER_KEY = "mailcake:gmail_quota:user:{user_key}"
+_PROJECT_KEY = "mailcake:gmail_quota:project:{project}"
+_BACKOFF_KEY = "mailcake:gmail_quota:backoff:{user_key}"
+_STRIKES_KEY = "mailcake:gmail_quota:strikes:{user_key}"
+
+# 單次等待上限（秒）；等完後重新檢查，避免長時間睡過已恢復的配額
+_MAX_SLEEP_SECONDS = 5.0
+
+# KEYS: user bucket, project bucket, user backoff
+# ARGV: units, user rate（units / 秒）, user 容量, project rate, project 容量
+# 回傳 0 = 已扣除；> 0 = 需要等待的毫秒數
+_ACQUIRE_SCRIPT = """
+local backoff = redis.call("PTTL", KEYS[3])
+if backoff > 0 then
+    return backoff
+end
+
+local t = redis.call("TIME")
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local units = tonumber(ARGV[1])
+
+local function level(key, rate, capacity)
+    local v = redis.call("HMGET", key, "tokens", "ts")
+    local tokens = tonumber(v[1]) or capacity
+    local ts = tonumber(v[2]) or now
+    return math.min(capacity, tokens + (now - ts) * rate / 1000)
+end
+
+local buckets = {
+    {KEYS[1], tonumber(ARGV[2]), tonumber(ARGV[3])},
+    {KEYS[2], tonumber(ARGV[4]), tonumber(ARGV[5])},
+}
+local wait = 0
+for i, b in ipairs(buckets) do
+    b[4] = level(b[1], b[2], b[3])
+    local need = math.min(units, b[3])
+    if b[4] < need then
+        wait = math.max(wait, math.ceil((need - b[4]) * 1000 / b[2]))
+    end
+end
+if wait > 0 then
+    return wait
+end
+
+for i, b in ipairs(buckets) do
+    redis.call("HSET", b[1], "tokens", b[4] - units, "ts", now)
+    redis.call("PEXPIRE", b[1], 60000)
+end
+return 0
+"""
+
+
+def _limits() -> tuple[float, float, float, float]:
+    headroom = settings.gmail_quota_headroom
+    burst = settings.gmail_quota_burst_seconds
+    user_rate = settings.gmail_user_quota_units_per_second * headroom
+    project_rate = settings.gmail_project_quota_units_per_second * headroom
+    return user_rate, user_rate * burst, project_rate, project_rate * burst
+
+
+async def acquire(user_key, units: int) -> None:
+    """扣除 units（per-user 與 per-project），配額不足或退避中時等待"""
+    user_rate, user_capacity, project_rate, project_capacity = _limits()
+    keys = [
+        _USER_KEY.format(user_key=user_key),
+        _PROJECT_KEY.format(project=settings.google_client_id or "default"),
+        _BACKOFF_KEY.format(user_key=user_key),
+    ]
+    waited = 0.0
+    while True:
+        try:
+            wait_ms = await get_redis().eval(
+                _ACQUIRE_SCRIPT, len(keys), *keys,
+                units, user_rate, user_capacity, project_rate, project_capacity,
+            )
+        except Exception:
+            metrics.incr("gmail_quota.limiter_errors")
+            logger.warning("Gmail 配額 limiter 無法使用，直接放行", exc_info=True)
+            return
+
+        if not wait_ms:
+            break
+        delay = min(_MAX_SLEEP_SECONDS, int(wait_ms) / 1000)
+        waited += delay
+        await asyncio.sleep(delay)
+
+    metrics.incr("gmail_quota.units", units)
+    if waited:
+        metrics.incr("gmail_quota.throttled")
+        metrics.observe("gmail_quota.wait_seconds", waited)
+
+
+async def report_rate_limited(user_key) -> float:
+    """收到 rateLimitExceeded：該用戶所有呼叫暫停（連續觸發時指數加長），回傳退避秒數"""
+    redis = get_redis()
+    strikes_key = _STRIKES_KEY.format(user_key=user_key)
+    try:
+        strikes = await redis.incr(strikes_key)
+        await redis.expire(strikes_key, settings.gmail_rate_limit_backoff_max_seconds * 5)
+        delay = min(
+            settings.gmail_rate_limit_backoff_max_seconds,
+            settings.gmail_rate_limit_backoff_base_seconds * 2 ** (strikes - 1),
+        )
+        await redis.set(_BACKOFF_KEY.format(user_key=user_key), 1, px=int(delay * 1000))
+    except Exception:
+        logger.warning("寫入 Gmail 退避狀態失敗", exc_info=True)
+        delay = settings.gmail_rate_limit_backoff_base_seconds
+
+    metrics.incr("gmail_quota.rate_limited")
+    logger.warning(f"Gmail 用戶 {user_key} 觸發 rate limit，暫停 {delay}s")
+    return delay
+
+
+class QuotaCharger:
+    """
+    給 Gmail pool thread 使用的同步介面
+
+    gmail_service 的函式在 thread 內執行，每個 HTTP 請求送出前呼叫 charge()；
+    實際的 Redis 操作交回 event loop 執行，thread 等到放行才繼續。
+    """
+
+    def __init__(self, user_key, loop: asyncio.AbstractEventLoop):
+        self.user_key = user_key
+        self._loop = loop
+
+    def charge(self, units: int) -> None:
+        asyncio.run_coroutine_threadsafe(acquire(self.user_key, units), self._loop).result()
+
+    def backoff(self) -> None:
+        asyncio.run_coroutine_threadsafe(report_rate_limited(self.user_key), self._loop).result()
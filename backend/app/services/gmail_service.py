@@ -5,17 +5,43 @@ Gmail OAuth 2.0 整合服務
 """
 import base64
 import email
+import json
+import logging
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from typing import Optional
 
 from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
 from googleapiclient.errors import HttpError
 
 from app.core.config import get_settings
+from app.services import content_normalizer
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Gmail batch endpoint 單次最多 100 個子請求
+BATCH_MAX_SIZE = 100
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Gmail API 各方法的 quota units（per-user 配額以 units / 秒計算）
+QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "history.list": 2,
+    "getProfile": 1,
+    "watch": 100,
+}
+
+# metadata 模式（metadata-first 同步）只取建立信件列需要的標頭與欄位
+METADATA_HEADERS = [
+    "Subject", "From", "To", "Cc", "Date", "In-Reply-To",
+    "List-Unsubscribe", "List-Id", "Precedence",
+]
+METADATA_FIELDS = "id,threadId,labelIds,snippet,payload(mimeType,headers)"
 
 # Temporary store for PKCE code_verifiers keyed by OAuth state (TTL ~10 min)
 import time as _time
@@ -105,88 +131,380 @@ def exchange_code_for_tokens(code: str, state: str | None = None) -> dict:
 
 def _get_user_email(creds: Credentials) -> str:
     """取得用戶 Gmail 地址"""
-    from googleapiclient.discovery import build
-
-    service = build("oauth2", "v2", credentials=creds)
+    service = build_service("oauth2", "v2", creds)
     user_info = service.userinfo().get().execute()
     return user_info.get("email", "")
 
 
-def build_gmail_service(access_token: str, refresh_token: str | None = None):
-    """建立 Gmail API Service"""
-    creds = Credentials(
+def build_credentials(
+    access_token: str, refresh_token: str | None = None, expiry: datetime | None = None
+) -> Credentials:
+    """建立 OAuth Credentials（不做任何網路呼叫；expiry 為 naive UTC）"""
+    return Credentials(
         token=access_token,
         refresh_token=refresh_token,
         token_uri="https://oauth2.googleapis.com/token",
         client_id=settings.google_client_id,
         client_secret=settings.google_client_secret,
+        expiry=expiry,
     )
 
-    # 自動更新 Token
-    if creds.expired and creds.refresh_token:
-        creds.refresh(Request())
 
-    return build("gmail", "v1", credentials=creds)
+_discovery_docs: dict[tuple[str, str], dict] = {}
+_discovery_lock = threading.Lock()
+
+
+def _discovery_document(name: str, version: str) -> dict | None:
+    """google-api-python-client 內建的靜態 discovery 文件（每個 process 只解析一次）"""
+    doc = _discovery_docs.get((name, version))
+    if doc is None:
+        with _discovery_lock:
+            doc = _discovery_docs.get((name, version))
+            if doc is None:
+                raw = discovery_cache.get_static_doc(name, version)
+                if raw is None:
+                    return None
+                doc = _discovery_docs[(name, version)] = json.loads(raw)
+    return doc
+
+
+def build_service(name: str, version: str, credentials: Credentials):
+    """用預先載入的 discovery 文件建立 API Service（不發網路請求、不重新解析 JSON）"""
+    doc = _discovery_document(name, version)
+    if doc is None:
+        return build(name, version, credentials=credentials, cache_discovery=False)
+    return build_from_document(doc, credentials=credentials)
+
+
+def _charge(quota, method: str, count: int = 1) -> None:
+    """送出請求前向配額 limiter（gmail_quota.QuotaCharger）扣除 units；quota 為 None 時不限制"""
+    if quota is not None:
+        quota.charge(QUOTA_UNITS[method] * count)
+
 
+@dataclass
+class HistoryChanges:
+    """一次同步取得的信箱變更"""
+    added: list[str] = field(default_factory=list)  # 需要抓取內容的新信件 id
+    deleted: list[str] = field(default_factory=list)  # 已從信箱刪除的信件 id
+    label_updates: dict[str, list[str]] = field(default_factory=dict)  # id → 最新 labelIds
+    history_id: int | None = None  # 下次增量同步的起點
+    full_resync: bool = False  # 是否為全量（首次 / history 過期）同步
 
-def fetch_new_messages(
+
+def fetch_changes(
     service,
     max_results: int = 50,
     after_history_id: Optional[int] = None,
-) -> list[dict]:
+    http=None,
+    quota=None,
+) -> HistoryChanges:
     """
-    取得新信件清單
+    取得信箱變更
     首次同步：取最近 max_results 封
-    增量同步：用 history_id 取得新增的信件
+    增量同步：逐頁讀取 history，包含新增、刪除與標籤變更；
+             history_id 過期（404）時改做有上限的全量重新同步
     """
-    messages = []
-
-    if after_history_id:
-        # 增量同步
-        try:
-            history = (
-                service.users()
-                .history()
-                .list(
-                    userId="me",
-                    startHistoryId=after_history_id,
-                    historyTypes=["messageAdded"],
-                )
-                .execute()
+    if not after_history_id:
+        return full_sync(service, max_results=max_results, http=http, quota=quota)
+
+    try:
+        return _fetch_history(service, after_history_id, http=http, quota=quota)
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        logger.warning(f"history_id {after_history_id} 已過期，改做全量重新同步")
+        return full_sync(
+            service, max_results=settings.gmail_full_resync_max, http=http, quota=quota
+        )
+
+
+def _fetch_history(service, start_history_id: int, http=None, quota=None) -> HistoryChanges:
+    """逐頁讀取 history.list，合併成最終的變更集合"""
+    added: dict[str, None] = {}  # 用 dict 保留順序
+    deleted: set[str] = set()
+    label_updates: dict[str, list[str]] = {}
+    history_id = start_history_id
+    page_token = None
+
+    while True:
+        _charge(quota, "history.list")
+        response = (
+            service.users()
+            .history()
+            .list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
+                pageToken=page_token,
             )
-            for record in history.get("history", []):
-                for msg in record.get("messagesAdded", []):
-                    messages.append({"id": msg["message"]["id"]})
-        except HttpError as e:
-            if e.resp.status == 404:
-                # history_id 過期，退回全量同步
-                pass
-            else:
-                raise
-    else:
-        # 首次全量同步
+            .execute(http=http)
+        )
+
+        for record in response.get("history", []):
+            for item in record.get("messagesAdded", []):
+                msg = item["message"]
+                # 草稿每次存檔都會產生 messageAdded，不需要同步
+                if "DRAFT" in msg.get("labelIds", []):
+                    continue
+                added[msg["id"]] = None
+                deleted.discard(msg["id"])
+            for item in record.get("messagesDeleted", []):
+                msg_id = item["message"]["id"]
+                added.pop(msg_id, None)
+                label_updates.pop(msg_id, None)
+                deleted.add(msg_id)
+            for key in ("labelsAdded", "labelsRemoved"):
+                for item in record.get(key, []):
+                    msg = item["message"]
+                    # record 內的 message.labelIds 是變更後的完整標籤
+                    if msg["id"] not in deleted:
+                        label_updates[msg["id"]] = msg.get("labelIds", [])
+
+        # 回應本身帶有目前的 historyId，不需要另外呼叫 getProfile
+        if response.get("historyId"):
+            history_id = int(response["historyId"])
+
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+    # 新信件會抓完整內容（含最新標籤），不需要另外套用標籤變更
+    for msg_id in added:
+        label_updates.pop(msg_id, None)
+
+    return HistoryChanges(
+        added=list(added),
+        deleted=list(deleted),
+        label_updates=label_updates,
+        history_id=history_id,
+    )
+
+
+def full_sync(service, max_results: int = 50, http=None, quota=None) -> HistoryChanges:
+    """全量同步：逐頁列出收件匣最近 max_results 封信"""
+    # 先取得 history_id，列表期間進來的新信會在下次增量同步補上
+    history_id = get_latest_history_id(service, http=http, quota=quota)
+
+    ids: list[str] = []
+    page_token = None
+    while len(ids) < max_results:
+        _charge(quota, "messages.list")
         result = (
             service.users()
             .messages()
-            .list(userId="me", maxResults=max_results, q="in:inbox")
-            .execute()
+            .list(
+                userId="me",
+                maxResults=min(max_results - len(ids), 500),
+                q="in:inbox",
+                pageToken=page_token,
+            )
+            .execute(http=http)
+        )
+        ids.extend(m["id"] for m in result.get("messages", []))
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            break
+
+    return HistoryChanges(added=ids, history_id=history_id, full_resync=True)
+
+
+def list_messages_page(
+    service,
+    page_token: str | None = None,
+    page_size: int = 100,
+    query: str = "",
+    http=None,
+    quota=None,
+) -> tuple[list[str], str | None]:
+    """列出一頁信件 id（messages.list，由新到舊），回傳 (ids, nextPageToken)"""
+    _charge(quota, "messages.list")
+    result = (
+        service.users()
+        .messages()
+        .list(
+            userId="me",
+            maxResults=min(page_size, 500),
+            q=query or None,
+            pageToken=page_token,
+        )
+        .execute(http=http)
+    )
+    return [m["id"] for m in result.get("messages", [])], result.get("nextPageToken")
+
+
+def get_message_detail(
+    service, message_id: str, format: str = "full", http=None, quota=None
+) -> dict:
+    """取得信件內容（format="metadata" 只取標頭，不含內文）"""
+    _charge(quota, "messages.get")
+    msg = _message_get_request(service, message_id, format).execute(http=http)
+    return _parse_message(msg)
+
+
+def _message_get_request(service, message_id: str, format: str):
+    """建立 messages.get 請求；metadata 模式用 fields= partial response 只取必要欄位"""
+    if format == "metadata":
+        return service.users().messages().get(
+            userId="me",
+            id=message_id,
+            format="metadata",
+            metadataHeaders=METADATA_HEADERS,
+            fields=METADATA_FIELDS,
         )
-        messages = result.get("messages", [])
+    return service.users().messages().get(userId="me", id=message_id, format="full")
+
+
+def get_message_details_batch(
+    service,
+    message_ids: list[str],
+    batch_size: int | None = None,
+    max_retries: int = 3,
+    format: str = "full",
+    http=None,
+    quota=None,
+) -> tuple[list[dict], list[str]]:
+    """
+    透過 Gmail batch endpoint 批次取得信件內容（每批最多 100 個子請求）
+    format="metadata" 時只取標頭（不含內文），用於同步時建立信件列
 
-    return messages
+    部分失敗時只重試失敗的子請求（429 / 5xx / rateLimitExceeded），
+    404 等不可重試的錯誤直接放棄。每個子請求都向配額 limiter 扣除 messages.get 的 units，
+    出現 rate limit 時通知 limiter 退避。
 
+    Returns:
+        (成功解析的信件清單, 最終仍失敗的 message id 清單)
+    """
+    batch_size = min(batch_size or settings.gmail_batch_size, BATCH_MAX_SIZE)
+    details: dict[str, dict] = {}
+    failed: list[str] = []
+    pending = list(dict.fromkeys(message_ids))  # 去重並保留順序
+
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            # 指數退避，避免同一批次立刻再撞 rate limit
+            _time.sleep(min(2 ** attempt, 16))
+
+        retry: list[str] = []
+        rate_limited = False
+
+        def callback(request_id, response, exception):
+            nonlocal rate_limited
+            if exception is None:
+                try:
+                    details[request_id] = _parse_message(response)
+                except Exception:
+                    logger.error(f"解析信件 {request_id} 失敗", exc_info=True)
+                    failed.append(request_id)
+            elif _is_retryable(exception):
+                rate_limited = rate_limited or is_rate_limit_error(exception)
+                retry.append(request_id)
+            else:
+                logger.warning(f"取得信件 {request_id} 失敗（不重試）: {exception}")
+                failed.append(request_id)
+
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in chunk:
+                batch.add(
+                    _message_get_request(service, message_id, format),
+                    request_id=message_id,
+                )
+            _charge(quota, "messages.get", len(chunk))
+            try:
+                batch.execute(http=http)
+            except HttpError as e:
+                # 整個 batch 請求失敗（非單一子請求）
+                if not _is_retryable(e):
+                    raise
+                rate_limited = rate_limited or is_rate_limit_error(e)
+                retry.extend(mid for mid in chunk if mid not in details and mid not in retry)
+
+            if rate_limited and quota is not None:
+                # 剩下的 chunk 與重試都會等到退避結束
+                quota.backoff()
+                rate_limited = False
+
+        pending = retry
+
+    if pending:
+        logger.warning(f"{len(pending)} 封信件重試 {max_retries} 次後仍失敗")
+        failed.extend(pending)
+
+    ordered = [details[mid] for mid in message_ids if mid in details]
+    return ordered, failed
+
+
+def _is_retryable(error: Exception) -> bool:
+    """判斷 Gmail API 錯誤是否可重試"""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status in _RETRYABLE_STATUS:
+        return True
+    # Gmail 的 per-user rate limit 以 403 回傳（rateLimitExceeded / userRateLimitExceeded）
+    return is_rate_limit_error(error)
 
-def get_message_detail(service, message_id: str) -> dict:
-    """取得信件完整內容"""
-    msg = service.users().messages().get(
-        userId="me",
-        id=message_id,
-        format="full"
-    ).execute()
 
-    headers = {h["name"].lower(): h["value"] for h in msg["payload"].get("headers", [])}
+def is_auth_error(error: Exception) -> bool:
+    """Token 失效 / 授權被撤銷（需要用戶重新授權）"""
+    from google.auth.exceptions import RefreshError
+
+    if isinstance(error, RefreshError):
+        return True
+    return isinstance(error, HttpError) and error.resp.status == 401
+
+
+def is_invalid_page_token(error: Exception) -> bool:
+    """pageToken 已失效（回填需從頭重新列出）"""
+    return (
+        isinstance(error, HttpError)
+        and error.resp.status == 400
+        and "pageToken" in str(error.content)
+    )
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """短期 rate limit（429 / rateLimitExceeded），退避後可重試；不含每日配額用盡"""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    content = str(error.content)
+    return error.resp.status == 403 and (
+        "rateLimitExceeded" in content or "userRateLimitExceeded" in content
+    )
 
-    body_plain, body_html = _extract_body(msg["payload"])
+
+def is_quota_error(error: Exception) -> bool:
+    """Gmail 配額或 rate limit 錯誤"""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    content = str(error.content)
+    return error.resp.status == 403 and any(
+        reason in content
+        for reason in ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+    )
+
+
+def _parse_message(msg: dict) -> dict:
+    """將 Gmail message resource 轉為 EmailMessage 欄位"""
+    payload = msg.get("payload", {})
+    headers = {h["name"].lower(): h["value"] for h in payload.get("headers", [])}
+
+    # metadata 模式沒有 parts / body：內文留空，待需要時再下載
+    has_body = "parts" in payload or "body" in payload
+    if has_body:
+        body_plain, body_html = _extract_body(payload)
+        has_attachments = _has_attachments(payload)
+        analysis_text = content_normalizer.normalize(body_plain, body_html)
+    else:
+        body_plain, body_html, analysis_text = None, None, None
+        has_attachments = payload.get("mimeType", "") == "multipart/mixed"
 
     return {
         "provider_message_id": msg["id"],
@@ -198,8 +516,11 @@ def get_message_detail(service, message_id: str) -> dict:
         "in_reply_to": headers.get("in-reply-to"),
         "body_plain": body_plain,
         "body_html": body_html,
+        "analysis_text": analysis_text,
         "snippet": msg.get("snippet", "")[:300],
-        "has_attachments": _has_attachments(msg["payload"]),
+        "has_attachments": has_attachments,
+        "is_list_mail": content_normalizer.is_list_mail(headers),
+        "body_fetched_at": datetime.utcnow() if has_body else None,
         "labels": msg.get("labelIds", []),
         "is_read": "UNREAD" not in msg.get("labelIds", []),
         "is_starred": "STARRED" in msg.get("labelIds", []),
@@ -207,9 +528,38 @@ def get_message_detail(service, message_id: str) -> dict:
     }
 
 
-def get_latest_history_id(service) -> int:
+def watch(
+    service, topic_name: str, label_ids: list[str] | None = None, http=None, quota=None
+) -> dict:
+    """
+    註冊 Gmail push 通知（users.watch），有變更時 Gmail 會發到 Pub/Sub topic
+
+    Returns:
+        {"history_id": int, "expires_at": datetime}（watch 最長 7 天，需定期續約）
+    """
+    _charge(quota, "watch")
+    response = (
+        service.users()
+        .watch(
+            userId="me",
+            body={
+                "topicName": topic_name,
+                "labelIds": label_ids or ["INBOX"],
+                "labelFilterBehavior": "include",
+            },
+        )
+        .execute(http=http)
+    )
+    return {
+        "history_id": int(response.get("historyId", 0)),
+        "expires_at": datetime.utcfromtimestamp(int(response["expiration"]) / 1000),
+    }
+
+
+def get_latest_history_id(service, http=None, quota=None) -> int:
     """取得最新的 history_id，用於下次增量同步"""
-    profile = service.users().getProfile(userId="me").execute()
+    _charge(quota, "getProfile")
+    profile = service.users().getProfile(userId="me").execute(http=http)
     return int(profile.get("historyId", 0))
 
 
@@ -0,0 +1,505 @@
+"""
+IMAP 同步服務（imapclient + mail-parser）
+
+增量同步策略：
+  - UIDVALIDITY 不變時只 FETCH `last_uidnext:*` 的新 UID；改變時做有上限的全量同步
+  - 伺服器支援 CONDSTORE 時用 `FETCH ... (FLAGS) (CHANGEDSINCE modseq)` 取得
+    旗標變更，不需要重抓信件內容
+  - 刪除偵測：支援 QRESYNC 時 FETCH 加上 VANISHED modifier，直接取得被刪除的 UID；
+    不支援時用 `UID SEARCH ALL` 的結果和 DB 中已存的 UID 比對
+  - 新信件分批 FETCH（每個 FETCH 命令帶多個 UID），不逐封 round trip
+  - 已驗證的連線保留在 pool 中跨同步週期重用，閒置過久才關閉
+  - 可選的 IDLE 監聽：收到 EXISTS 時立即觸發同步
+
+imapclient 是同步 I/O，所有操作都在專用的有上限 thread pool 執行。
+IMAP 旗標會轉成和 Gmail 相同的標籤語意（無 \\Seen → UNREAD，\\Flagged → STARRED），
+讓 is_read / is_starred / Topic 標籤規則在不同 provider 之間一致。
+"""
+import asyncio
+import ipaddress
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import mailparser
+from imapclient import IMAPClient, imap4, tls
+from imapclient.exceptions import LoginError
+
+from app.core.config import get_settings
+from app.services import content_normalizer, token_manager
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.imap_max_workers,
+    thread_name_prefix="imap",
+)
+
+
+@dataclass
+class ImapChanges:
+    """一次 IMAP 同步取得的變更"""
+    new_uids: list[int] = field(default_factory=list)
+    label_updates: dict[str, list[str]] = field(default_factory=dict)  # provider id → labels
+    uidvalidity: int | None = None
+    uidnext: int | None = None
+    highest_modseq: int | None = None
+    full_resync: bool = False
+    vanished: list[tuple[int, int]] = field(default_factory=list)  # QRESYNC：被刪除的 UID 區間
+    present_uids: set[int] | None = None  # 無 QRESYNC：伺服器上目前全部的 UID
+
+
+@dataclass
+class _PooledConnection:
+    client: IMAPClient
+    password_hash: int
+    lock: threading.Lock
+    last_used: float
+    capabilities: frozenset
+
+
+_pool: dict = {}
+_pool_lock = threading.Lock()
+
+# IDLE thread 檢查停止訊號的間隔（秒）
+_IDLE_CHECK_SECONDS = 30
+
+
+def provider_message_id(folder: str, uidvalidity: int, uid: int) -> str:
+    """IMAP 信件在 DB 中的 provider_message_id（UID 只在同一 UIDVALIDITY 下唯一）"""
+    return f"{folder}:{uidvalidity}:{uid}"
+
+
+def flags_to_labels(flags) -> list[str]:
+    """IMAP 旗標 → Gmail 語意的標籤"""
+    names = [f.decode() if isinstance(f, bytes) else str(f) for f in flags]
+    labels = [n for n in names if n not in ("\\Seen", "\\Flagged", "\\Recent")]
+    if "\\Seen" not in names:
+        labels.append("UNREAD")
+    if "\\Flagged" in names:
+        labels.append("STARRED")
+    return labels
+
+
+def _parse_uid_ranges(text: str) -> list[tuple[int, int]]:
+    """解析 IMAP sequence set（如 `41,43:116`）為 (start, end) 區間"""
+    ranges = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition(":")
+        start, end = int(start), int(end or start)
+        ranges.append((min(start, end), max(start, end)))
+    return ranges
+
+
+def _pop_vanished(client: IMAPClient) -> list[tuple[int, int]]:
+    """
+    取出 FETCH 期間收到的 `* VANISHED [(EARLIER)] uid-set` 回應
+
+    imapclient 沒有解析 VANISHED，這些 untagged 回應留在 imaplib 的 untagged_responses 中
+    （SELECT 時會清空，因此只會有這次同步期間的回應）。
+    """
+    ranges = []
+    for data in client._imap.untagged_responses.pop("VANISHED", []):
+        text = data.decode() if isinstance(data, bytes) else str(data)
+        if text.upper().startswith("(EARLIER)"):
+            text = text[len("(EARLIER)"):]
+        ranges.extend(_parse_uid_ranges(text))
+    return ranges
+
+
+def deleted_uids(changes: ImapChanges, known_uids) -> list[int]:
+    """DB 中已存的 UID 裡，已從伺服器刪除的部分"""
+    if changes.present_uids is not None:
+        return sorted(uid for uid in known_uids if uid not in changes.present_uids)
+    return sorted(
+        uid for uid in known_uids
+        if any(start <= uid <= end for start, end in changes.vanished)
+    )
+
+
+def check_host(host: str, port: int) -> str:
+    """
+    確認用戶提供的 IMAP 主機可以連線，回傳之後要連線的位址（不合規定時拋出 ValueError）
+
+    主機由用戶輸入，伺服器會主動連過去：只允許 imap_allowed_ports 的 port，
+    且主機的所有解析結果都必須是公開位址（imap_allowed_hosts 內的主機除外），
+    避免被用來探測內網服務或雲端 metadata endpoint。
+    """
+    if port not in settings.imap_allowed_ports:
+        raise ValueError(f"IMAP port {port} 不在允許清單內")
+    if host.lower().rstrip(".") in {h.lower() for h in settings.imap_allowed_hosts}:
+        return host
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as e:
+        raise ValueError(f"無法解析 IMAP 主機 {host}") from e
+    if not infos:
+        raise ValueError(f"無法解析 IMAP 主機 {host}")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"IMAP 主機 {host} 解析到非公開位址 {address}")
+    return infos[0][4][0]
+
+
+class _PinnedIMAP4(imap4.IMAP4WithTimeout):
+    def __init__(self, address: str, host: str, port: int, timeout: float | None) -> None:
+        self._address = address
+        super().__init__(host, port, timeout)
+
+    def _create_socket(self, timeout: float | None = None) -> socket.socket:
+        return socket.create_connection(
+            (self._address, self.port), timeout if timeout is not None else self._timeout
+        )
+
+
+class _PinnedIMAP4TLS(tls.IMAP4_TLS):
+    def __init__(self, address: str, host: str, port: int, ssl_context, timeout) -> None:
+        self._address = address
+        super().__init__(host, port, ssl_context, timeout)
+
+    def _create_socket(self, timeout: float | None = None) -> socket.socket:
+        sock = socket.create_connection(
+            (self._address, self.port), timeout if timeout is not None else self._timeout
+        )
+        # SNI 與憑證驗證仍使用原本的主機名稱
+        return tls.wrap_socket(sock, self.ssl_context, self.host)
+
+
+class _PinnedIMAPClient(IMAPClient):
+    """
+    連到 check_host 驗證過的位址，不讓 imaplib 再解析一次主機名稱
+
+    兩次解析之間 DNS 可能被改指向內網（DNS rebinding），因此只連線已檢查過的 IP；
+    self.host 保留原本的主機名稱，供 TLS 使用。
+    """
+
+    def __init__(self, address: str, host: str, **kwargs):
+        self._address = address
+        super().__init__(host, **kwargs)
+
+    def _create_IMAP4(self):  # noqa: N802
+        connect_timeout = getattr(self._timeout, "connect", None)
+        if self.ssl:
+            return _PinnedIMAP4TLS(
+                self._address, self.host, self.port, self.ssl_context, connect_timeout
+            )
+        return _PinnedIMAP4(self._address, self.host, self.port, connect_timeout)
+
+
+def _connect(
+    host: str, port: int, use_ssl: bool, username: str, password: str
+) -> tuple[IMAPClient, frozenset]:
+    # 每次建立連線都重新檢查，DNS 改指向內網時不會沿用舊的檢查結果
+    address = check_host(host, port)
+    client = _PinnedIMAPClient(
+        address, host, port=port, ssl=use_ssl, timeout=settings.imap_timeout
+    )
+    client.login(username, password)
+    capabilities = frozenset(c.decode().upper() for c in client.capabilities())
+    if "QRESYNC" in capabilities:
+        client.enable("QRESYNC")
+    elif "CONDSTORE" in capabilities:
+        client.enable("CONDSTORE")
+    return client, capabilities
+
+
+def _checkout(
+    account_id, host: str, port: int, use_ssl: bool, username: str, password: str
+) -> _PooledConnection:
+    """從 pool 取得已登入的連線（失效或密碼變更時重建）"""
+    with _pool_lock:
+        conn = _pool.get(account_id)
+    if conn and conn.password_hash == hash(password):
+        try:
+            with conn.lock:
+                conn.client.noop()
+            conn.last_used = time.monotonic()
+            return conn
+        except Exception:
+            logger.info(f"IMAP 連線已失效，重新連線（account={account_id}）")
+            _discard(account_id)
+
+    client, capabilities = _connect(host, port, use_ssl, username, password)
+    conn = _PooledConnection(
+        client=client,
+        password_hash=hash(password),
+        lock=threading.Lock(),
+        last_used=time.monotonic(),
+        capabilities=capabilities,
+    )
+    with _pool_lock:
+        _pool[account_id] = conn
+    return conn
+
+
+def _discard(account_id) -> None:
+    with _pool_lock:
+        conn = _pool.pop(account_id, None)
+    if conn:
+        try:
+            conn.client.logout()
+        except Exception:
+            pass
+
+
+def is_auth_error(error: Exception) -> bool:
+    """帳密錯誤（需要用戶重新設定，重試無效）"""
+    return isinstance(error, LoginError)
+
+
+def close_idle_connections() -> int:
+    """關閉閒置超過 imap_pool_idle_seconds 的連線，回傳關閉數"""
+    now = time.monotonic()
+    with _pool_lock:
+        stale = [
+            aid for aid, c in _pool.items()
+            if now - c.last_used > settings.imap_pool_idle_seconds
+        ]
+    for account_id in stale:
+        _discard(account_id)
+    return len(stale)
+
+
+def _fetch_changes(
+    conn: _PooledConnection,
+    folder: str,
+    last_uidvalidity: int | None,
+    last_uidnext: int | None,
+    last_modseq: int | None,
+    max_results: int,
+) -> ImapChanges:
+    client = conn.client
+    status = client.select_folder(folder, readonly=True)
+    uidvalidity = int(status[b"UIDVALIDITY"])
+    uidnext = int(status.get(b"UIDNEXT", 0)) or None
+    highest_modseq = status.get(b"HIGHESTMODSEQ")
+    highest_modseq = int(highest_modseq) if highest_modseq is not None else None
+
+    changes = ImapChanges(uidvalidity=uidvalidity, uidnext=uidnext, highest_modseq=highest_modseq)
+
+    if last_uidvalidity != uidvalidity or not last_uidnext:
+        # 首次同步或 UIDVALIDITY 改變（舊 UID 全部失效）：取最新的 max_results 封
+        uids = sorted(client.search("ALL"))
+        changes.new_uids = uids[-max_results:]
+        changes.full_resync = True
+        return changes
+
+    qresync = "QRESYNC" in conn.capabilities
+    if qresync:
+        # 只取 last_uidnext 之後的新 UID（`n:*` 在沒有新信時仍會回傳最後一封，需要過濾）
+        changes.new_uids = sorted(
+            uid for uid in client.search(["UID", f"{last_uidnext}:*"]) if uid >= last_uidnext
+        )
+    else:
+        # 沒有 QRESYNC 就收不到 VANISHED：取全部 UID，呼叫端和 DB 比對找出被刪除的信件
+        changes.present_uids = set(client.search("ALL"))
+        changes.new_uids = sorted(uid for uid in changes.present_uids if uid >= last_uidnext)
+
+    # CONDSTORE：只取 modseq 之後有變更的旗標，不重抓內容；
+    # QRESYNC 下刪除信件也會推進 modseq，加上 VANISHED 一併取得被刪除的 UID
+    if (
+        last_modseq
+        and highest_modseq
+        and highest_modseq > last_modseq
+        and ({"CONDSTORE", "QRESYNC"} & conn.capabilities)
+    ):
+        modifiers = [f"CHANGEDSINCE {last_modseq}"]
+        if qresync:
+            modifiers.append("VANISHED")
+        response = client.fetch(f"1:{last_uidnext - 1}", ["FLAGS"], modifiers=modifiers)
+        for uid, data in response.items():
+            changes.label_updates[provider_message_id(folder, uidvalidity, uid)] = flags_to_labels(
+                data.get(b"FLAGS", ())
+            )
+        if qresync:
+            changes.vanished = _pop_vanished(client)
+
+    return changes
+
+
+def _fetch_messages(
+    conn: _PooledConnection, folder: str, uidvalidity: int, uids: list[int]
+) -> list[dict]:
+    """分批 FETCH 新信件並解析（每個 FETCH 命令帶 imap_fetch_chunk 個 UID）"""
+    client = conn.client
+    details = []
+    for i in range(0, len(uids), settings.imap_fetch_chunk):
+        chunk = uids[i:i + settings.imap_fetch_chunk]
+        response = client.fetch(chunk, ["BODY.PEEK[]", "FLAGS"])
+        for uid in chunk:
+            data = response.get(uid)
+            if not data or b"BODY[]" not in data:
+                continue
+            try:
+                details.append(
+                    _parse_message(
+                        provider_message_id(folder, uidvalidity, uid),
+                        data[b"BODY[]"],
+                        data.get(b"FLAGS", ()),
+                    )
+                )
+            except Exception:
+                logger.error(f"解析 IMAP 信件 UID {uid} 失敗", exc_info=True)
+    return details
+
+
+def _parse_message(provider_id: str, raw: bytes, flags) -> dict:
+    """將原始 RFC 822 信件轉為 EmailMessage 欄位"""
+    parsed = mailparser.parse_from_bytes(raw)
+    labels = flags_to_labels(flags)
+    headers = {k.lower(): v for k, v in parsed.headers.items()}
+
+    sender_name, sender = ("", "")
+    if parsed.from_:
+        sender_name, sender = parsed.from_[0]
+
+    references = (headers.get("references") or "").split()
+    message_id = headers.get("message-id")
+    body_plain = "\n".join(parsed.text_plain)
+    body_html = "\n".join(parsed.text_html)
+    analysis_text = content_normalizer.normalize(body_plain, body_html)
+
+    return {
+        "provider_message_id": provider_id,
+        "thread_id": references[0] if references else message_id,
+        "subject": parsed.subject or "(無主旨)",
+        "sender": f"{sender_name} <{sender}>" if sender_name else sender,
+        "recipients": [addr for _, addr in parsed.to],
+        "cc": [addr for _, addr in parsed.cc],
+        "in_reply_to": headers.get("in-reply-to"),
+        "body_plain": body_plain,
+        "body_html": body_html,
+        "analysis_text": analysis_text,
+        "snippet": " ".join((body_plain or analysis_text).split())[:300],
+        "has_attachments": bool(parsed.attachments),
+        "is_list_mail": content_normalizer.is_list_mail(headers),
+        "labels": labels,
+        "is_read": "UNREAD" not in labels,
+        "is_starred": "STARRED" in labels,
+        "received_at": parsed.date.replace(tzinfo=None) if parsed.date else None,
+        "body_fetched_at": datetime.utcnow(),
+    }
+
+
+class AsyncImapClient:
+    """單一 IMAP 帳號的非同步介面（pool 連線 + thread pool）"""
+
+    def __init__(self, account):
+        self.account_id = account.id
+        self.host = account.imap_host
+        self.use_ssl = account.imap_use_ssl
+        self.port = account.imap_port or (993 if self.use_ssl else 143)
+        self.username = account.email_address
+        self.password = token_manager.decrypt(account.encrypted_access_token)
+        self.folder = settings.imap_folder
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+
+        def call():
+            conn = _checkout(
+                self.account_id, self.host, self.port, self.use_ssl, self.username, self.password
+            )
+            try:
+                with conn.lock:
+                    return fn(conn, *args)
+            except Exception:
+                # 連線狀態不明，丟棄避免下次重用
+                _discard(self.account_id)
+                raise
+
+        return await loop.run_in_executor(_executor, call)
+
+    async def fetch_changes(
+        self,
+        last_uidvalidity: int | None,
+        last_uidnext: int | None,
+        last_modseq: int | None,
+        max_results: int = 50,
+    ) -> ImapChanges:
+        return await self._run(
+            _fetch_changes, self.folder, last_uidvalidity, last_uidnext, last_modseq, max_results
+        )
+
+    async def fetch_messages(self, uidvalidity: int, uids: list[int]) -> list[dict]:
+        if not uids:
+            return []
+        return await self._run(_fetch_messages, self.folder, uidvalidity, uids)
+
+
+def verify_login(host: str, port: int, use_ssl: bool, username: str, password: str) -> None:
+    """驗證 IMAP 帳密（失敗時拋出例外）"""
+    client, _ = _connect(host, port, use_ssl, username, password)
+    client.logout()
+
+
+def _idle_loop(
+    account_id, host, port, use_ssl, username, password, folder, on_new_mail,
+    stop: threading.Event,
+):
+    """在專用連線上持續 IDLE；收到 EXISTS 時呼叫 on_new_mail()"""
+    while not stop.is_set():
+        try:
+            client, _ = _connect(host, port, use_ssl, username, password)
+            client.select_folder(folder, readonly=True)
+            try:
+                client.idle()
+                started = time.monotonic()
+                # RFC 2177：最長 29 分鐘需要重新 IDLE
+                while not stop.is_set() and time.monotonic() - started < settings.imap_idle_timeout:
+                    responses = client.idle_check(timeout=_IDLE_CHECK_SECONDS)
+                    if any(len(r) > 1 and r[1] == b"EXISTS" for r in responses):
+                        on_new_mail()
+                client.idle_done()
+            finally:
+                client.logout()
+        except Exception:
+            logger.warning(f"IMAP IDLE 中斷（account={account_id}），30 秒後重連", exc_info=True)
+            stop.wait(30)
+
+
+async def idle_watch(account, on_new_mail, stop_event: asyncio.Event) -> None:
+    """
+    為單一帳號維持 IDLE 監聽（專用連線，不佔用同步用的 pool 連線）
+
+    on_new_mail 是 coroutine function，會在 event loop 上執行。
+    """
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+
+    def notify():
+        asyncio.run_coroutine_threadsafe(on_new_mail(), loop)
+
+    password = token_manager.decrypt(account.encrypted_access_token)
+    thread = threading.Thread(
+        target=_idle_loop,
+        args=(
+            account.id,
+            account.imap_host,
+            account.imap_port or (993 if account.imap_use_ssl else 143),
+            account.imap_use_ssl,
+            account.email_address,
+            password,
+            settings.imap_folder,
+            notify,
+            stop,
+        ),
+        name=f"imap-idle-{account.id}",
+        daemon=True,
+    )
+    thread.start()
+    try:
+        await stop_event.wait()
+    finally:
+        stop.set()
+        # 等 thread 結束（最多一個 idle_check 週期），確保 IDLE 連線已登出
+        await loop.run_in_executor(None, thread.join)
@@ -0,0 +1,94 @@
+"""
+增量 JSON 解析（LLM streaming 輸出）
+
+LLM 以 response_format=json_object 串流回傳一個 JSON 物件，文字是一段一段到達的。
+JsonObjectStream 只追蹤頂層物件的括號深度與字串狀態：
+  - 頂層欄位的值一結束（遇到頂層的 , 或 }）就解析並回傳 (欄位, 值)
+  - 字串欄位尚未結束時，partial() 可取得目前已收到的文字（用於逐字顯示摘要）
+物件前的雜訊（例如 ```json）會被略過；無法解析的欄位直接捨棄，由呼叫端檢查最終結果。
+"""
+import json
+
+
+class JsonObjectStream:
+    def __init__(self):
+        self.result: dict = {}
+        self.done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member: list[str] = []  # 目前頂層欄位的原始文字（"key": value）
+        self._colon_at: int | None = None
+        self._value_start: int | None = None  # 字串值第一個字元的位置
+
+    def feed(self, text: str) -> list[tuple[str, object]]:
+        """餵入一段文字，回傳這段文字中完成的頂層欄位"""
+        fields: list[tuple[str, object]] = []
+        for ch in text:
+            if self.done:
+                break
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                self._member.append(ch)
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if self._depth == 1 and self._colon_at is not None and self._value_start is None:
+                    self._value_start = len(self._member) + 1
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    fields.extend(self._flush())
+                    self.done = True
+                    continue
+            elif ch == ":" and self._depth == 1 and self._colon_at is None:
+                self._colon_at = len(self._member)
+            elif ch == "," and self._depth == 1:
+                fields.extend(self._flush())
+                continue
+            self._member.append(ch)
+        return fields
+
+    def partial(self) -> tuple[str, str] | None:
+        """頂層字串欄位尚未結束時，回傳 (欄位, 目前已收到的文字)"""
+        if not (self._in_string and self._depth == 1 and self._value_start is not None):
+            return None
+        try:
+            key = json.loads("".join(self._member[:self._colon_at]).strip())
+        except ValueError:
+            return None
+        raw = "".join(self._member[self._value_start:])
+        # 結尾可能是不完整的跳脫序列（\ 或 \u00），逐步去掉再解碼
+        for cut in range(0, 7):
+            try:
+                return key, json.loads(f'"{raw[:len(raw) - cut]}"')
+            except ValueError:
+                continue
+        return None
+
+    def _flush(self) -> list[tuple[str, object]]:
+        text = "".join(self._member).strip()
+        self._member = []
+        self._colon_at = None
+        self._value_start = None
+        if not text:
+            return []
+        try:
+            parsed = json.loads("{" + text + "}")
+        except ValueError:
+            return []
+        self.result.update(parsed)
+        return list(parsed.items())
@@ -0,0 +1,201 @@
+"""
+LLM 分析結果快取
+
+同一份電子報 / 通知常寄給很多用戶與帳號，內容相同時直接重用分析結果：
+  - key = sha256(正規化內容 + 風格 + 模型 + 語言 + prompt 版本)
+  - Redis 為主：TTL 到期自動失效；以 sorted set 記錄最近使用時間，
+    超過 llm_cache_max_entries 時淘汰最久未使用的（LRU）
+  - Postgres llm_cache_entries 為備援：Redis 淘汰 / 重啟 / 無法連線時仍可命中，
+    命中後回填 Redis；過期與超過 llm_cache_db_max_entries 的列由 Worker 定期清理
+  - 命中 / 未命中次數記在 Redis，GET /metrics 回報跨 process 的命中率
+"""
+import hashlib
+import json
+import logging
+import re
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.redis import get_redis
+from app.models.analysis import LLMCacheEntry
+from app.services.llm_service import PROMPT_VERSION, LLMService, token_budget
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_ENTRY_KEY = "mailcake:llm_cache:{key}"
+_LRU_KEY = "mailcake:llm_cache:lru"
+_STATS_KEY = "mailcake:llm_cache:stats"
+
+# 快取的欄位；tokens_used / generation_ms 是單次呼叫的成本，不快取
+_RESULT_FIELDS = (
+    "summary", "urgency_score", "importance_score", "action_required",
+    "category", "sentiment", "reply_suggestions", "model_used",
+)
+
+
+def cache_key(content: str, style: str, model: str, language: str) -> str:
+    """內容只差在空白時視為相同；token 預算也納入 key（分段方式改變後不誤用舊結果）"""
+    normalized = re.sub(r"\s+", " ", content).strip()
+    payload = json.dumps(
+        [normalized, style, model, language, PROMPT_VERSION, token_budget(model)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+async def _record(outcome: str) -> None:
+    try:
+        await get_redis().hincrby(_STATS_KEY, outcome, 1)
+    except Exception:
+        pass
+
+
+async def _store_redis(key: str, data: dict, ttl_seconds: int) -> None:
+    """寫入 Redis 並更新 LRU；超過上限時淘汰最久未使用的項目"""
+    if ttl_seconds <= 0:
+        return
+    redis = get_redis()
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(
+                _ENTRY_KEY.format(key=key), json.dumps(data, ensure_ascii=False), ex=ttl_seconds
+            )
+            pipe.zadd(_LRU_KEY, {key: time.time()})
+            pipe.zcard(_LRU_KEY)
+            _, _, size = await pipe.execute()
+
+        overflow = size - settings.llm_cache_max_entries
+        if overflow > 0:
+            evicted = await redis.zpopmin(_LRU_KEY, overflow)
+            if evicted:
+                await redis.delete(*(_ENTRY_KEY.format(key=k) for k, _ in evicted))
+                metrics.incr("llm_cache.evicted", len(evicted))
+    except Exception:
+        logger.warning("寫入 LLM 快取（Redis）失敗", exc_info=True)
+
+
+async def get(db: AsyncSession, key: str) -> dict | None:
+    """查詢快取：Redis → Postgres；Postgres 命中時回填 Redis（hit_count 由呼叫端 commit）"""
+    if not settings.llm_cache_enabled:
+        return None
+
+    redis = get_redis()
+    try:
+        raw = await redis.get(_ENTRY_KEY.format(key=key))
+        if raw is not None:
+            await redis.zadd(_LRU_KEY, {key: time.time()})
+            metrics.incr("llm_cache.hits_redis")
+            await _record("hits")
+            return json.loads(raw)
+    except Exception:
+        logger.warning("讀取 LLM 快取（Redis）失敗，改查 Postgres", exc_info=True)
+
+    now = datetime.utcnow()
+    entry = await db.scalar(
+        select(LLMCacheEntry).where(LLMCacheEntry.cache_key == key, LLMCacheEntry.expires_at > now)
+    )
+    if entry is None:
+        metrics.incr("llm_cache.misses")
+        await _record("misses")
+        return None
+
+    entry.hit_count = (entry.hit_count or 0) + 1
+    entry.last_hit_at = now
+    await _store_redis(key, entry.result, int((entry.expires_at - now).total_seconds()))
+    metrics.incr("llm_cache.hits_db")
+    await _record("hits")
+    return dict(entry.result)
+
+
+async def put(db: AsyncSession, key: str, result: dict) -> None:
+    """寫入快取（Postgres 隨呼叫端的 transaction commit）"""
+    if not settings.llm_cache_enabled:
+        return
+
+    data = {field: result.get(field) for field in _RESULT_FIELDS}
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=settings.llm_cache_ttl_seconds)
+    await db.execute(
+        pg_insert(LLMCacheEntry)
+        .values(
+            cache_key=key, result=data, model=data.get("model_used"), hit_count=0,
+            created_at=now, last_hit_at=now, expires_at=expires_at,
+        )
+        .on_conflict_do_update(
+            index_elements=["cache_key"],
+            set_={"result": data, "last_hit_at": now, "expires_at": expires_at},
+        )
+    )
+    await _store_redis(key, data, settings.llm_cache_ttl_seconds)
+
+
+async def analyze_email(
+    db: AsyncSession,
+    llm: LLMService,
+    content: str,
+    style: str,
+    model: str,
+    language: str,
+) -> dict:
+    """先查快取，未命中才呼叫 LLMService.analyze_email 並寫入快取"""
+    key = cache_key(content, style, model, language)
+    cached = await get(db, key)
+    if cached is not None:
+        # 命中時沒有實際花費 token
+        return {**cached, "tokens_used": 0, "generation_ms": 0, "cached": True}
+
+    result = await llm.analyze_email(content, style=style, model=model, language=language)
+    await put(db, key, result)
+    return result
+
+
+async def prune(db: AsyncSession) -> int:
+    """清理過期列與超過 llm_cache_db_max_entries 的最久未用列，回傳刪除數"""
+    now = datetime.utcnow()
+    expired = await db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.expires_at <= now))
+
+    stale = (
+        select(LLMCacheEntry.cache_key)
+        .order_by(LLMCacheEntry.last_hit_at.desc())
+        .offset(settings.llm_cache_db_max_entries)
+    )
+    overflow = await db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.cache_key.in_(stale)))
+    await db.commit()
+
+    # Redis 項目已由 TTL 過期，順便移除 LRU 裡殘留的 key
+    try:
+        await get_redis().zremrangebyscore(
+            _LRU_KEY, 0, time.time() - settings.llm_cache_ttl_seconds
+        )
+    except Exception:
+        logger.warning("清理 LLM 快取 LRU 失敗", exc_info=True)
+
+    return (expired.rowcount or 0) + (overflow.rowcount or 0)
+
+
+async def stats() -> dict:
+    """跨 process 的命中率與 Redis 項目數（同時更新 gauge；Redis 無法連線時回傳 0）"""
+    redis = get_redis()
+    try:
+        counts = await redis.hgetall(_STATS_KEY)
+        entries = await redis.zcard(_LRU_KEY)
+    except Exception:
+        logger.warning("讀取 LLM 快取統計失敗", exc_info=True)
+        counts, entries = {}, 0
+    hits, misses = int(counts.get("hits", 0)), int(counts.get("misses", 0))
+    result = {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "redis_entries": entries,
+    }
+    for name, value in result.items():
+        metrics.set_gauge(f"llm_cache.{name}", value)
+    return result
@@ -0,0 +1,178 @@
+"""
+LLM 並行控制（每個 process、每個模型各一個 AIMD 上限）
+
+原本每次分析都建立新的 Semaphore(5)：多個呼叫之間沒有共同上限、不分模型，
+LiteLLM 回 429 或延遲飆高時也不會退讓。這裡：
+  - 起始上限由 litellm_config.yaml 各模型的 rpm / tpm 換算（Little's law：
+    並行數 ≈ 每秒請求數 × 預估延遲），乘上 llm_rate_share（API 與 Worker 共用同一組配額）
+  - 成功且延遲正常、且上限已用滿時加法增加（每用滿一輪約 +1）
+  - 收到 429 時乘上 llm_rate_limit_backoff；延遲超過 llm_latency_target_seconds 或逾時時
+    乘上 llm_latency_backoff；同一波失敗在 llm_decrease_cooldown_seconds 內只下調一次
+  - LLMService 的所有呼叫（Worker 分析、API 摘要 / 串流、Topic 摘要）都經過 slot()
+"""
+import asyncio
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+import openai
+import yaml
+
+from app.core import metrics
+from app.core.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+@lru_cache
+def _model_rates() -> dict[str, tuple[int | None, int | None]]:
+    """讀取 litellm_config.yaml 的 {model_name: (rpm, tpm)}；同名多個部署時加總"""
+    try:
+        with open(settings.litellm_config_path, encoding="utf-8") as f:
+            config = yaml.safe_load(f) or {}
+    except OSError:
+        logger.warning(
+            f"找不到 {settings.litellm_config_path}，"
+            f"所有模型使用預設並行數 {settings.llm_concurrency_default}"
+        )
+        return {}
+
+    rates: dict[str, tuple[int | None, int | None]] = {}
+    for entry in config.get("model_list") or []:
+        name = entry.get("model_name")
+        params = entry.get("litellm_params") or {}
+        rpm, tpm = entry.get("rpm", params.get("rpm")), entry.get("tpm", params.get("tpm"))
+        if not name:
+            continue
+        prev_rpm, prev_tpm = rates.get(name, (None, None))
+        rates[name] = (
+            (prev_rpm or 0) + rpm if rpm else prev_rpm,
+            (prev_tpm or 0) + tpm if tpm else prev_tpm,
+        )
+    return rates
+
+
+def initial_limit(model: str) -> int:
+    """由 rpm / tpm 換算起始並行數；都沒設定時使用 llm_concurrency_default"""
+    rpm, tpm = _model_rates().get(model, (None, None))
+    estimates = []
+    if rpm:
+        estimates.append(rpm * settings.llm_rate_share / 60 * settings.llm_expected_latency_seconds)
+    if tpm:
+        tokens_per_minute = tpm * settings.llm_rate_share
+        requests_per_minute = tokens_per_minute / settings.llm_expected_tokens_per_request
+        estimates.append(requests_per_minute / 60 * settings.llm_expected_latency_seconds)
+    limit = math.floor(min(estimates)) if estimates else settings.llm_concurrency_default
+    return max(settings.llm_concurrency_min, min(settings.llm_concurrency_max, limit))
+
+
+class ModelLimiter:
+    """單一模型的 AIMD 並行上限"""
+
+    def __init__(self, model: str, limit: int):
+        self.model = model
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+        self._last_decrease = 0.0
+
+    def _capacity(self) -> int:
+        return max(settings.llm_concurrency_min, int(self.limit))
+
+    async def acquire(self) -> None:
+        started = time.monotonic()
+        async with self._cond:
+            self.waiting += 1
+            try:
+                await self._cond.wait_for(lambda: self.in_flight < self._capacity())
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            metrics.observe(f"llm_limiter.{self.model}.wait_seconds", waited)
+
+    async def release(self) -> None:
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+        metrics.set_gauge(f"llm_limiter.{self.model}.limit", self.limit)
+
+    def on_success(self, latency: float | None) -> None:
+        if latency is not None and latency > settings.llm_latency_target_seconds:
+            self._decrease(settings.llm_latency_backoff, f"延遲 {latency:.1f}s")
+            return
+        # 只在上限用滿時成長，避免低負載期間上限無限制增加
+        if self.in_flight >= self._capacity() and self.limit < settings.llm_concurrency_max:
+            self.limit = min(settings.llm_concurrency_max, self.limit + 1 / self.limit)
+
+    def on_rate_limited(self) -> None:
+        metrics.incr(f"llm_limiter.{self.model}.rate_limited")
+        self._decrease(settings.llm_rate_limit_backoff, "429 rate limit")
+
+    def on_timeout(self) -> None:
+        metrics.incr(f"llm_limiter.{self.model}.timeouts")
+        self._decrease(settings.llm_latency_backoff, "逾時")
+
+    def _decrease(self, factor: float, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < settings.llm_decrease_cooldown_seconds:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self.limit = max(float(settings.llm_concurrency_min), self.limit * factor)
+        metrics.incr(f"llm_limiter.{self.model}.decreases")
+        logger.warning(
+            f"LLM 模型 {self.model} {reason}，並行上限 {previous:.1f} → {self.limit:.1f}"
+        )
+
+
+_limiters: dict[str, ModelLimiter] = {}
+
+
+def limiter_for(model: str) -> ModelLimiter:
+    limiter = _limiters.get(model)
+    if limiter is None:
+        limiter = _limiters[model] = ModelLimiter(model, initial_limit(model))
+        logger.info(f"LLM 模型 {model} 起始並行上限 {limiter.limit:.0f}")
+    return limiter
+
+
+@asynccontextmanager
+async def slot(model: str, measure_latency: bool = True):
+    """
+    取得一個 LLM 呼叫名額，離開時依結果調整上限
+
+    串流呼叫的總時間取決於輸出長度，傳入 measure_latency=False 只以 429 / 逾時調整。
+    """
+    limiter = limiter_for(model)
+    await limiter.acquire()
+    started = time.monotonic()
+    try:
+        yield
+    except openai.RateLimitError:
+        limiter.on_rate_limited()
+        raise
+    except openai.APITimeoutError:
+        limiter.on_timeout()
+        raise
+    else:
+        limiter.on_success(time.monotonic() - started if measure_latency else None)
+    finally:
+        await limiter.release()
+
+
+def stats() -> dict:
+    """各模型目前的並行上限 / 使用中 / 等待中（本 process）"""
+    return {
+        model: {
+            "limit": round(limiter.limit, 2),
+            "in_flight": limiter.in_flight,
+            "waiting": limiter.waiting,
+        }
+        for model, limiter in _limiters.items()
+    }
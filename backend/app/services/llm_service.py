@@ -7,13 +7,21 @@ LLM Service - 透過 LiteLLM Proxy 統一呼叫所有模型
   - Smart Reply 草稿建議
   - 主題分類
 """
+import asyncio
+import hashlib
 import json
+import logging
 import time
 from typing import AsyncGenerator
 from openai import AsyncOpenAI
+from app.core import metrics
 from app.core.config import get_settings
+from app.services import llm_limiter
+from app.services.json_stream import JsonObjectStream
+from app.services.token_counter import count_tokens, split_by_tokens
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
 
 # ─── 摘要風格 Prompts ────────────────────────────────────────────
 STYLE_PROMPTS = {
@@ -49,12 +57,12 @@ MASTER_SYSTEM_PROMPT = """
 你是一個專業的信件分析助理。請分析以下信件並以 JSON 格式回應，包含以下欄位：
 
 {{
-  "summary": "依照指定風格整理的摘要",
   "urgency_score": 1-5（1=不急，5=非常緊急），
   "importance_score": 1-5（1=不重要，5=非常重要），
   "action_required": true/false（是否需要採取行動），
   "category": "工作信件|電子報|帳單財務|會議邀請|促銷廣告|個人通知|其他",
   "sentiment": "positive|neutral|negative",
+  "summary": "依照指定風格整理的摘要",
   "reply_suggestions": ["建議回覆1", "建議回覆2", "建議回覆3"]
 }}
 
@@ -62,11 +70,141 @@ MASTER_SYSTEM_PROMPT = """
 語言：請用{language}語言回應
 
 注意：
+- 請依照上面的欄位順序輸出（評分在前，串流時前端可先顯示分流結果）
+- reply_suggestions 請根據信件內容提供 3 個自然、實用的回覆選項
+- urgency_score 和 importance_score 要基於內容客觀評分
+- 若信件是電子報或廣告，reply_suggestions 可為空陣列
+"""
+
+# ─── 批次分析 Prompt（多封短信件共用一次 system prompt） ─────────
+BATCH_SYSTEM_PROMPT = """
+你是一個專業的信件分析助理。以下有多封彼此無關的信件，每封以 <email id="..."> 標示。
+請逐封分析，並以 JSON 格式回應：
+
+{{
+  "results": [
+    {{
+      "id": "信件的 id（與輸入完全相同）",
+      "summary": "依照指定風格整理的摘要",
+      "urgency_score": 1-5（1=不急，5=非常緊急），
+      "importance_score": 1-5（1=不重要，5=非常重要），
+      "action_required": true/false（是否需要採取行動），
+      "category": "工作信件|電子報|帳單財務|會議邀請|促銷廣告|個人通知|其他",
+      "sentiment": "positive|neutral|negative",
+      "reply_suggestions": ["建議回覆1", "建議回覆2", "建議回覆3"]
+    }}
+  ]
+}}
+
+摘要風格：{style}
+語言：請用{language}語言回應
+
+注意：
+- 每封信件都要有一筆結果，不要合併、遺漏或互相參照
 - reply_suggestions 請根據信件內容提供 3 個自然、實用的回覆選項
 - urgency_score 和 importance_score 要基於內容客觀評分
 - 若信件是電子報或廣告，reply_suggestions 可為空陣列
 """
 
+# ─── 長信件分段 Prompt（map：每段整理重點，再交給 MASTER prompt 合併） ─
+CHUNK_SYSTEM_PROMPT = """
+你是一個專業的信件分析助理。以下是一封長信件的第 {index}/{total} 段（其他段落另外處理）。
+請整理這一段的重點並以 JSON 格式回應：
+
+{{
+  "notes": ["重點1", "重點2"],
+  "urgency_score": 1-5（依這一段的內容），
+  "importance_score": 1-5（依這一段的內容），
+  "action_required": true/false（這一段是否要求收件人採取行動）
+}}
+
+語言：請用{language}語言回應
+
+注意：
+- 保留重要的人名、日期、數字、金額與期限
+- 只整理這一段實際出現的內容，不要推測其他段落
+"""
+
+# prompt 內容的指紋：修改任何 prompt 後，LLM 結果快取（llm_cache）自動失效
+PROMPT_VERSION = hashlib.sha256(
+    (
+        MASTER_SYSTEM_PROMPT
+        + BATCH_SYSTEM_PROMPT
+        + CHUNK_SYSTEM_PROMPT
+        + json.dumps(STYLE_PROMPTS, sort_keys=True, ensure_ascii=False)
+    ).encode()
+).hexdigest()[:12]
+
+
+def token_budget(model: str | None) -> int:
+    """單次分析可送入的內容 token 數（model_token_budgets 可依模型覆寫）"""
+    model = model or settings.default_model
+    return settings.model_token_budgets.get(model, settings.max_tokens_per_email)
+
+
+def _master_prompt(style: str, language: str, topic_skill: str | None = None) -> str:
+    system_prompt = MASTER_SYSTEM_PROMPT.format(
+        style=STYLE_PROMPTS.get(style, STYLE_PROMPTS["bullet_points"]),
+        language=language,
+    )
+    if topic_skill:
+        system_prompt = f"【信件集整理指示】\n{topic_skill}\n\n" + system_prompt
+    return system_prompt
+
+
+def _format_notes(parts: list[tuple[dict, int | None]]) -> str:
+    """把各段整理出的 notes 組成 <part> 區塊（reduce 的輸入）"""
+    sections = []
+    for i, (part, _) in enumerate(parts):
+        notes = part.get("notes", [])
+        if isinstance(notes, str):
+            notes = [notes]
+        if not isinstance(notes, list):
+            notes = []
+        lines = "\n".join(f"- {note}" for note in notes if note)
+        sections.append(f'<part index="{i + 1}">\n{lines}\n</part>')
+    return "\n".join(sections)
+
+
+def _normalize_result(result: dict) -> dict:
+    """正規化 LLM 回傳的欄位型別（就地修改並回傳）"""
+    # ── 正規化 summary 欄位 ──────────────────────────────────────
+    # Claude 有時把 bullet_points 回傳成 JSON array，
+    # 但 summary_text 欄位是 VARCHAR，必須是字串。
+    summary = result.get("summary", "")
+    if isinstance(summary, list):
+        result["summary"] = "\n".join(f"• {item}" for item in summary if item)
+    elif not isinstance(summary, str):
+        result["summary"] = str(summary)
+
+    # ── 正規化 reply_suggestions 欄位 ────────────────────────────
+    # 確保一定是 list[str]，避免 JSON 欄位存入非預期型別
+    suggestions = result.get("reply_suggestions", [])
+    if isinstance(suggestions, str):
+        try:
+            suggestions = json.loads(suggestions)
+        except Exception:
+            suggestions = [suggestions]
+    if not isinstance(suggestions, list):
+        suggestions = []
+    result["reply_suggestions"] = [str(s) for s in suggestions]
+    return result
+
+
+def _is_valid_result(result) -> bool:
+    """批次結果的單筆檢查：要有摘要，評分需是 1-5（順便轉成 int）"""
+    if not isinstance(result, dict) or not result.get("summary"):
+        return False
+    for field in ("urgency_score", "importance_score"):
+        try:
+            score = int(result.get(field))
+        except (TypeError, ValueError):
+            return False
+        if not 1 <= score <= 5:
+            return False
+        result[field] = score
+    return True
+
 
 class LLMService:
     """透過 LiteLLM Proxy 統一呼叫所有模型"""
@@ -78,6 +216,11 @@ class LLMService:
             api_key=settings.litellm_master_key,
         )
 
+    async def chat_completion(self, **kwargs):
+        """chat.completions.create（非串流），經過該模型的並行控制（llm_limiter）"""
+        async with llm_limiter.slot(kwargs["model"]):
+            return await self.client.chat.completions.create(**kwargs)
+
     async def analyze_email(
         self,
         email_content: str,
@@ -89,6 +232,9 @@ class LLMService:
         """
         一次 LLM call 完成摘要 + 評分 + 回覆建議
 
+        內容超過 token_budget(model) 時改走 _analyze_long_email（分段整理後合併），
+        不再截斷信件尾端；回傳格式相同。
+
         Returns:
             {
                 summary, urgency_score, importance_score,
@@ -97,24 +243,31 @@ class LLMService:
             }
         """
         model = model or settings.default_model
-        start_time = time.time()
-
-        system_prompt = MASTER_SYSTEM_PROMPT.format(
-            style=STYLE_PROMPTS.get(style, STYLE_PROMPTS["bullet_points"]),
-            language=language,
+        budget = token_budget(model)
+        if count_tokens(email_content, model) > budget:
+            return await self._analyze_long_email(
+                email_content, style, model, language, topic_skill, budget
+            )
+        return await self._analyze_content(
+            f"<email>\n{email_content}\n</email>", style, model, language, topic_skill
         )
-        if topic_skill:
-            system_prompt = f"【信件集整理指示】\n{topic_skill}\n\n" + system_prompt
 
-        # 截斷過長的信件（省 token）
-        max_chars = settings.max_tokens_per_email * 3  # 約 3 char/token
-        content = email_content[:max_chars] if len(email_content) > max_chars else email_content
+    async def _analyze_content(
+        self,
+        user_content: str,
+        style: str,
+        model: str,
+        language: str,
+        topic_skill: str | None,
+    ) -> dict:
+        """以 MASTER_SYSTEM_PROMPT 分析一段內容（完整信件或分段重點）"""
+        start_time = time.time()
 
-        response = await self.client.chat.completions.create(
+        response = await self.chat_completion(
             model=model,
             messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"<email>\n{content}\n</email>"},
+                {"role": "system", "content": _master_prompt(style, language, topic_skill)},
+                {"role": "user", "content": user_content},
             ],
             temperature=0.3,
             max_tokens=800,
@@ -123,28 +276,7 @@ class LLMService:
 
         generation_ms = int((time.time() - start_time) * 1000)
         raw = response.choices[0].message.content
-        result = json.loads(raw)
-
-        # ── 正規化 summary 欄位 ──────────────────────────────────────
-        # Claude 有時把 bullet_points 回傳成 JSON array，
-        # 但 summary_text 欄位是 VARCHAR，必須是字串。
-        summary = result.get("summary", "")
-        if isinstance(summary, list):
-            result["summary"] = "\n".join(f"• {item}" for item in summary if item)
-        elif not isinstance(summary, str):
-            result["summary"] = str(summary)
-
-        # ── 正規化 reply_suggestions 欄位 ────────────────────────────
-        # 確保一定是 list[str]，避免 JSON 欄位存入非預期型別
-        suggestions = result.get("reply_suggestions", [])
-        if isinstance(suggestions, str):
-            try:
-                suggestions = json.loads(suggestions)
-            except Exception:
-                suggestions = [suggestions]
-        if not isinstance(suggestions, list):
-            suggestions = []
-        result["reply_suggestions"] = [str(s) for s in suggestions]
+        result = _normalize_result(json.loads(raw))
 
         return {
             **result,
@@ -153,35 +285,317 @@ class LLMService:
             "generation_ms": generation_ms,
         }
 
-    async def analyze_email_stream(
+    async def _analyze_chunk(
+        self, chunk: str, index: int, total: int, model: str, language: str
+    ) -> tuple[dict, int | None]:
+        """map：整理單一段落的重點，回傳 (notes / 評分, tokens_used)"""
+        response = await self.chat_completion(
+            model=model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": CHUNK_SYSTEM_PROMPT.format(
+                        index=index, total=total, language=language
+                    ),
+                },
+                {"role": "user", "content": f"<email_part>\n{chunk}\n</email_part>"},
+            ],
+            temperature=0.3,
+            max_tokens=settings.long_email_chunk_output_tokens,
+            response_format={"type": "json_object"},
+        )
+        result = json.loads(response.choices[0].message.content)
+        return (
+            result if isinstance(result, dict) else {},
+            response.usage.total_tokens if response.usage else None,
+        )
+
+    async def _map_long_email(
+        self, email_content: str, model: str, language: str, budget: int
+    ) -> tuple[str, list[tuple[dict, int | None]], bool]:
+        """
+        map：長信件依 token 預算分段，各段並行整理重點
+
+        段數超過 long_email_max_chunks 時逐層合併：每 long_email_max_chunks 段的重點
+        再整理成一段，直到段數不超過上限（不捨棄內容）。
+        只有超過 long_email_max_total_chunks 的尾端會被捨棄，並回傳 truncated=True。
+
+        回傳 (交給 MASTER prompt 合併的內容, [(各次呼叫的結果, tokens_used)], truncated)
+        """
+        chunks = split_by_tokens(email_content, budget, model)
+        truncated = len(chunks) > settings.long_email_max_total_chunks
+        if truncated:
+            metrics.incr("llm.long_email_truncated")
+            logger.warning(
+                f"長信件分成 {len(chunks)} 段，超過上限 "
+                f"{settings.long_email_max_total_chunks}，捨棄尾端並在摘要註記"
+            )
+            chunks = chunks[:settings.long_email_max_total_chunks]
+        metrics.incr("llm.long_emails")
+        metrics.incr("llm.long_email_chunks", len(chunks))
+
+        level = await asyncio.gather(
+            *(
+                self._analyze_chunk(chunk, i + 1, len(chunks), model, language)
+                for i, chunk in enumerate(chunks)
+            )
+        )
+        parts = list(level)
+
+        # reduce：分組把重點再整理一次，每層段數除以 long_email_max_chunks
+        fan_in = max(2, settings.long_email_max_chunks)
+        while len(level) > fan_in:
+            groups = [level[i:i + fan_in] for i in range(0, len(level), fan_in)]
+            level = await asyncio.gather(
+                *(
+                    self._analyze_chunk(
+                        _format_notes(group), i + 1, len(groups), model, language
+                    )
+                    for i, group in enumerate(groups)
+                )
+            )
+            parts.extend(level)
+            metrics.incr("llm.long_email_reduce_levels")
+
+        user_content = (
+            f"以下是一封長信件分成 {len(level)} 段後整理的重點，請視為同一封信件分析：\n"
+            f"<email_notes>\n" + _format_notes(level) + "\n</email_notes>"
+        )
+        return user_content, parts, truncated
+
+    @staticmethod
+    def _merge_long_email(
+        result: dict,
+        parts: list[tuple[dict, int | None]],
+        truncated: bool = False,
+        language: str = "zh-TW",
+    ) -> dict:
+        """
+        reduce 後處理：評分取各段與合併結果的最大值（一段要求行動即視為需要行動），
+        tokens_used 為所有呼叫的總和；尾端被捨棄時在摘要後註記
+        """
+        for field in ("urgency_score", "importance_score"):
+            scores = [result.get(field)] + [part.get(field) for part, _ in parts]
+            valid = [int(s) for s in scores if isinstance(s, (int, float)) and 1 <= s <= 5]
+            if valid:
+                result[field] = max(valid)
+        result["action_required"] = bool(result.get("action_required")) or any(
+            part.get("action_required") is True for part, _ in parts
+        )
+
+        usages = [tokens for _, tokens in parts] + [result.get("tokens_used")]
+        known = [tokens for tokens in usages if tokens is not None]
+        result["tokens_used"] = sum(known) if known else None
+
+        if truncated:
+            note = (
+                "（信件過長，僅分析前段內容）"
+                if language.lower().startswith("zh")
+                else "(Email truncated: only the beginning was analyzed)"
+            )
+            result["summary"] = f"{result.get('summary') or ''}\n\n{note}".strip()
+        return result
+
+    async def _analyze_long_email(
         self,
         email_content: str,
+        style: str,
+        model: str,
+        language: str,
+        topic_skill: str | None,
+        budget: int,
+    ) -> dict:
+        """超過 token 預算的長信件：分段整理重點（並行）→ 以 MASTER prompt 合併"""
+        start_time = time.time()
+        user_content, parts, truncated = await self._map_long_email(
+            email_content, model, language, budget
+        )
+        result = await self._analyze_content(user_content, style, model, language, topic_skill)
+        result = self._merge_long_email(result, parts, truncated, language)
+        result["generation_ms"] = int((time.time() - start_time) * 1000)
+        return result
+
+    async def analyze_emails_batch(
+        self,
+        emails: list[tuple[str, str]],
         style: str = "bullet_points",
         model: str | None = None,
         language: str = "zh-TW",
-    ) -> AsyncGenerator[str, None]:
-        """Streaming 版本 - 即時顯示摘要生成"""
+    ) -> dict[str, dict]:
+        """
+        一次 LLM call 分析多封短信件（共用一份 system prompt）
+
+        Args:
+            emails: [(message id, 內容)]，呼叫端負責控制總 token 數
+        Returns:
+            {message id: 與 analyze_email 相同格式的結果}；
+            缺漏或格式不正確的項目不會出現，由呼叫端改用單封分析
+        """
         model = model or settings.default_model
+        start_time = time.time()
+
+        system_prompt = BATCH_SYSTEM_PROMPT.format(
+            style=STYLE_PROMPTS.get(style, STYLE_PROMPTS["bullet_points"]),
+            language=language,
+        )
+        user_content = "\n\n".join(
+            f'<email id="{message_id}">\n{content}\n</email>' for message_id, content in emails
+        )
 
-        response = await self.client.chat.completions.create(
+        response = await self.chat_completion(
             model=model,
             messages=[
-                {
-                    "role": "system",
-                    "content": STYLE_PROMPTS.get(style, STYLE_PROMPTS["bullet_points"])
-                    + f"\n請用{language}語言回應。",
-                },
-                {"role": "user", "content": f"<email>\n{email_content}\n</email>"},
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content},
             ],
             temperature=0.3,
-            max_tokens=600,
-            stream=True,
+            max_tokens=min(
+                settings.analysis_batch_max_output_tokens,
+                settings.analysis_batch_output_tokens_per_item * len(emails),
+            ),
+            response_format={"type": "json_object"},
         )
 
-        async for chunk in response:
-            content = chunk.choices[0].delta.content
-            if content:
-                yield content
+        generation_ms = int((time.time() - start_time) * 1000)
+        items = json.loads(response.choices[0].message.content).get("results", [])
+        expected = {message_id: content for message_id, content in emails}
+
+        # token 依內容長度攤給各封信件
+        total_tokens = response.usage.total_tokens if response.usage else None
+        total_chars = sum(len(content) for _, content in emails) or 1
+
+        results: dict[str, dict] = {}
+        for item in items if isinstance(items, list) else []:
+            message_id = str(item.get("id", "")) if isinstance(item, dict) else ""
+            if message_id not in expected or message_id in results:
+                continue
+            item = _normalize_result(item)
+            if not _is_valid_result(item):
+                continue
+            item.pop("id", None)
+            results[message_id] = {
+                **item,
+                "model_used": model,
+                "tokens_used": (
+                    round(total_tokens * len(expected[message_id]) / total_chars)
+                    if total_tokens is not None else None
+                ),
+                "generation_ms": generation_ms,
+            }
+        return results
+
+    async def analyze_email_stream(
+        self,
+        email_content: str,
+        style: str = "bullet_points",
+        model: str | None = None,
+        language: str = "zh-TW",
+    ) -> AsyncGenerator[str, None]:
+        """Streaming 版本 - 即時顯示摘要生成"""
+        model = model or settings.default_model
+
+        # 串流期間佔用一個名額；總時間取決於輸出長度，只以 429 / 逾時調整上限
+        async with llm_limiter.slot(model, measure_latency=False):
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": STYLE_PROMPTS.get(style, STYLE_PROMPTS["bullet_points"])
+                        + f"\n請用{language}語言回應。",
+                    },
+                    {"role": "user", "content": f"<email>\n{email_content}\n</email>"},
+                ],
+                temperature=0.3,
+                max_tokens=600,
+                stream=True,
+            )
+
+            async for chunk in response:
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+
+    async def analyze_email_structured_stream(
+        self,
+        email_content: str,
+        style: str = "bullet_points",
+        model: str | None = None,
+        language: str = "zh-TW",
+    ) -> AsyncGenerator[dict, None]:
+        """
+        Streaming 版本的 analyze_email：JSON 欄位一完成就送出
+
+        依序 yield：
+            {"event": "field", "name": 欄位, "value": 值}  每個頂層欄位完成時（評分在前）
+            {"event": "summary_delta", "text": 新增文字}    摘要生成中
+            {"event": "result", "data": 完整結果}           最後一筆，格式同 analyze_email
+        長信件先並行完成分段整理，只串流合併那一步；最終評分以 result 為準。
+        """
+        model = model or settings.default_model
+        start_time = time.time()
+
+        parts: list[tuple[dict, int | None]] = []
+        truncated = False
+        budget = token_budget(model)
+        if count_tokens(email_content, model) > budget:
+            user_content, parts, truncated = await self._map_long_email(
+                email_content, model, language, budget
+            )
+        else:
+            user_content = f"<email>\n{email_content}\n</email>"
+
+        async with llm_limiter.slot(model, measure_latency=False):
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": _master_prompt(style, language)},
+                    {"role": "user", "content": user_content},
+                ],
+                temperature=0.3,
+                max_tokens=800,
+                response_format={"type": "json_object"},
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+
+            parser = JsonObjectStream()
+            summary_sent = 0
+            tokens_used = None
+            first_field = True
+            async for chunk in response:
+                if chunk.usage:
+                    tokens_used = chunk.usage.total_tokens
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+
+                for name, value in parser.feed(chunk.choices[0].delta.content):
+                    if first_field:
+                        metrics.observe("llm.stream_first_field_seconds", time.time() - start_time)
+                        first_field = False
+                    if name == "summary" and isinstance(value, str) and summary_sent < len(value):
+                        yield {"event": "summary_delta", "text": value[summary_sent:]}
+                        summary_sent = len(value)
+                    value = _normalize_result({name: value})[name]
+                    yield {"event": "field", "name": name, "value": value}
+
+                partial = parser.partial()
+                if partial and partial[0] == "summary" and len(partial[1]) > summary_sent:
+                    yield {"event": "summary_delta", "text": partial[1][summary_sent:]}
+                    summary_sent = len(partial[1])
+
+        if not parser.result:
+            raise ValueError("LLM 串流回應不是有效的 JSON 物件")
+
+        result = {
+            **_normalize_result(dict(parser.result)),
+            "model_used": model,
+            "tokens_used": tokens_used,
+        }
+        if parts:
+            result = self._merge_long_email(result, parts, truncated, language)
+        result["generation_ms"] = int((time.time() - start_time) * 1000)
+        yield {"event": "result", "data": result}
 
     async def analyze_thread(
         self,
@@ -219,7 +633,7 @@ class LLMService:
 請用{language}語言回應。
 """
 
-        response = await self.client.chat.completions.create(
+        response = await self.chat_completion(
             model=model,
             messages=[
                 {"role": "system", "content": system_prompt},
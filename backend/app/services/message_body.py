@@ -0,0 +1,81 @@
+"""
+信件內文延遲下載（metadata-first 同步）
+
+同步時只用 format=metadata 建立信件列；等到 LLM 分析或開啟信件詳情
+（GET /emails/{id}）真的需要內文時才向 Gmail 下載 format=full，
+下載後寫回 DB，之後直接讀 DB。
+
+LLM 分析一律使用正規化後的 analysis_text（見 content_normalizer）。
+內文本身存在 body_store（壓縮、跨帳號去重），讀取端需 selectinload(EmailMessage.body)。
+"""
+import logging
+from collections import defaultdict
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.models.email import EmailMessage
+from app.services import body_store, content_normalizer
+from app.services.gmail_client import client_for_account
+
+logger = logging.getLogger(__name__)
+
+
+async def ensure_bodies(db: AsyncSession, messages: list[EmailMessage]) -> None:
+    """
+    確保信件內文已下載（呼叫端需先 eager load EmailMessage.account 與 EmailMessage.body）
+
+    同一帳號的信件合併成一次 Gmail batch 請求；下載失敗的信件維持原狀，
+    呼叫端會退回使用 snippet。
+    """
+    by_account: dict = defaultdict(list)
+    for msg in messages:
+        if msg.body_fetched_at is None and msg.account and msg.account.provider == "gmail":
+            by_account[msg.account_id].append(msg)
+
+    for msgs in by_account.values():
+        account = msgs[0].account
+        try:
+            client = await client_for_account(account)
+            if not client:
+                continue
+            details, failed_ids = await client.get_message_details_batch(
+                [m.provider_message_id for m in msgs], format="full"
+            )
+        except Exception:
+            logger.error(f"下載帳號 {account.email_address} 的信件內文失敗", exc_info=True)
+            continue
+
+        if failed_ids:
+            logger.warning(f"{len(failed_ids)} 封信件內文下載失敗")
+
+        by_id = {d["provider_message_id"]: d for d in details}
+        fetched = [
+            (m, by_id[m.provider_message_id]) for m in msgs if m.provider_message_id in by_id
+        ]
+        hashes = await body_store.save(
+            db, [(d["body_plain"], d["body_html"]) for _, d in fetched]
+        )
+        bodies = await body_store.load(db, hashes)
+
+        for (msg, detail), body_hash in zip(fetched, hashes):
+            msg.body_hash = body_hash
+            # 直接掛上剛寫入的內文，呼叫端不必再查一次
+            set_committed_value(msg, "body", bodies.get(body_hash))
+            msg.analysis_text = detail["analysis_text"]
+            msg.has_attachments = detail["has_attachments"]
+            msg.body_fetched_at = detail["body_fetched_at"]
+
+    await db.flush()
+
+
+async def ensure_body(db: AsyncSession, msg: EmailMessage) -> None:
+    """確保單封信件內文已下載"""
+    await ensure_bodies(db, [msg])
+
+
+def analysis_content(msg: EmailMessage) -> str:
+    """送給 LLM 的內容（舊信件沒有 analysis_text 時在此補算，隨 session commit 寫回）"""
+    if msg.analysis_text is None and msg.body_fetched_at is not None:
+        msg.analysis_text = content_normalizer.normalize(msg.body_plain, msg.body_html)
+    return msg.analysis_text or msg.body_plain or msg.snippet or ""
@@ -0,0 +1,288 @@
+"""
+近似重複信件偵測（SimHash + LSH）
+
+內容雜湊（llm_cache）只能命中完全相同的信件；收據、出貨通知、CI 通知這類範本信件
+只差在人名、金額、訂單編號，每封都要付一次完整的 LLM 分析。這裡：
+  - 正規化：網址 / email 換成佔位字、含數字的字詞（金額、日期、編號）換成 #，
+    CJK 逐字、其他語言逐詞切開，取 3-gram shingle 計算 64 bit SimHash
+  - 索引：LLM 分析過的信件寫入 simhash_entries；64 bit 切成 4 段 16 bit，
+    任一段相同即為候選（漢明距離 ≤ 3 時保證至少一段相同）
+  - 範圍：同一用戶（scope=user）或同一用戶且同寄件網域（scope=sender_domain），不跨用戶
+  - 沿用：距離 ≤ near_duplicate_max_distance 時複製先前的評分 / 分類；摘要裡出現的
+    舊數字 / 編號依兩封信的對應關係換成新值，無法對應時改用主旨 + snippet 範本摘要
+  - 每次沿用都寫入 near_duplicate_matches（稽核）並記錄 metrics（near_duplicate.*）
+"""
+import hashlib
+import logging
+import re
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload, undefer
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.models.analysis import NearDuplicateMatch, SimhashEntry
+from app.models.email import EmailMessage
+from app.models.summary import EmailSummary
+from app.services import message_body
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# 沿用時寫入 EmailSummary.model_used；這類結果不會再被當成沿用來源，信譽計算也排除
+NEAR_DUPLICATE_MODEL = "near-duplicate"
+
+_BITS = 64
+_BANDS = 4
+_BAND_BITS = _BITS // _BANDS
+_MAX_TOKENS = 3000  # 只取前段計算指紋，長信件的尾端通常是制式頁尾
+
+_URL_RE = re.compile(r"https?://\S+|www\.\S+", re.IGNORECASE)
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+# 含數字的字詞：金額、日期、時間、訂單編號、commit hash、版本號
+_VARIABLE_RE = re.compile(r"[\w.:/-]*\d[\w.:/-]*")
+_TOKEN_RE = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|[^\W\d_]+|#"
+)
+_DOMAIN_RE = re.compile(r"@([\w-]+(?:\.[\w-]+)+)")
+
+
+@dataclass
+class Fingerprint:
+    simhash: int  # 無號 64 bit
+    user_id: uuid.UUID
+    sender_domain: str | None
+
+
+@dataclass
+class Match:
+    source: EmailMessage  # 已載入 summary 與分析內容
+    distance: int
+
+
+def _tokens(text: str) -> list[str]:
+    text = _URL_RE.sub(" url ", text.lower())
+    text = _EMAIL_RE.sub(" email ", text)
+    text = _VARIABLE_RE.sub(" # ", text)
+    return _TOKEN_RE.findall(text)[:_MAX_TOKENS]
+
+
+def simhash(tokens: list[str]) -> int:
+    shingles = Counter(" ".join(tokens[i:i + 3]) for i in range(max(1, len(tokens) - 2)))
+    weights = [0] * _BITS
+    for shingle, count in shingles.items():
+        h = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(_BITS):
+            weights[bit] += count if h >> bit & 1 else -count
+    return sum(1 << bit for bit in range(_BITS) if weights[bit] > 0)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _bands(value: int) -> list[int]:
+    mask = (1 << _BAND_BITS) - 1
+    # Postgres Integer 為有號 32 bit，16 bit 的段落不會溢位
+    return [(value >> (band * _BAND_BITS)) & mask for band in range(_BANDS)]
+
+
+def _to_signed(value: int) -> int:
+    return value - (1 << _BITS) if value >= 1 << (_BITS - 1) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << _BITS) if value < 0 else value
+
+
+def sender_domain(sender: str | None) -> str | None:
+    found = _DOMAIN_RE.search(sender or "")
+    return found.group(1).lower() if found else None
+
+
+def fingerprint(msg: EmailMessage, content: str) -> Fingerprint | None:
+    """計算信件指紋（需已載入 account）；功能關閉或內容太短時回傳 None"""
+    if not settings.near_duplicate_enabled or not msg.account:
+        return None
+    tokens = _tokens(content)
+    if len(tokens) < settings.near_duplicate_min_tokens:
+        return None
+    return Fingerprint(simhash(tokens), msg.account.user_id, sender_domain(msg.sender))
+
+
+def is_near(a: Fingerprint, b: Fingerprint) -> bool:
+    """兩個指紋是否在同一範圍內且距離不超過門檻"""
+    if a.user_id != b.user_id:
+        return False
+    if settings.near_duplicate_scope == "sender_domain" and a.sender_domain != b.sender_domain:
+        return False
+    return hamming(a.simhash, b.simhash) <= settings.near_duplicate_max_distance
+
+
+async def find_match(db: AsyncSession, msg_id, fp: Fingerprint) -> Match | None:
+    """在索引中依距離由近到遠，找第一封仍有 LLM 摘要的信件"""
+    bands = _bands(fp.simhash)
+    min_created_at = datetime.utcnow() - timedelta(days=settings.near_duplicate_max_age_days)
+    query = (
+        select(SimhashEntry.message_id, SimhashEntry.simhash)
+        .where(
+            SimhashEntry.user_id == fp.user_id,
+            SimhashEntry.message_id != msg_id,
+            SimhashEntry.created_at >= min_created_at,
+            or_(*(
+                getattr(SimhashEntry, f"band{band}") == value
+                for band, value in enumerate(bands)
+            )),
+        )
+        .order_by(SimhashEntry.created_at.desc())
+        .limit(settings.near_duplicate_max_candidates)
+    )
+    if settings.near_duplicate_scope == "sender_domain":
+        query = query.where(
+            SimhashEntry.sender_domain == fp.sender_domain
+            if fp.sender_domain
+            else SimhashEntry.sender_domain == None  # noqa: E711
+        )
+
+    candidates = sorted(
+        (hamming(fp.simhash, _to_unsigned(value)), message_id)
+        for message_id, value in (await db.execute(query)).all()
+    )
+    candidates = [c for c in candidates if c[0] <= settings.near_duplicate_max_distance]
+    if not candidates:
+        metrics.incr("near_duplicate.misses")
+        return None
+
+    # 最近的候選可能已被刪除摘要或本身也是沿用結果，一次查出哪些候選可當來源
+    usable = set((await db.execute(
+        select(EmailSummary.message_id).where(
+            EmailSummary.message_id.in_([source_id for _, source_id in candidates]),
+            EmailSummary.model_used != NEAR_DUPLICATE_MODEL,
+        )
+    )).scalars().all())
+    for distance, source_id in candidates:
+        if source_id not in usable:
+            continue
+        source = (
+            await db.execute(
+                select(EmailMessage)
+                .where(EmailMessage.id == source_id)
+                .options(
+                    selectinload(EmailMessage.summary),
+                    selectinload(EmailMessage.body),
+                    undefer(EmailMessage.analysis_text),
+                )
+            )
+        ).scalar_one_or_none()
+        if source is not None and source.summary is not None:
+            return Match(source, distance)
+
+    metrics.incr("near_duplicate.misses")
+    return None
+
+
+def _adapt(text: str, mapping: dict[str, str], stale: set[str]) -> str | None:
+    """把文字中的舊數字 / 編號換成新值；有舊值無法對應時回傳 None"""
+    missing = False
+
+    def replace(found: re.Match) -> str:
+        nonlocal missing
+        token = found.group(0)
+        if token in mapping:
+            return mapping[token]
+        if token in stale:
+            missing = True
+        return token
+
+    adapted = _VARIABLE_RE.sub(replace, text)
+    return None if missing else adapted
+
+
+def reuse_result(msg: EmailMessage, content: str, match: Match, language: str) -> tuple[dict, bool]:
+    """
+    依來源信件的摘要產生這封信的結果（格式同 LLMService.analyze_email）
+
+    回傳 (結果, 摘要是否經過數字 / 編號替換)
+    """
+    source = match.source
+    summary = source.summary
+    old_values = _VARIABLE_RE.findall(message_body.analysis_content(source))
+    new_values = _VARIABLE_RE.findall(content)
+    # 只在來源出現、這封信沒有的值，出現在摘要裡就代表摘要已過時
+    stale = set(old_values) - set(new_values)
+
+    mapping: dict[str, str] = {}
+    if len(old_values) == len(new_values):
+        for old, new in zip(old_values, new_values):
+            if old == new:
+                continue
+            if mapping.get(old, new) != new:
+                mapping = {}
+                break
+            mapping[old] = new
+
+    summary_text = _adapt(summary.summary_text or "", mapping, stale)
+    suggestions = [_adapt(s, mapping, stale) for s in (summary.reply_suggestions or [])]
+    adapted = bool(mapping) and summary_text != summary.summary_text
+
+    if summary_text is None:
+        snippet = (msg.snippet or "").strip()
+        prefix = (
+            "（與先前的相似信件同類，沿用其分類）"
+            if language.lower().startswith("zh")
+            else "(Similar to an earlier email; triage reused) "
+        )
+        summary_text = f"{prefix}{msg.subject or ''}\n{snippet}".strip()
+
+    return {
+        "summary": summary_text,
+        "urgency_score": summary.urgency_score,
+        "importance_score": summary.importance_score,
+        "action_required": str(summary.action_required) == "True",
+        "category": summary.ai_category,
+        "sentiment": summary.sentiment,
+        "reply_suggestions": [s for s in suggestions if s is not None],
+        "model_used": NEAR_DUPLICATE_MODEL,
+        "tokens_used": 0,
+        "generation_ms": 0,
+    }, adapted
+
+
+def record(db: AsyncSession, msg: EmailMessage, match: Match, adapted: bool) -> None:
+    """寫入稽核紀錄（由呼叫端 commit）"""
+    db.add(NearDuplicateMatch(
+        message_id=msg.id,
+        source_message_id=match.source.id,
+        distance=match.distance,
+        scope=settings.near_duplicate_scope,
+        adapted=adapted,
+    ))
+    metrics.incr("near_duplicate.reused")
+    metrics.incr(f"near_duplicate.distance.{match.distance}")
+    logger.info(
+        f"信件 {msg.id} 沿用相似信件 {match.source.id} 的分析"
+        f"（distance={match.distance}，scope={settings.near_duplicate_scope}，adapted={adapted}）"
+    )
+
+
+async def add(db: AsyncSession, msg: EmailMessage, fp: Fingerprint) -> None:
+    """把 LLM 分析過的信件加入索引（由呼叫端 commit）"""
+    bands = _bands(fp.simhash)
+    await db.execute(
+        pg_insert(SimhashEntry)
+        .values(
+            message_id=msg.id,
+            user_id=fp.user_id,
+            sender_domain=fp.sender_domain,
+            simhash=_to_signed(fp.simhash),
+            **{f"band{band}": value for band, value in enumerate(bands)},
+            created_at=datetime.utcnow(),
+        )
+        .on_conflict_do_nothing(index_elements=["message_id"])
+    )
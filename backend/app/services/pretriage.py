@@ -0,0 +1,192 @@
+"""
+分析前的規則式分流（pre-triage）
+
+促銷、社群通知、電子報與 no-reply 寄件者佔了大部分信件量，不需要高階模型：
+  - 訊號：Gmail 分類標籤（CATEGORY_PROMOTIONS / CATEGORY_SOCIAL）、List-Unsubscribe / List-Id 標頭、
+    no-reply 類寄件者、寄件者信譽（同一寄件者過去 LLM 分析的平均重要性）
+  - 每個訊號對應一個動作：full（照常分析）、cheap（改用 pretriage_cheap_model）、
+    skip（不呼叫 LLM，套用預設評分與範本摘要）；多個訊號取最省的動作
+  - 預設值來自 settings，用戶可在 users.pretriage_rules 覆寫（PUT /settings/pretriage）
+  - 決策與命中的訊號記錄在 metrics（pretriage.*）
+"""
+import re
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.models.email import EmailAccount, EmailMessage
+from app.models.summary import EmailSummary
+from app.services.near_duplicate import NEAR_DUPLICATE_MODEL
+
+settings = get_settings()
+
+ACTIONS = ("full", "cheap", "skip")  # 由貴到省
+SIGNALS = ("promotions", "social", "list_mail", "no_reply", "low_reputation")
+
+# skip 時寫入 EmailSummary.model_used，信譽計算會排除這些結果
+PRETRIAGE_MODEL = "pretriage"
+
+_NO_REPLY_RE = re.compile(
+    r"no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon|notifications?@|bounces?[@+-]",
+    re.IGNORECASE,
+)
+
+# 訊號對應的分類（skip 時寫入 ai_category）
+_SIGNAL_CATEGORY = {
+    "promotions": "促銷廣告",
+    "social": "個人通知",
+    "list_mail": "電子報",
+    "no_reply": "個人通知",
+    "low_reputation": "其他",
+}
+
+
+@dataclass
+class Decision:
+    action: str = "full"
+    signals: list[str] = field(default_factory=list)
+
+
+def default_rules() -> dict:
+    return {
+        "enabled": settings.pretriage_enabled,
+        "promotions": settings.pretriage_promotions,
+        "social": settings.pretriage_social,
+        "list_mail": settings.pretriage_list_mail,
+        "no_reply": settings.pretriage_no_reply,
+        "low_reputation": settings.pretriage_low_reputation,
+        "reputation_min_messages": settings.pretriage_reputation_min_messages,
+        "reputation_max_importance": settings.pretriage_reputation_max_importance,
+    }
+
+
+def rules_for(user) -> dict:
+    """系統預設 + 用戶覆寫"""
+    rules = default_rules()
+    if user is not None and user.pretriage_rules:
+        rules.update({k: v for k, v in user.pretriage_rules.items() if k in rules})
+    return rules
+
+
+def _signals(msg: EmailMessage, rules: dict, reputation: tuple[int, float] | None) -> list[str]:
+    labels = set(msg.labels or [])
+    found = []
+    if "CATEGORY_PROMOTIONS" in labels:
+        found.append("promotions")
+    if "CATEGORY_SOCIAL" in labels:
+        found.append("social")
+    if msg.is_list_mail:
+        found.append("list_mail")
+    if msg.sender and _NO_REPLY_RE.search(msg.sender):
+        found.append("no_reply")
+    if reputation:
+        count, avg_importance = reputation
+        if (
+            count >= rules["reputation_min_messages"]
+            and avg_importance is not None
+            and avg_importance <= rules["reputation_max_importance"]
+        ):
+            found.append("low_reputation")
+    return found
+
+
+def decide(msg: EmailMessage, rules: dict, reputation: tuple[int, float] | None = None) -> Decision:
+    if not rules["enabled"]:
+        return Decision()
+
+    signals = _signals(msg, rules, reputation)
+    action = max(
+        (rules.get(signal, "full") for signal in signals),
+        key=lambda a: ACTIONS.index(a) if a in ACTIONS else 0,
+        default="full",
+    )
+    # 用戶標星號或 Gmail 判定為重要的信件不略過，最多降級模型
+    if action == "skip" and {"STARRED", "IMPORTANT"} & set(msg.labels or []):
+        action = "cheap"
+    return Decision(action if action in ACTIONS else "full", signals)
+
+
+async def sender_reputation(
+    db: AsyncSession, user_id, senders: set[str]
+) -> dict[str, tuple[int, float]]:
+    """同一用戶下各寄件者過去 LLM 分析的 (筆數, 平均重要性)，不含 pre-triage 預設值與沿用的結果"""
+    if not senders:
+        return {}
+    result = await db.execute(
+        select(EmailMessage.sender, func.count(), func.avg(EmailSummary.importance_score))
+        .join(EmailSummary, EmailSummary.message_id == EmailMessage.id)
+        .join(EmailAccount, EmailAccount.id == EmailMessage.account_id)
+        .where(
+            EmailAccount.user_id == user_id,
+            EmailMessage.sender.in_(senders),
+            EmailSummary.importance_score != None,  # noqa: E711
+            EmailSummary.model_used.not_in((PRETRIAGE_MODEL, NEAR_DUPLICATE_MODEL)),
+        )
+        .group_by(EmailMessage.sender)
+    )
+    return {
+        sender: (count, float(avg) if avg is not None else None)
+        for sender, count, avg in result.all()
+    }
+
+
+def record(decision: Decision) -> None:
+    metrics.incr(f"pretriage.{decision.action}")
+    for signal in decision.signals:
+        metrics.incr(f"pretriage.signal.{signal}")
+
+
+async def evaluate(
+    db: AsyncSession, messages: list[EmailMessage], record_metrics: bool = True
+) -> dict:
+    """
+    對一批信件（需已載入 account.user）做分流，回傳 {message id: Decision}
+
+    record_metrics=False 時由呼叫端對實際採用的決策呼叫 record()（避免同一封信重複計數）
+    """
+    by_user: dict = defaultdict(list)
+    for msg in messages:
+        by_user[msg.account.user_id if msg.account else None].append(msg)
+
+    decisions = {}
+    for user_id, user_messages in by_user.items():
+        account = user_messages[0].account
+        rules = rules_for(account.user if account else None)
+
+        reputation = {}
+        if rules["enabled"] and rules.get("low_reputation", "full") != "full" and user_id:
+            senders = {m.sender for m in user_messages if m.sender}
+            reputation = await sender_reputation(db, user_id, senders)
+
+        for msg in user_messages:
+            decision = decide(msg, rules, reputation.get(msg.sender))
+            decisions[msg.id] = decision
+            if record_metrics:
+                record(decision)
+    return decisions
+
+
+def template_result(msg: EmailMessage, decision: Decision, language: str) -> dict:
+    """skip 時使用的預設評分與範本摘要（格式同 LLMService.analyze_email）"""
+    category = _SIGNAL_CATEGORY.get(decision.signals[0], "其他") if decision.signals else "其他"
+    subject = msg.subject or ""
+    if language.lower().startswith("zh"):
+        summary = f"（{category}，自動分類未經 AI 分析）{subject}"
+    else:
+        summary = f"(Auto-triaged as bulk mail, not analyzed by AI) {subject}"
+    return {
+        "summary": summary,
+        "urgency_score": 1,
+        "importance_score": 1,
+        "action_required": False,
+        "category": category,
+        "sentiment": "neutral",
+        "reply_suggestions": [],
+        "model_used": PRETRIAGE_MODEL,
+        "tokens_used": 0,
+        "generation_ms": 0,
+    }
@@ -0,0 +1,101 @@
+"""
+帳號同步 Lease（Redis）
+
+確保同一帳號在所有 API / Worker replica 中同時只有一個同步在跑：
+  - SET NX PX 取得 lease，持有期間背景續約（TTL 的 1/3 續一次）
+  - 每次取得 lease 都會拿到遞增的 fencing token；同步寫入 DB 前
+    會檢查 email_sync_states.lease_fence，過期持有者（例如 GC 停頓後 lease 已被接手）
+    的寫入會被拒絕
+  - 釋放 / 續約用 Lua 比對持有者，不會誤刪別人的 lease
+"""
+import asyncio
+import logging
+import secrets
+
+from app.core.config import get_settings
+from app.core.redis import get_redis
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_LEASE_KEY = "mailcake:lease:{kind}:{account_id}"
+_FENCE_KEY = "mailcake:lease_fence:{kind}:{account_id}"
+
+_RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+_RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LeaseLostError(Exception):
+    """Lease 已過期或被其他持有者取得"""
+
+
+class SyncLease:
+    """已取得的 lease；用 async with 自動續約與釋放"""
+
+    def __init__(self, key: str, value: str, fence: int, ttl_ms: int):
+        self.key = key
+        self.fence = fence
+        self._value = value
+        self._ttl_ms = ttl_ms
+        self._renewer: asyncio.Task | None = None
+        self.lost = False
+
+    async def __aenter__(self) -> "SyncLease":
+        self._renewer = asyncio.create_task(self._renew_loop())
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        if self._renewer:
+            self._renewer.cancel()
+        await self.release()
+
+    def check(self) -> None:
+        """寫入前確認 lease 仍有效"""
+        if self.lost:
+            raise LeaseLostError(f"lease {self.key} 已遺失（fence={self.fence}）")
+
+    async def _renew_loop(self) -> None:
+        redis = get_redis()
+        while True:
+            await asyncio.sleep(self._ttl_ms / 3000)
+            try:
+                renewed = await redis.eval(_RENEW_SCRIPT, 1, self.key, self._value, self._ttl_ms)
+            except Exception:
+                logger.warning(f"lease {self.key} 續約失敗，稍後重試", exc_info=True)
+                continue
+            if not renewed:
+                self.lost = True
+                logger.error(f"lease {self.key} 已被其他持有者取得（fence={self.fence}）")
+                return
+
+    async def release(self) -> None:
+        try:
+            await get_redis().eval(_RELEASE_SCRIPT, 1, self.key, self._value)
+        except Exception:
+            logger.warning(f"lease {self.key} 釋放失敗，將於 TTL 到期後自動釋放", exc_info=True)
+
+
+async def acquire(
+    account_id, kind: str = "sync", ttl_seconds: int | None = None
+) -> SyncLease | None:
+    """嘗試取得帳號的 lease；已被持有時回傳 None"""
+    redis = get_redis()
+    ttl_ms = int((ttl_seconds or settings.sync_lease_ttl_seconds) * 1000)
+    fence = await redis.incr(_FENCE_KEY.format(kind=kind, account_id=account_id))
+    key = _LEASE_KEY.format(kind=kind, account_id=account_id)
+    value = f"{secrets.token_hex(8)}:{fence}"
+
+    if not await redis.set(key, value, nx=True, px=ttl_ms):
+        return None
+    return SyncLease(key, value, fence, ttl_ms)
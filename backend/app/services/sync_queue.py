@@ -0,0 +1,63 @@
+"""
+帳號同步請求佇列（Redis）
+
+API（push 通知、OAuth callback）只負責把「哪個帳號需要同步」放進佇列，
+實際同步由 Worker 消化，API process 不直接跑 sync_account。
+
+同一帳號在佇列中只會有一筆（每個帳號一個 pending 標記去重），
+連續多個 push 通知只會觸發一次增量同步：
+  - 設定標記與 RPUSH 在同一個 Lua script 內完成，不會只設了標記卻沒進佇列
+  - 標記有 TTL：Worker 在 BLPOP 之後、刪除標記之前中斷時，
+    標記最晚 sync_pending_ttl_seconds 後過期，帳號不會永遠被去重擋住
+"""
+import json
+import logging
+
+from app.core.config import get_settings
+from app.core.redis import get_redis
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "mailcake:sync_requests"
+_PENDING_KEY = "mailcake:sync_pending:{account_id}"
+
+_ENQUEUE_SCRIPT = """
+if redis.call("SET", KEYS[1], "1", "NX", "EX", ARGV[1]) then
+    redis.call("RPUSH", KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+async def request_sync(account_id, user_id=None) -> bool:
+    """將帳號加入同步佇列；已在佇列中則略過（回傳是否新加入）"""
+    payload = json.dumps(
+        {"account_id": str(account_id), "user_id": str(user_id) if user_id else None}
+    )
+    added = await get_redis().eval(
+        _ENQUEUE_SCRIPT,
+        2,
+        _PENDING_KEY.format(account_id=account_id),
+        QUEUE_KEY,
+        settings.sync_pending_ttl_seconds,
+        payload,
+    )
+    return bool(added)
+
+
+async def next_request(timeout: int = 5) -> dict | None:
+    """取出下一個同步請求（最多等待 timeout 秒）"""
+    redis = get_redis()
+    item = await redis.blpop([QUEUE_KEY], timeout=timeout)
+    if not item:
+        return None
+    payload = json.loads(item[1])
+    # 刪除標記之後到的請求會重新排入；刪除之前到的請求由這次同步涵蓋
+    await redis.delete(_PENDING_KEY.format(account_id=payload["account_id"]))
+    return payload
+
+
+async def queue_depth() -> int:
+    return await get_redis().llen(QUEUE_KEY)
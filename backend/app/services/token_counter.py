@@ -0,0 +1,108 @@
+"""
+Token 計數（依模型）
+
+LiteLLM Proxy 後面各家模型的 tokenizer 不同：
+  - OpenAI（gpt-4o 系列）：tiktoken o200k_base，結果精確
+  - 其他（Claude / Gemini / Ollama）：tiktoken cl100k_base × 模型家族校正係數
+  - tiktoken 無法載入編碼檔（例如離線環境）時改用 CJK-aware 估算：
+    中日韓字元 1 字約 1 token，其他文字約 4 字元 1 token
+舊的「3 字元 = 1 token」對中文信件會高估三倍，對英文長信則會截掉尾端。
+"""
+import functools
+import logging
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+# 平假名 / 片假名、CJK 統一漢字（含擴充 A、相容字）、韓文音節、全形字元
+_CJK_RE = re.compile(
+    "[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af\uff00-\uffef]"
+)
+
+# 以 cl100k_base 計數後乘上的係數（各家 tokenizer 對同一段文字的相對 token 數）
+_FAMILY_FACTORS = {
+    "openai": 1.0,
+    "claude": 1.15,
+    "gemini": 1.0,
+    "local": 1.1,
+}
+
+
+def _family(model: str | None) -> str:
+    name = (model or "").lower()
+    if name.startswith(("gpt-", "o1", "o3")):
+        return "openai"
+    if name.startswith("claude"):
+        return "claude"
+    if name.startswith("gemini"):
+        return "gemini"
+    return "local"
+
+
+@functools.lru_cache(maxsize=4)
+def _encoding(name: str):
+    """載入 tiktoken 編碼；失敗時回傳 None（之後都用估算）"""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(name)
+    except Exception:
+        logger.warning(f"無法載入 tiktoken 編碼 {name}，改用 CJK-aware 估算", exc_info=True)
+        return None
+
+
+def _estimate(text: str) -> int:
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def count_tokens(text: str, model: str | None = None) -> int:
+    """計算 text 在指定模型下的 token 數（非 OpenAI 模型為校正後的近似值）"""
+    if not text:
+        return 0
+    family = _family(model)
+    encoding_name = "o200k_base" if family == "openai" and "4o" in (model or "") else "cl100k_base"
+    encoding = _encoding(encoding_name)
+    if encoding is None:
+        return _estimate(text)
+    count = len(encoding.encode(text, disallowed_special=()))
+    # 先 round 消掉浮點誤差（100 × 1.1 = 110.00000000000001），再無條件進位
+    return math.ceil(round(count * _FAMILY_FACTORS[family], 6))
+
+
+def split_by_tokens(text: str, max_tokens: int, model: str | None = None) -> list[str]:
+    """
+    依段落把 text 切成每段不超過 max_tokens 的片段
+
+    盡量在空行 / 換行處切開；單一段落就超過上限時依字元比例硬切。
+    """
+    pieces: list[str] = []
+    for paragraph in re.split(r"\n{2,}", text):
+        if not paragraph.strip():
+            continue
+        tokens = count_tokens(paragraph, model)
+        if tokens <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for line in paragraph.split("\n"):
+            line_tokens = count_tokens(line, model)
+            if line_tokens <= max_tokens:
+                pieces.append(line)
+                continue
+            step = max(1, int(len(line) * max_tokens / line_tokens * 0.95))
+            pieces.extend(line[i:i + step] for i in range(0, len(line), step))
+
+    chunks: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = count_tokens(piece, model)
+        if current and current_tokens + piece_tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
@@ -0,0 +1,74 @@
+"""
+OAuth Token 管理
+
+  - 解密後的 Token 以密文為 key 快取在 process 內（TTL），同步時不必每次跑 Fernet 解密；
+    密文改變（refresh / 重新授權）自然就是新的 key
+  - refresh 後的 access token 與到期時間寫回 email_accounts，
+    其他 process / 下一次同步直接使用，不會每次同步都重新 refresh
+  - 實際的 refresh 由 gmail_client 在 thread pool 執行；Worker 定期在到期前
+    背景 refresh（refresh_expiring_tokens），同步流程正常情況下不會碰到 Token endpoint
+"""
+import time
+from datetime import datetime, timedelta
+
+from google.oauth2.credentials import Credentials
+from sqlalchemy import update
+
+from app.core.config import get_settings
+from app.core.database import AsyncSessionLocal
+from app.models.email import EmailAccount
+from app.services import crypto_service
+
+settings = get_settings()
+
+_plaintext: dict[str, tuple[str, float]] = {}  # 密文 → (明文, 到期時間)
+
+
+def _remember(ciphertext: str, plaintext: str) -> None:
+    now = time.monotonic()
+    for key in [k for k, (_, exp) in _plaintext.items() if exp <= now]:
+        del _plaintext[key]
+    _plaintext[ciphertext] = (plaintext, now + settings.token_cache_ttl_seconds)
+
+
+def decrypt(ciphertext: str | None) -> str:
+    """解密 Token（TTL 快取）"""
+    if not ciphertext:
+        return ""
+    cached = _plaintext.get(ciphertext)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    plaintext = crypto_service.decrypt(ciphertext)
+    _remember(ciphertext, plaintext)
+    return plaintext
+
+
+def encrypt(plaintext: str) -> str:
+    """加密 Token，並直接放入解密快取"""
+    ciphertext = crypto_service.encrypt(plaintext)
+    if ciphertext:
+        _remember(ciphertext, plaintext)
+    return ciphertext
+
+
+def expires_within(creds: Credentials, seconds: int) -> bool:
+    """Token 是否會在 seconds 秒內到期（到期時間未知視為需要 refresh）"""
+    if creds.expiry is None:
+        return True
+    return creds.expiry - datetime.utcnow() < timedelta(seconds=seconds)
+
+
+async def persist(account_id, creds: Credentials, previous_refresh_token: str | None) -> None:
+    """將 refresh 後的 Token 寫回 DB（refresh token 有輪替時一併更新）"""
+    values = {
+        "encrypted_access_token": encrypt(creds.token),
+        "token_expires_at": creds.expiry,
+    }
+    if creds.refresh_token and creds.refresh_token != previous_refresh_token:
+        values["encrypted_refresh_token"] = encrypt(creds.refresh_token)
+
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(EmailAccount).where(EmailAccount.id == account_id).values(**values)
+        )
+        await db.commit()
@@ -0,0 +1,170 @@
+"""
+Topic 自動分類規則比對器
+
+把用戶所有 Topic 的 auto_rules 編譯成一個 matcher：
+  - senders / subject_contains → 各一個 Aho-Corasick 自動機（多字串一次掃描）
+  - labels                     → label → topic_ids 的 dict
+
+Worker 內以 user_id 快取編譯結果；Topics API 修改規則時會遞增 Redis 中的版本號，
+Worker 發現版本不同就重新編譯（Redis 不可用時以 TTL 到期重建）。
+"""
+import json
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import get_settings
+from app.core.redis import get_redis
+from app.models.topic import Topic
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_VERSION_KEY = "mailcake:topic_rules_version:{user_id}"
+
+
+class AhoCorasick:
+    """多字串比對自動機，search() 回傳所有命中 pattern 的 payload"""
+
+    def __init__(self, patterns: dict[str, set]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[frozenset] = [frozenset()]
+
+        outputs: list[set] = [set()]
+        for pattern, payloads in patterns.items():
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    outputs.append(set())
+                state = nxt
+            outputs[state] |= payloads
+
+        # BFS 建立 failure link，並把 fail 狀態的輸出合併進來
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                outputs[nxt] |= outputs[self._fail[nxt]]
+
+        self._out = [frozenset(o) for o in outputs]
+
+    def search(self, text: str) -> set:
+        found: set = set()
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class TopicMatcher:
+    """單一用戶的已編譯分類規則"""
+
+    def __init__(self, topics: list[Topic]):
+        senders: dict[str, set] = {}
+        subjects: dict[str, set] = {}
+        self._labels: dict[str, set] = {}
+        self._always: set = set()  # 空字串規則：和逐條 `in` 比對一樣命中所有信件
+
+        for topic in topics:
+            try:
+                rules = json.loads(topic.auto_rules) if topic.auto_rules else {}
+            except Exception:
+                continue
+            if not isinstance(rules, dict):
+                continue
+            for p in (*rules.get("senders", []), *rules.get("subject_contains", [])):
+                if not str(p):
+                    self._always.add(topic.id)
+            for p in rules.get("senders", []):
+                senders.setdefault(str(p).lower(), set()).add(topic.id)
+            for k in rules.get("subject_contains", []):
+                subjects.setdefault(str(k).lower(), set()).add(topic.id)
+            for lb in rules.get("labels", []):
+                self._labels.setdefault(str(lb).lower(), set()).add(topic.id)
+
+        self._senders = AhoCorasick(senders) if senders else None
+        self._subjects = AhoCorasick(subjects) if subjects else None
+        self.is_empty = not (senders or subjects or self._labels or self._always)
+
+    def match(self, sender: str | None, subject: str | None, labels: list[str] | None) -> set:
+        """回傳符合的 topic_id 集合"""
+        matched: set = set(self._always)
+        if self._senders and sender:
+            matched |= self._senders.search(sender.lower())
+        if self._subjects and subject:
+            matched |= self._subjects.search(subject.lower())
+        for lb in labels or []:
+            matched |= self._labels.get(lb.lower(), set())
+        return matched
+
+
+@dataclass
+class _CacheEntry:
+    matcher: TopicMatcher
+    version: str | None
+    built_at: float
+
+
+_cache: dict = {}
+
+
+async def _remote_version(user_id) -> str | None:
+    try:
+        return await get_redis().get(_VERSION_KEY.format(user_id=user_id))
+    except Exception:
+        logger.warning("無法讀取 Topic 規則版本（Redis），改用 TTL 失效", exc_info=True)
+        return None
+
+
+async def get_matcher(db: AsyncSession, user_id) -> TopicMatcher:
+    """取得用戶的已編譯 matcher（版本不同或 TTL 到期時重新編譯）"""
+    version = await _remote_version(user_id)
+    entry = _cache.get(user_id)
+    if (
+        entry
+        and entry.version == version
+        and time.monotonic() - entry.built_at < settings.topic_matcher_ttl_seconds
+    ):
+        return entry.matcher
+
+    result = await db.execute(
+        select(Topic).where(
+            Topic.user_id == user_id,
+            Topic.is_active == True,  # noqa: E712
+            Topic.auto_rules != None,  # noqa: E711
+        )
+    )
+    matcher = TopicMatcher(result.scalars().all())
+    _cache[user_id] = _CacheEntry(matcher=matcher, version=version, built_at=time.monotonic())
+    return matcher
+
+
+async def invalidate(user_id) -> None:
+    """規則變更後呼叫：清掉本 process 的快取，並通知其他 process 重新編譯"""
+    _cache.pop(user_id, None)
+    try:
+        await get_redis().incr(_VERSION_KEY.format(user_id=user_id))
+    except Exception:
+        logger.warning(f"無法更新 Topic 規則版本（user={user_id}），Worker 將於 TTL 到期後重建")
@@ -0,0 +1,373 @@
+"""
+LLM 分析 Worker - 消化 analysis_jobs 佇列
+
+與同步完全分離：同步只負責把新信件排入佇列，這裡以 SKIP LOCKED 認領工作，
+可以在主 Worker 內執行，也可以另外啟動任意數量的分析 process：
+
+    python -m app.workers.analysis
+"""
+import asyncio
+import logging
+import signal
+from collections import defaultdict
+
+from sqlalchemy import exists, select
+from sqlalchemy.orm import selectinload, undefer
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.database import AsyncSessionLocal
+from app.models.email import EmailAccount, EmailMessage
+from app.models.summary import EmailSummary
+from app.services import analysis_queue, llm_cache, message_body, near_duplicate, pretriage
+from app.services.llm_service import LLMService
+from app.services.token_counter import count_tokens
+from app.workers.email_sync import _resolve_model
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+def _analysis_params(
+    msg: EmailMessage, decision: pretriage.Decision | None = None
+) -> tuple[str, str, str]:
+    """信件使用的 (model, style, language)：pre-triage 降級 → 帳號覆寫 → 用戶預設"""
+    account = msg.account
+    user = account.user if account else None
+
+    raw_model = (
+        account.model_override
+        or (user.default_model if user else None)
+        or "claude-haiku"
+    )
+    if decision and decision.action == "cheap":
+        raw_model = settings.pretriage_cheap_model
+    model = _resolve_model(raw_model)   # 本地模型自動降級
+    style = (user.default_summary_style if user else None) or "bullet_points"
+    language = (user.summary_language if user else None) or "zh-TW"
+    return model, style, language
+
+
+def _save_result(db, msg: EmailMessage, result_data: dict, style: str, model: str) -> None:
+    """寫回 triage 評分並建立 EmailSummary（由呼叫端 commit）"""
+    # 更新信件 triage 評分（EmailMessage.action_required 是 Boolean）
+    action_req_bool = bool(result_data.get("action_required", False))
+    msg.urgency_score = result_data.get("urgency_score")
+    msg.importance_score = result_data.get("importance_score")
+    msg.action_required = action_req_bool
+    msg.ai_category = result_data.get("category")
+    msg.sentiment = result_data.get("sentiment")
+
+    # 儲存摘要（EmailSummary.action_required 是 String(5)，需轉字串）
+    db.add(EmailSummary(
+        message_id=msg.id,
+        summary_text=result_data.get("summary", ""),
+        style=style,
+        urgency_score=result_data.get("urgency_score"),
+        importance_score=result_data.get("importance_score"),
+        action_required=str(action_req_bool),
+        ai_category=result_data.get("category"),
+        sentiment=result_data.get("sentiment"),
+        reply_suggestions=result_data.get("reply_suggestions", []),
+        model_used=result_data.get("model_used", model),
+        tokens_used=result_data.get("tokens_used"),
+        generation_ms=result_data.get("generation_ms"),
+    ))
+
+
+def _message_query(message_ids: list):
+    """載入待分析信件（含帳號、user、內文與 analysis_text），已有摘要的略過"""
+    return (
+        select(EmailMessage)
+        .where(
+            EmailMessage.id.in_(message_ids),
+            ~exists().where(EmailSummary.message_id == EmailMessage.id),
+        )
+        .options(
+            selectinload(EmailMessage.account).selectinload(EmailAccount.user),
+            selectinload(EmailMessage.body),
+            undefer(EmailMessage.analysis_text),
+        )
+    )
+
+
+async def _analyze_single_message(msg_id, llm: LLMService):
+    """分析單封信件（獨立 session；LLM 並行數由 llm_limiter 依模型控制）；失敗時拋出例外"""
+    async with AsyncSessionLocal() as db:
+        # 已有摘要（例如用戶手動摘要過）就不必再分析
+        msg = (await db.execute(_message_query([msg_id]))).scalar_one_or_none()
+        if not msg:
+            logger.info(f"信件 {msg_id} 不存在或已有摘要，跳過")
+            return
+
+        content = message_body.analysis_content(msg) or msg.subject or ""
+        if not content:
+            logger.warning(f"信件 {msg_id} 內容為空，跳過")
+            return
+
+        decision = (await pretriage.evaluate(db, [msg]))[msg.id]
+        model, style, language = _analysis_params(msg, decision)
+
+        if decision.action == "skip":
+            # 大量寄送的信件：不呼叫 LLM，套用預設評分與範本摘要
+            _save_result(db, msg, pretriage.template_result(msg, decision, language), style, model)
+            await db.commit()
+            logger.info(f"信件 {msg.id} 由 pre-triage 略過 LLM（{','.join(decision.signals)}）")
+            return
+
+        # 範本信件（只差在人名 / 數字 / 編號）沿用先前相似信件的分析
+        fp = near_duplicate.fingerprint(msg, content)
+        match = await near_duplicate.find_match(db, msg.id, fp) if fp else None
+        if match:
+            result_data, adapted = near_duplicate.reuse_result(msg, content, match, language)
+            _save_result(db, msg, result_data, style, model)
+            near_duplicate.record(db, msg, match, adapted)
+            await db.commit()
+            return
+
+        # 一次 LLM call 拿齊所有資料（llm_service 已正規化型別）；相同內容先查快取
+        result_data = await llm_cache.analyze_email(
+            db, llm, content, style=style, model=model, language=language
+        )
+        _save_result(db, msg, result_data, style, model)
+        if fp:
+            await near_duplicate.add(db, msg, fp)
+        await db.commit()
+
+        logger.info(f"信件 {msg.id} 分析完成（urgency={msg.urgency_score}，"
+                    f"model={model}，ms={result_data.get('generation_ms')}，"
+                    f"cached={result_data.get('cached', False)}）")
+
+
+def _pack_batches(items: list[tuple], model: str) -> list[list[tuple]]:
+    """依 token 預算與筆數上限把 (msg, content, key) 依序裝成批次"""
+    batches, current, tokens = [], [], 0
+    for item in items:
+        item_tokens = count_tokens(item[1], model)
+        if current and (
+            tokens + item_tokens > settings.analysis_batch_token_budget
+            or len(current) >= settings.analysis_batch_max_items
+        ):
+            batches.append(current)
+            current, tokens = [], 0
+        current.append(item)
+        tokens += item_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def _analyze_short_messages(
+    message_ids: list, llm: LLMService
+) -> set:
+    """
+    積壓時的批次分析：短信件依 (model, style, language) 分組，多封打包成一次 LLM call
+
+    回傳已完成（含快取命中）的信件 id；其餘（長信、批次失敗或結果不合格的項目）
+    由呼叫端改走單封分析。
+    """
+    done: set = set()
+    async with AsyncSessionLocal() as db:
+        messages = (await db.execute(_message_query(message_ids))).scalars().all()
+        # 沒有在這裡完成的信件會在單封分析再分流一次，metrics 只記錄這裡完成的
+        decisions = await pretriage.evaluate(db, messages, record_metrics=False)
+
+        groups: dict[tuple, list] = defaultdict(list)
+        fingerprints: dict = {}
+        for msg in messages:
+            decision = decisions[msg.id]
+            params = _analysis_params(msg, decision)
+            model, style, language = params
+            if decision.action == "skip":
+                template = pretriage.template_result(msg, decision, language)
+                _save_result(db, msg, template, style, model)
+                pretriage.record(decision)
+                done.add(msg.id)
+                continue
+
+            content = message_body.analysis_content(msg) or msg.subject or ""
+            fp = near_duplicate.fingerprint(msg, content) if content else None
+            if fp:
+                match = await near_duplicate.find_match(db, msg.id, fp)
+                if match:
+                    result_data, adapted = near_duplicate.reuse_result(
+                        msg, content, match, language
+                    )
+                    _save_result(db, msg, result_data, style, model)
+                    near_duplicate.record(db, msg, match, adapted)
+                    pretriage.record(decision)
+                    done.add(msg.id)
+                    continue
+                # 同一批裡彼此相似的信件只送第一封，其餘留給單封分析（屆時可沿用這封的結果）
+                if any(near_duplicate.is_near(fp, other) for other in fingerprints.values()):
+                    continue
+                fingerprints[msg.id] = fp
+
+            too_long = count_tokens(content, model) > settings.analysis_batch_item_max_tokens
+            if not content or too_long:
+                continue
+            key = llm_cache.cache_key(content, style, model, language)
+            cached = await llm_cache.get(db, key)
+            if cached is not None:
+                cached_result = {**cached, "tokens_used": 0, "generation_ms": 0}
+                _save_result(db, msg, cached_result, style, model)
+                if fp:
+                    await near_duplicate.add(db, msg, fp)
+                pretriage.record(decision)
+                done.add(msg.id)
+                continue
+            groups[params].append((msg, content, key))
+
+        async def run_batch(params, batch):
+            model, style, language = params
+            return await llm.analyze_emails_batch(
+                [(str(msg.id), content) for msg, content, _ in batch],
+                style=style, model=model, language=language,
+            )
+
+        jobs = [
+            (params, batch)
+            for params, items in groups.items()
+            for batch in _pack_batches(items, params[0])
+        ]
+        # 只有一封的批次沒有節省，留給單封分析
+        jobs = [(params, batch) for params, batch in jobs if len(batch) > 1]
+        outcomes = await asyncio.gather(
+            *(run_batch(params, batch) for params, batch in jobs), return_exceptions=True
+        )
+
+        # LLM 呼叫並行完成後，才在同一個 session 依序寫回
+        for (params, batch), outcome in zip(jobs, outcomes):
+            model, style, _ = params
+            metrics.incr("analysis.batch_calls")
+            if isinstance(outcome, Exception):
+                metrics.incr("analysis.batch_fallbacks", len(batch))
+                logger.warning(f"批次分析 {len(batch)} 封失敗，改為單封分析：{outcome}")
+                continue
+            for msg, _, key in batch:
+                result_data = outcome.get(str(msg.id))
+                if result_data is None:
+                    metrics.incr("analysis.batch_fallbacks")
+                    continue
+                _save_result(db, msg, result_data, style, model)
+                await llm_cache.put(db, key, result_data)
+                if msg.id in fingerprints:
+                    await near_duplicate.add(db, msg, fingerprints[msg.id])
+                pretriage.record(decisions[msg.id])
+                done.add(msg.id)
+                metrics.incr("analysis.batch_items")
+
+        await db.commit()
+
+    if done:
+        logger.info(f"批次分析完成 {len(done)} 封（{len(jobs)} 次 LLM call）")
+    return done
+
+
+async def analyze_new_messages(message_ids: list) -> list:
+    """
+    對一批信件執行 LLM 分析（並行；各模型同時進行的 LLM 請求數由 llm_limiter 控制）
+
+    積壓達 analysis_batch_min_backlog 封時，短信件先打包批次分析，其餘單封分析。
+    回傳與 message_ids 對應的結果：None 代表成功，例外代表失敗。
+    """
+    if not message_ids:
+        return []
+
+    # 分析前先補齊內文（metadata-first 同步只存了標頭；同帳號一次 batch 下載）
+    try:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(EmailMessage)
+                .where(
+                    EmailMessage.id.in_(message_ids),
+                    EmailMessage.body_fetched_at == None,  # noqa: E711
+                )
+                .options(selectinload(EmailMessage.account))
+            )
+            await message_body.ensure_bodies(db, result.scalars().all())
+            await db.commit()
+    except Exception:
+        logger.error("預先下載信件內文失敗，將以 snippet 分析", exc_info=True)
+
+    llm = LLMService()
+
+    done: set = set()
+    if settings.analysis_batch_enabled and len(message_ids) >= settings.analysis_batch_min_backlog:
+        try:
+            done = await _analyze_short_messages(message_ids, llm)
+        except Exception:
+            logger.error("批次分析失敗，全部改為單封分析", exc_info=True)
+
+    remaining = [msg_id for msg_id in message_ids if msg_id not in done]
+    logger.info(f"開始並行分析 {len(remaining)} 封信件")
+    single = await asyncio.gather(
+        *[_analyze_single_message(msg_id, llm) for msg_id in remaining],
+        return_exceptions=True,  # 單封失敗不中斷其他封
+    )
+    by_id = dict(zip(remaining, single))
+    outcomes = [by_id.get(msg_id) for msg_id in message_ids]
+    for msg_id, outcome in zip(message_ids, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"信件 {msg_id} 分析失敗", exc_info=outcome)
+    logger.info(f"分析完成，共 {len(message_ids)} 封")
+    return outcomes
+
+
+async def drain_analysis_queue(stop_event: asyncio.Event):
+    """持續認領並分析佇列中的工作，直到 stop_event 被設定"""
+    while not stop_event.is_set():
+        try:
+            jobs = await analysis_queue.claim(settings.analysis_claim_batch)
+        except Exception:
+            logger.error("認領分析工作失敗，稍後重試", exc_info=True)
+            jobs = []
+
+        if not jobs:
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.analysis_poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        outcomes = await analyze_new_messages([job.message_id for job in jobs])
+
+        # 回寫失敗時工作維持 running，超過 lock timeout 後會被重新認領
+        try:
+            await analysis_queue.complete([
+                job for job, outcome in zip(jobs, outcomes)
+                if not isinstance(outcome, Exception)
+            ])
+            for job, outcome in zip(jobs, outcomes):
+                if isinstance(outcome, Exception):
+                    await analysis_queue.fail(job, outcome)
+        except Exception:
+            logger.error("更新分析工作狀態失敗", exc_info=True)
+
+
+async def prune_llm_cache():
+    """清理 LLM 結果快取的過期 / 最久未用項目"""
+    async with AsyncSessionLocal() as db:
+        removed = await llm_cache.prune(db)
+    if removed:
+        logger.info(f"清理 {removed} 筆 LLM 快取")
+
+
+async def main():
+    """獨立的分析 process（水平擴充用）"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    logger.info("✅ 分析 Worker 啟動")
+    await drain_analysis_queue(stop_event)
+    logger.info("分析 Worker 已停止")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    )
+    asyncio.run(main())
@@ -0,0 +1,189 @@
+"""
+Gmail 歷史信件回填 Worker
+
+首次同步只抓收件匣最近 50 封；這裡在背景逐頁讀取 messages.list，把整個信箱的
+歷史信件補進 DB，搜尋與 Topic 才會涵蓋舊信：
+  - 每頁寫入後把 nextPageToken 存回 email_sync_states，重啟後從斷點續跑
+  - 使用 kind="backfill" 的 lease，與增量同步的 lease 互不阻塞
+  - 依 backfill_quota_share 節流，只使用 Gmail per-user 配額的一部分
+  - 只抓 metadata 並批次寫入；回填的信件以最低優先排入分析佇列
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.database import AsyncSessionLocal
+from app.models.email import EmailAccount, EmailSyncState
+from app.services import analysis_queue, gmail_service, sync_lease
+from app.services.gmail_client import client_for_account
+from app.workers.email_sync import (
+    _bulk_insert_messages,
+    _classify_messages_to_topics,
+    _filter_known_messages,
+)
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+async def backfill_accounts():
+    """挑出尚未完成回填的 Gmail 帳號，各自處理最多 backfill_pages_per_run 頁"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(EmailAccount.id)
+            .join(EmailSyncState, EmailSyncState.account_id == EmailAccount.id)
+            .where(
+                EmailAccount.provider == "gmail",
+                EmailAccount.is_active == True,  # noqa: E712
+                EmailAccount.sync_enabled == True,  # noqa: E712
+                EmailAccount.quarantined_at == None,  # noqa: E711
+                # 首次同步完成（有 history_id）後才開始回填
+                EmailSyncState.last_history_id != None,  # noqa: E711
+                EmailSyncState.backfill_completed_at == None,  # noqa: E711
+            )
+            .order_by(EmailSyncState.updated_at)
+            .limit(settings.backfill_max_accounts)
+        )
+        account_ids = result.scalars().all()
+
+    if not account_ids:
+        return
+
+    outcomes = await asyncio.gather(
+        *(backfill_account(account_id) for account_id in account_ids), return_exceptions=True
+    )
+    for account_id, outcome in zip(account_ids, outcomes):
+        if isinstance(outcome, Exception):
+            metrics.incr("backfill.account_errors")
+            logger.error(f"帳號 {account_id} 歷史信件回填失敗", exc_info=outcome)
+
+
+async def backfill_account(account_id) -> int:
+    """回填單一帳號的歷史信件，回傳本次寫入的信件數；已有其他回填在跑時略過"""
+    lease = await sync_lease.acquire(account_id, kind="backfill")
+    if lease is None:
+        return 0
+
+    async with lease:
+        return await _backfill_locked(account_id, lease)
+
+
+async def _backfill_locked(account_id, lease: sync_lease.SyncLease) -> int:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(EmailAccount)
+            .where(EmailAccount.id == account_id)
+            .options(
+                selectinload(EmailAccount.sync_state),
+                selectinload(EmailAccount.user),
+            )
+        )
+        account = result.scalar_one_or_none()
+        if not account or not account.sync_state or account.sync_state.backfill_completed_at:
+            return 0
+
+        client = await client_for_account(account)
+        if not client:
+            return 0
+
+        workspace_id = account.user.workspace_id if account.user else None
+        page_token = account.sync_state.backfill_page_token
+        # 回填可使用的配額（units / 秒），其餘留給增量同步與使用者操作
+        units_per_second = max(
+            1.0, settings.gmail_user_quota_units_per_second * settings.backfill_quota_share
+        )
+        total = 0
+
+        for _ in range(settings.backfill_pages_per_run):
+            started = time.monotonic()
+            try:
+                ids, next_token = await client.list_messages_page(
+                    page_token, page_size=settings.backfill_page_size, query=settings.backfill_query
+                )
+            except Exception as e:
+                if page_token and gmail_service.is_invalid_page_token(e):
+                    # 已寫入的信件會被 _filter_known_messages 濾掉，從頭列出只花 list 配額
+                    logger.warning(
+                        f"帳號 {account.email_address} 的回填 pageToken 已失效，從頭重新列出"
+                    )
+                    page_token = None
+                    continue
+                raise
+
+            to_fetch = await _filter_known_messages(db, account.id, ids)
+            details, failed_ids = await client.get_message_details_batch(
+                to_fetch, format=settings.gmail_sync_format
+            )
+            if failed_ids:
+                metrics.incr("backfill.failed_messages", len(failed_ids))
+                logger.warning(
+                    f"帳號 {account.email_address} 回填時有 {len(failed_ids)} 封信件取得失敗"
+                )
+
+            new_messages = await _bulk_insert_messages(db, account.id, workspace_id, details)
+            await _classify_messages_to_topics(db, new_messages, account.user_id)
+            if settings.backfill_analyze:
+                await analysis_queue.enqueue(
+                    db, [m.id for m in new_messages], priority=analysis_queue.PRIORITY_BACKFILL
+                )
+
+            # 信件與斷點同一個 transaction commit，重啟後不會漏頁也不會重抓
+            await _checkpoint(db, account.id, lease, next_token, len(new_messages))
+            await db.commit()
+
+            total += len(new_messages)
+            metrics.incr("backfill.messages", len(new_messages))
+            metrics.incr("backfill.pages")
+
+            if not next_token:
+                logger.info(f"帳號 {account.email_address} 歷史信件回填完成")
+                break
+            page_token = next_token
+
+            # 節流：這一頁用掉的 units 依配額比例攤到時間上
+            units = (
+                gmail_service.QUOTA_UNITS["messages.list"]
+                + gmail_service.QUOTA_UNITS["messages.get"] * len(to_fetch)
+            )
+            await asyncio.sleep(max(0.0, units / units_per_second - (time.monotonic() - started)))
+
+    if total:
+        logger.info(f"帳號 {account_id} 回填了 {total} 封歷史信件")
+    return total
+
+
+async def _checkpoint(
+    db: AsyncSession, account_id, lease: sync_lease.SyncLease, next_token: str | None, added: int
+) -> None:
+    """寫入回填斷點；fence 已被更新的持有者取代時放棄這一頁的寫入"""
+    lease.check()
+    values = {
+        "backfill_page_token": next_token,
+        "backfill_count": EmailSyncState.backfill_count + added,
+        "backfill_fence": lease.fence,
+    }
+    if not next_token:
+        values["backfill_completed_at"] = datetime.utcnow()
+
+    result = await db.execute(
+        update(EmailSyncState)
+        .where(
+            EmailSyncState.account_id == account_id,
+            or_(
+                EmailSyncState.backfill_fence == None,  # noqa: E711
+                EmailSyncState.backfill_fence <= lease.fence,
+            ),
+        )
+        .values(**values)
+    )
+    if result.rowcount == 0:
+        raise sync_lease.LeaseLostError(
+            f"帳號 {account_id} 的回填 fence {lease.fence} 已過期，放棄本頁寫入"
+        )
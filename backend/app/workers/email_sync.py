@@ -1,23 +1,34 @@
 """
 Email 同步 Worker
 - 定時從 Gmail/IMAP 同步新信件
-- 觸發 LLM 摘要分析
+- 新信件排入 LLM 分析佇列（由 app.workers.analysis 消化）
 """
 import asyncio
-import json
+import contextlib
 import logging
-from datetime import datetime
-from sqlalchemy import select, desc
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, delete, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
+from app.core import metrics
+from app.core.config import get_settings
 from app.core.database import AsyncSessionLocal
 from app.models.email import EmailAccount, EmailMessage, EmailSyncState
-from app.models.topic import Topic, EmailTopic
+from app.models.topic import EmailTopic
 from app.models.summary import EmailSummary
-from app.services import gmail_service, crypto_service
-from app.services.llm_service import LLMService
-
+from app.models.analysis import AnalysisJob, NearDuplicateMatch, SimhashEntry
+from app.services import (
+    analysis_queue, body_store, gmail_service, imap_service, llm_cache, llm_limiter, sync_lease,
+    sync_queue, topic_matcher,
+)
+from app.services.gmail_client import client_for_account, refresh_account_token
+
+settings = get_settings()
 logger = logging.getLogger(__name__)
 
 # ── 本地模型前綴：Ollama 沒有啟動時自動降級到雲端模型 ─────────────
@@ -36,73 +47,408 @@ def _resolve_model(model: str) -> str:
     return model
 
 
-async def _classify_email_to_topics(db: AsyncSession, msg: EmailMessage, user_id) -> None:
-    """依照 Topic 的 auto_rules 將信件自動歸類到對應集合"""
-    result = await db.execute(
-        select(Topic).where(
-            Topic.user_id == user_id,
-            Topic.is_active == True,  # noqa: E712
-            Topic.auto_rules != None,  # noqa: E711
-        )
+async def _classify_messages_to_topics(
+    db: AsyncSession, messages: list[EmailMessage], user_id
+) -> None:
+    """依照 Topic 的 auto_rules 將一批信件自動歸類（單次比對 + 單次批次寫入）"""
+    if not messages:
+        return
+
+    matcher = await topic_matcher.get_matcher(db, user_id)
+    if matcher.is_empty:
+        return
+
+    rows = [
+        {"topic_id": topic_id, "message_id": msg.id, "is_manual": False, "confidence": 0.9}
+        for msg in messages
+        for topic_id in matcher.match(msg.sender, msg.subject, msg.labels)
+    ]
+    if rows:
+        await db.execute(pg_insert(EmailTopic).values(rows).on_conflict_do_nothing())
+
+
+# ── 同步並行上限（排程輪詢與 push 觸發的同步共用） ───────────────
+_global_limit = asyncio.Semaphore(settings.sync_max_concurrency)
+_user_limits: dict = defaultdict(
+    lambda: asyncio.Semaphore(settings.sync_per_user_concurrency)
+)
+
+
+def _next_interval(account: EmailAccount, new_count: int, now: datetime) -> int:
+    """
+    成功同步後的下次間隔：有新信縮到最短、閒置逐步放寬
+
+    只有 Gmail 帳號且 watch 尚未過期（push 會即時觸發同步）時固定為安全網輪詢；
+    IMAP 帳號、watch 註冊失敗或已過期的 Gmail 帳號仍用自適應間隔。
+    """
+    sync_state = account.sync_state
+    if (
+        account.provider == "gmail"
+        and sync_state is not None
+        and sync_state.watch_expires_at is not None
+        and sync_state.watch_expires_at > now
+    ):
+        return settings.sync_safety_poll_seconds
+    if new_count > 0:
+        return settings.sync_min_interval_seconds
+    return min(
+        settings.sync_max_interval_seconds,
+        int((account.sync_interval_seconds or settings.sync_interval_seconds) * 1.5),
     )
-    topics = result.scalars().all()
-    if not topics:
+
+
+async def _record_sync_result(account_id, new_count: int, error: Exception | None) -> None:
+    """更新帳號的下次同步時間、失敗次數與隔離狀態"""
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        account = await db.get(
+            EmailAccount, account_id, options=[selectinload(EmailAccount.sync_state)]
+        )
+        if not account:
+            return
+
+        if error is None:
+            account.sync_interval_seconds = _next_interval(account, new_count, now)
+            account.sync_failures = 0
+            account.next_sync_at = now + timedelta(seconds=account.sync_interval_seconds)
+        else:
+            account.sync_failures = (account.sync_failures or 0) + 1
+            account.sync_error = f"{type(error).__name__}: {error}"[:1000]
+            backoff = min(
+                settings.sync_backoff_max_seconds,
+                settings.sync_backoff_base_seconds * 2 ** (account.sync_failures - 1),
+            )
+            account.next_sync_at = now + timedelta(seconds=backoff)
+
+            persistent = (
+                gmail_service.is_auth_error(error)
+                or gmail_service.is_quota_error(error)
+                or imap_service.is_auth_error(error)
+            )
+            if persistent and account.sync_failures >= settings.sync_quarantine_after:
+                account.quarantined_at = now
+                metrics.incr("sync.accounts_quarantined")
+                logger.error(
+                    f"帳號 {account.email_address} 連續失敗 {account.sync_failures} 次，已隔離"
+                    f"（重新授權後恢復）：{account.sync_error}"
+                )
+
+        await db.commit()
+
+
+async def _account_user_id(account_id):
+    """查詢帳號所屬的用戶（佇列請求沒有帶 user_id 時使用）"""
+    try:
+        async with AsyncSessionLocal() as db:
+            return await db.scalar(
+                select(EmailAccount.user_id).where(EmailAccount.id == account_id)
+            )
+    except Exception:
+        logger.warning(f"查詢帳號 {account_id} 的用戶失敗", exc_info=True)
+        return None
+
+
+async def _run_limited_sync(account_id, user_id=None) -> float:
+    """在全域 / 單一用戶並行上限內同步一個帳號，並更新排程；回傳耗時（秒）"""
+    if user_id is None:
+        user_id = await _account_user_id(account_id)
+    # 查不到用戶時只受全域上限限制，不讓無關的帳號共用同一個用戶額度
+    user_limit = _user_limits[user_id] if user_id is not None else contextlib.nullcontext()
+    # 先取得用戶額度再佔全域額度，避免同一用戶的帳號排隊時卡住全域名額
+    async with user_limit, _global_limit:
+        start = time.monotonic()
+        new_count, error = 0, None
+        try:
+            new_count = await sync_account(account_id)
+        except Exception as e:
+            error = e
+            metrics.incr("sync.account_errors")
+            logger.error(f"帳號同步失敗 (id={account_id})", exc_info=True)
+        finally:
+            elapsed = time.monotonic() - start
+            metrics.observe("sync.account_seconds", elapsed)
+
+        # lease 被其他地方持有：排程由持有者寫入，這裡不動 next_sync_at / 間隔
+        if new_count is None:
+            return elapsed
+        try:
+            await _record_sync_result(account_id, new_count, error)
+        except Exception:
+            logger.error(f"更新帳號排程失敗 (id={account_id})", exc_info=True)
+        return elapsed
+
+
+async def sync_all_accounts():
+    """
+    同步所有到期的帳號（next_sync_at <= now，走 partial index）
+
+    - 全域上限 sync_max_concurrency，單一用戶上限 sync_per_user_concurrency
+    - 記錄每個帳號的同步耗時；回報到期帳號被延遲的時間（lag）
+    """
+    cycle_start = time.monotonic()
+    now = datetime.utcnow()
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(EmailAccount.id, EmailAccount.user_id, EmailAccount.next_sync_at)
+            .where(
+                EmailAccount.is_active == True,
+                EmailAccount.sync_enabled == True,
+                EmailAccount.quarantined_at == None,  # noqa: E711
+                EmailAccount.next_sync_at <= now,
+            )
+            .order_by(EmailAccount.next_sync_at)
+            .limit(settings.sync_max_due_per_tick)
+        )
+        accounts = result.all()
+
+    if not accounts:
+        metrics.set_gauge("sync.schedule_lag_seconds", 0)
         return
 
-    sender_lower = (msg.sender or "").lower()
-    subject_lower = (msg.subject or "").lower()
-    msg_labels = [lb.lower() for lb in (msg.labels or [])]
+    # 最早到期的帳號等了多久才被排到
+    lag = (now - accounts[0].next_sync_at).total_seconds()
+    metrics.set_gauge("sync.schedule_lag_seconds", lag)
+    logger.info(f"開始同步 {len(accounts)} 個到期帳號（lag={lag:.1f}s）")
 
-    for topic in topics:
+    elapsed = await asyncio.gather(*[_run_limited_sync(a.id, a.user_id) for a in accounts])
+    durations = dict(zip([a.id for a in accounts], elapsed))
+
+    cycle_seconds = time.monotonic() - cycle_start
+    overrun = max(0.0, cycle_seconds - settings.sync_tick_seconds)
+    metrics.observe("sync.cycle_seconds", cycle_seconds)
+    metrics.set_gauge("sync.cycle_lag_seconds", overrun)
+
+    if overrun > 0:
+        slowest = sorted(durations.items(), key=lambda kv: kv[1], reverse=True)[:3]
+        logger.warning(
+            f"同步週期超時：耗時 {cycle_seconds:.1f}s，超過排程間隔 "
+            f"{settings.sync_tick_seconds}s（lag={overrun:.1f}s），最慢帳號："
+            + ", ".join(f"{aid}={sec:.1f}s" for aid, sec in slowest)
+        )
+    else:
+        logger.info(f"同步週期完成：{len(accounts)} 個帳號，耗時 {cycle_seconds:.1f}s")
+
+
+async def consume_sync_requests(stop_event: asyncio.Event):
+    """
+    消化 Redis 同步佇列（push 通知 / OAuth callback 觸發的單一帳號同步）
+
+    每個請求各自在並行上限內執行，不會阻塞佇列的讀取。
+    """
+    tasks: set[asyncio.Task] = set()
+    while not stop_event.is_set():
         try:
-            rules = json.loads(topic.auto_rules)
+            request = await sync_queue.next_request(timeout=5)
         except Exception:
+            logger.error("讀取同步佇列失敗，5 秒後重試", exc_info=True)
+            await asyncio.sleep(5)
+            continue
+        if not request:
             continue
 
-        matched = any(p.lower() in sender_lower for p in rules.get("senders", []))
-        if not matched:
-            matched = any(k.lower() in subject_lower for k in rules.get("subject_contains", []))
-        if not matched:
-            matched = any(lb.lower() in msg_labels for lb in rules.get("labels", []))
-
-        if matched:
-            existing = await db.execute(
-                select(EmailTopic).where(
-                    EmailTopic.topic_id == topic.id,
-                    EmailTopic.message_id == msg.id,
+        metrics.incr("sync.push_requests")
+        user_id = uuid.UUID(request["user_id"]) if request.get("user_id") else None
+        task = asyncio.create_task(
+            _run_limited_sync(uuid.UUID(request["account_id"]), user_id)
+        )
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def watch_imap_accounts(stop_event: asyncio.Event):
+    """
+    對啟用中的 IMAP 帳號維持 IDLE 監聽，新信到達時加入同步佇列
+
+    每 10 分鐘重新載入帳號清單，接上新加入的帳號。每條 IDLE 連線佔一個 thread，
+    最多 imap_idle_max_connections 條；超過的帳號不監聽，仍由 sync_all_accounts 排程輪詢。
+    """
+    watchers: dict = {}
+    tasks: set[asyncio.Task] = set()
+
+    while not stop_event.is_set():
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(EmailAccount).where(
+                        EmailAccount.provider == "imap",
+                        EmailAccount.is_active == True,  # noqa: E712
+                        EmailAccount.sync_enabled == True,  # noqa: E712
+                        EmailAccount.quarantined_at == None,  # noqa: E711
+                    )
+                    .order_by(EmailAccount.created_at)
                 )
-            )
-            if not existing.scalar_one_or_none():
-                db.add(EmailTopic(
-                    topic_id=topic.id,
-                    message_id=msg.id,
-                    is_manual=False,
-                    confidence=0.9,
-                ))
+                accounts = result.scalars().all()
+
+            active_ids = {a.id for a in accounts}
+            for account_id in list(watchers):
+                if account_id not in active_ids:
+                    watchers.pop(account_id).set()
+
+            over_cap = 0
+            for account in accounts:
+                if account.id in watchers or not account.imap_host:
+                    continue
+                if len(watchers) >= settings.imap_idle_max_connections:
+                    over_cap += 1
+                    continue
+                account_stop = asyncio.Event()
+                watchers[account.id] = account_stop
+
+                async def on_new_mail(account_id=account.id, user_id=account.user_id):
+                    metrics.incr("sync.imap_idle_notifications")
+                    await sync_queue.request_sync(account_id, user_id)
+
+                task = asyncio.create_task(
+                    imap_service.idle_watch(account, on_new_mail, account_stop)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            metrics.set_gauge("sync.imap_idle_connections", len(watchers))
+            if over_cap:
+                logger.warning(
+                    f"IMAP IDLE 連線已達上限 {settings.imap_idle_max_connections}，"
+                    f"{over_cap} 個帳號改用排程輪詢"
+                )
+        except Exception:
+            logger.error("更新 IMAP IDLE 監聽清單失敗", exc_info=True)
 
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=600)
+        except asyncio.TimeoutError:
+            pass
 
-async def sync_all_accounts():
-    """同步所有啟用中的帳號"""
+    for account_stop in watchers.values():
+        account_stop.set()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def close_idle_imap_connections():
+    """關閉 pool 中閒置過久的 IMAP 連線"""
+    loop = asyncio.get_running_loop()
+    closed = await loop.run_in_executor(None, imap_service.close_idle_connections)
+    if closed:
+        logger.info(f"關閉 {closed} 條閒置的 IMAP 連線")
+
+
+async def refresh_expiring_tokens():
+    """在 access token 到期前背景 refresh 並寫回 DB，讓同步流程不必等待 Token endpoint"""
+    threshold = datetime.utcnow() + timedelta(seconds=settings.token_refresh_margin_seconds)
     async with AsyncSessionLocal() as db:
         result = await db.execute(
             select(EmailAccount).where(
-                EmailAccount.is_active == True,
-                EmailAccount.sync_enabled == True,
+                EmailAccount.provider == "gmail",
+                EmailAccount.is_active == True,  # noqa: E712
+                EmailAccount.quarantined_at == None,  # noqa: E711
+                EmailAccount.encrypted_refresh_token != None,  # noqa: E711
+                or_(
+                    EmailAccount.token_expires_at == None,  # noqa: E711
+                    EmailAccount.token_expires_at < threshold,
+                ),
             )
         )
         accounts = result.scalars().all()
-        account_ids = [a.id for a in accounts]
-        logger.info(f"開始同步 {len(account_ids)} 個帳號")
 
-    for account_id in account_ids:
-        try:
-            await sync_account(account_id)
-        except Exception as e:
-            logger.error(f"帳號同步失敗 (id={account_id})", exc_info=True)
+    if not accounts:
+        return
+
+    results = await asyncio.gather(
+        *(refresh_account_token(account) for account in accounts), return_exceptions=True
+    )
+    failed = 0
+    for account, outcome in zip(accounts, results):
+        if isinstance(outcome, Exception):
+            failed += 1
+            logger.warning(f"帳號 {account.email_address} 預先 refresh Token 失敗：{outcome}")
+    refreshed = sum(1 for r in results if r is True)
+    logger.info(f"預先 refresh {refreshed} 個帳號的 Token（失敗 {failed}）")
 
 
-async def sync_account(account_id):
-    """同步單一帳號的信件"""
+async def log_worker_metrics():
+    """記錄同步 / 分析佇列深度、LLM 快取命中率、各模型並行上限與 Worker process 指標"""
+    async with AsyncSessionLocal() as db:
+        analysis = await analysis_queue.stats(db)
+    sync_depth = await sync_queue.queue_depth()
+    metrics.set_gauge("sync_queue.depth", sync_depth)
+    cache = await llm_cache.stats()
+    logger.info(
+        f"佇列：分析 pending={analysis['pending']} running={analysis['running']} "
+        f"dead={analysis['dead']} 最舊等待 {analysis['oldest_pending_seconds']:.0f}s；"
+        f"同步請求 {sync_depth}；LLM 快取命中率 {cache['hit_rate']:.1%}"
+    )
+    logger.info(f"LLM 並行上限：{llm_limiter.stats()}")
+    logger.info(f"metrics: {metrics.snapshot()}")
+
+
+async def renew_gmail_watches():
+    """為 watch 未註冊或一天內到期的 Gmail 帳號註冊 / 續約 push 通知"""
+    if not settings.gmail_push_topic:
+        return
+
+    renew_before = datetime.utcnow() + timedelta(days=1)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(EmailAccount)
+            .outerjoin(EmailSyncState, EmailSyncState.account_id == EmailAccount.id)
+            .where(
+                EmailAccount.provider == "gmail",
+                EmailAccount.is_active == True,  # noqa: E712
+                EmailAccount.sync_enabled == True,  # noqa: E712
+                or_(
+                    EmailSyncState.watch_expires_at == None,  # noqa: E711
+                    EmailSyncState.watch_expires_at < renew_before,
+                ),
+            )
+            .options(selectinload(EmailAccount.sync_state))
+        )
+        accounts = result.scalars().all()
+
+        for account in accounts:
+            try:
+                client = await client_for_account(account)
+                if not client:
+                    continue
+                watch = await client.watch(settings.gmail_push_topic)
+            except Exception:
+                logger.error(f"Gmail watch 註冊失敗 ({account.email_address})", exc_info=True)
+                continue
+
+            if account.sync_state:
+                account.sync_state.watch_expires_at = watch["expires_at"]
+            else:
+                # 尚未同步過：history_id 留空，讓第一次同步做全量同步
+                db.add(EmailSyncState(account_id=account.id, watch_expires_at=watch["expires_at"]))
+
+        await db.commit()
+
+    if accounts:
+        logger.info(f"已註冊 / 續約 {len(accounts)} 個帳號的 Gmail watch")
+
+
+async def sync_account(account_id) -> int | None:
+    """
+    同步單一帳號的信件，回傳新信件數
+
+    以 Redis lease 保證同一帳號在所有 replica 中同時只有一個同步在跑；
+    已被持有時直接略過並回傳 None（持有者會處理同一批信件並更新排程）。
+    """
+    lease = await sync_lease.acquire(account_id)
+    if lease is None:
+        metrics.incr("sync.lease_busy")
+        logger.info(f"帳號 {account_id} 正在其他地方同步，略過")
+        return None
+
+    async with lease:
+        return await _sync_account_locked(account_id, lease)
+
+
+async def _sync_account_locked(account_id, lease: sync_lease.SyncLease) -> int:
+    """持有 lease 時執行的同步流程"""
     async with AsyncSessionLocal() as db:
         # eager load sync_state 和 user，避免 async lazy loading 問題
         result = await db.execute(
@@ -115,13 +461,15 @@ async def sync_account(account_id):
         )
         account = result.scalar_one_or_none()
         if not account:
-            return
+            return 0
 
         if account.provider == "gmail":
-            new_messages = await _sync_gmail(db, account)
+            new_messages = await _sync_gmail(db, account, lease)
+        elif account.provider == "imap":
+            new_messages = await _sync_imap(db, account, lease)
         else:
             logger.warning(f"尚不支援 provider: {account.provider}")
-            return
+            return 0
 
         # 更新同步時間
         account.last_synced_at = datetime.utcnow()
@@ -130,202 +478,345 @@ async def sync_account(account_id):
 
         logger.info(f"帳號 {account.email_address} 同步了 {len(new_messages)} 封新信")
 
-        # 傳出 message id 清單，在外部另開 session 做 LLM 分析
-        if new_messages:
-            message_ids = [m.id for m in new_messages]
-
-    # ── 補跑：找出還沒有摘要的舊信件（每次最多 20 封） ──────────────
-    # 解決「信件已在 DB 但摘要分析失敗過」的情況
-    async with AsyncSessionLocal() as db:
-        backfill_result = await db.execute(
-            select(EmailMessage.id)
-            .outerjoin(EmailSummary, EmailSummary.message_id == EmailMessage.id)
-            .where(
-                EmailMessage.account_id == account_id,
-                EmailSummary.message_id == None,   # noqa: E711 — SQLAlchemy 需要 ==
-            )
-            .order_by(desc(EmailMessage.received_at))
-            .limit(20)
-        )
-        backfill_ids = backfill_result.scalars().all()
-
-    if backfill_ids:
-        logger.info(f"補跑 {len(backfill_ids)} 封未分析信件")
-
-    # 合併新信 + 補跑清單（去重）
-    new_ids = list(message_ids) if new_messages else []
-    all_ids = new_ids + [i for i in backfill_ids if i not in set(new_ids)]
+    # LLM 分析已在同步的 transaction 內排入 analysis_jobs，由分析 worker 消化
+    return len(new_messages)
 
-    if all_ids:
-        await analyze_new_messages(all_ids)
 
-
-async def _sync_gmail(db: AsyncSession, account: EmailAccount) -> list[EmailMessage]:
+async def _sync_gmail(
+    db: AsyncSession, account: EmailAccount, lease: sync_lease.SyncLease
+) -> list[EmailMessage]:
     """Gmail 增量同步"""
-    # 解密 Token
-    access_token = crypto_service.decrypt(account.encrypted_access_token or "")
-    refresh_token = crypto_service.decrypt(account.encrypted_refresh_token or "")
-
-    if not access_token:
+    # 建立 Gmail Client（所有 Gmail I/O 都在 thread pool，不阻塞 event loop）
+    client = await client_for_account(account)
+    if not client:
         logger.warning(f"帳號 {account.email_address} 沒有 access token")
         return []
 
-    # 建立 Gmail Service
-    service = gmail_service.build_gmail_service(access_token, refresh_token)
-
     # 取得同步狀態（已 eager load）
     sync_state = account.sync_state
     after_history_id = sync_state.last_history_id if sync_state else None
 
-    # 取得新信件清單
-    message_refs = gmail_service.fetch_new_messages(
-        service,
+    # 取得信箱變更（新增 / 刪除 / 標籤變更，history 過期時自動全量重新同步）
+    changes = await client.fetch_changes(
         max_results=50,
         after_history_id=after_history_id,
     )
 
+    # 標籤與刪除直接套用到既有信件，不需要重新抓內容
+    await _apply_label_updates(db, account.id, changes.label_updates)
+    await _apply_deletions(db, account.id, changes.deleted)
+
     # workspace_id 從已 eager load 的 user 取得
     workspace_id = account.user.workspace_id if account.user else None
 
-    new_messages = []
-    for msg_ref in message_refs:
-        try:
-            # 取得信件詳細內容
-            detail = gmail_service.get_message_detail(service, msg_ref["id"])
-
-            # 檢查是否已存在
-            existing = await db.execute(
-                select(EmailMessage).where(
-                    EmailMessage.account_id == account.id,
-                    EmailMessage.provider_message_id == detail["provider_message_id"],
-                )
-            )
-            if existing.scalar_one_or_none():
-                continue
-
-            # 建立新信件記錄
-            msg = EmailMessage(
-                account_id=account.id,
-                workspace_id=workspace_id,
-                **detail,
-            )
-            db.add(msg)
-            new_messages.append(msg)
+    # 一次 IN 查詢濾掉 DB 已有的信件，避免重複抓內容
+    to_fetch = await _filter_known_messages(db, account.id, changes.added)
 
-        except Exception:
-            logger.error(f"取得信件 {msg_ref['id']} 失敗", exc_info=True)
+    # 批次取得信件（每批最多 100 封，只重試失敗的子請求）
+    # metadata-first：預設只取標頭，內文等分析或開啟詳情時才下載
+    details, failed_ids = await client.get_message_details_batch(
+        to_fetch, format=settings.gmail_sync_format
+    )
+    if failed_ids:
+        logger.error(f"帳號 {account.email_address} 有 {len(failed_ids)} 封信件取得失敗")
 
-    await db.flush()
+    # 批次寫入（ON CONFLICT DO NOTHING），併發同步同一帳號也不會重複
+    new_messages = await _bulk_insert_messages(db, account.id, workspace_id, details)
 
     # 自動分類：將新信件歸入符合規則的 Topic
-    for msg in new_messages:
-        await _classify_email_to_topics(db, msg, account.user_id)
+    await _classify_messages_to_topics(db, new_messages, account.user_id)
+
+    # 排入分析佇列（與信件同一個 transaction commit）
+    await analysis_queue.enqueue(
+        db,
+        [m.id for m in new_messages],
+        priority=(
+            analysis_queue.PRIORITY_BACKFILL if changes.full_resync else analysis_queue.PRIORITY_NEW
+        ),
+    )
 
-    # 更新同步狀態
-    latest_history_id = gmail_service.get_latest_history_id(service)
+    # 更新同步狀態（history_id 直接取自 history 回應）
+    latest_history_id = changes.history_id
     if sync_state:
+        await _claim_fence(db, account.id, lease)
         sync_state.last_history_id = latest_history_id
         sync_state.last_synced_at = datetime.utcnow()
     else:
-        sync_state = EmailSyncState(
-            account_id=account.id,
-            last_history_id=latest_history_id,
+        await _insert_fenced_state(db, account.id, lease, last_history_id=latest_history_id)
+
+    await db.commit()
+    return new_messages
+
+
+async def _sync_imap(
+    db: AsyncSession, account: EmailAccount, lease: sync_lease.SyncLease
+) -> list[EmailMessage]:
+    """IMAP 增量同步（UID / CONDSTORE，連線跨週期重用）"""
+    if not account.imap_host or not account.encrypted_access_token:
+        logger.warning(f"帳號 {account.email_address} 缺少 IMAP 連線設定")
+        return []
+
+    client = imap_service.AsyncImapClient(account)
+    sync_state = account.sync_state
+
+    changes = await client.fetch_changes(
+        last_uidvalidity=sync_state.last_uidvalidity if sync_state else None,
+        last_uidnext=sync_state.last_uidnext if sync_state else None,
+        last_modseq=sync_state.last_modseq if sync_state else None,
+        max_results=50,
+    )
+
+    # UIDVALIDITY 改變：舊 UID 全部失效，先移除舊 UID 建立的信件再重新同步
+    previous_uidvalidity = sync_state.last_uidvalidity if sync_state else None
+    if previous_uidvalidity and previous_uidvalidity != changes.uidvalidity:
+        stale_prefix = f"{client.folder}:{sync_state.last_uidvalidity}:"
+        result = await db.execute(
+            select(EmailMessage.provider_message_id).where(
+                EmailMessage.account_id == account.id,
+                EmailMessage.provider_message_id.startswith(stale_prefix),
+            )
         )
-        db.add(sync_state)
+        await _apply_deletions(db, account.id, list(result.scalars().all()))
+        logger.warning(f"帳號 {account.email_address} 的 UIDVALIDITY 已改變，重新同步")
+
+    # 伺服器上已刪除的信件（QRESYNC VANISHED / UID SEARCH ALL 比對）
+    if not changes.full_resync:
+        await _apply_deletions(
+            db, account.id, await _imap_deleted_ids(db, account.id, client.folder, changes)
+        )
+
+    # 旗標變更直接套用，不需要重新抓內容
+    await _apply_label_updates(db, account.id, changes.label_updates)
+
+    workspace_id = account.user.workspace_id if account.user else None
+
+    by_pid = {
+        imap_service.provider_message_id(client.folder, changes.uidvalidity, uid): uid
+        for uid in changes.new_uids
+    }
+    to_fetch = await _filter_known_messages(db, account.id, list(by_pid))
+    details = await client.fetch_messages(changes.uidvalidity, [by_pid[pid] for pid in to_fetch])
+
+    new_messages = await _bulk_insert_messages(db, account.id, workspace_id, details)
+    await _classify_messages_to_topics(db, new_messages, account.user_id)
+    await analysis_queue.enqueue(
+        db,
+        [m.id for m in new_messages],
+        priority=(
+            analysis_queue.PRIORITY_BACKFILL if changes.full_resync else analysis_queue.PRIORITY_NEW
+        ),
+    )
+
+    # 部分伺服器 SELECT 不回傳 UIDNEXT，改用已見過的最大 UID 推算
+    uidnext = changes.uidnext or (max(changes.new_uids) + 1 if changes.new_uids else None)
+    state_values = {
+        "last_uidvalidity": changes.uidvalidity,
+        "last_uidnext": uidnext or (sync_state.last_uidnext if sync_state else None),
+        "last_modseq": changes.highest_modseq,
+    }
+    if sync_state:
+        await _claim_fence(db, account.id, lease)
+        for key, value in state_values.items():
+            setattr(sync_state, key, value)
+    else:
+        await _insert_fenced_state(db, account.id, lease, **state_values)
 
     await db.commit()
     return new_messages
 
 
-async def _analyze_single_message(msg_id, llm: LLMService, semaphore: asyncio.Semaphore):
-    """分析單封信件（獨立 session，由 semaphore 控制並行數量）"""
-    async with semaphore:
-        async with AsyncSessionLocal() as db:
-            try:
-                # 重新 load 信件（含帳號和 user）
-                result = await db.execute(
-                    select(EmailMessage)
-                    .where(EmailMessage.id == msg_id)
-                    .options(
-                        selectinload(EmailMessage.account).selectinload(EmailAccount.user)
-                    )
-                )
-                msg = result.scalar_one_or_none()
-                if not msg:
-                    logger.warning(f"找不到信件 {msg_id}，跳過")
-                    return
-
-                content = msg.body_plain or msg.snippet or msg.subject or ""
-                if not content:
-                    logger.warning(f"信件 {msg_id} 內容為空，跳過")
-                    return
-
-                account = msg.account
-                user = account.user if account else None
-
-                raw_model = (
-                    account.model_override
-                    or (user.default_model if user else None)
-                    or "claude-haiku"
-                )
-                model = _resolve_model(raw_model)   # 本地模型自動降級
-                style = (user.default_summary_style if user else None) or "bullet_points"
-                language = (user.summary_language if user else None) or "zh-TW"
-
-                # 一次 LLM call 拿齊所有資料（llm_service 已正規化型別）
-                result_data = await llm.analyze_email(
-                    content,
-                    style=style,
-                    model=model,
-                    language=language,
-                )
+async def _imap_deleted_ids(
+    db: AsyncSession, account_id, folder: str, changes: imap_service.ImapChanges
+) -> list[str]:
+    """回傳 DB 中已從 IMAP 伺服器刪除的信件 provider_message_id"""
+    if changes.present_uids is None and not changes.vanished:
+        return []
 
-                # 更新信件 triage 評分（EmailMessage.action_required 是 Boolean）
-                action_req_bool = bool(result_data.get("action_required", False))
-                msg.urgency_score = result_data.get("urgency_score")
-                msg.importance_score = result_data.get("importance_score")
-                msg.action_required = action_req_bool
-                msg.ai_category = result_data.get("category")
-                msg.sentiment = result_data.get("sentiment")
-
-                # 儲存摘要（EmailSummary.action_required 是 String(5)，需轉字串）
-                summary = EmailSummary(
-                    message_id=msg.id,
-                    summary_text=result_data.get("summary", ""),
-                    style=style,
-                    urgency_score=result_data.get("urgency_score"),
-                    importance_score=result_data.get("importance_score"),
-                    action_required=str(action_req_bool),
-                    ai_category=result_data.get("category"),
-                    sentiment=result_data.get("sentiment"),
-                    reply_suggestions=result_data.get("reply_suggestions", []),
-                    model_used=result_data.get("model_used", model),
-                    tokens_used=result_data.get("tokens_used"),
-                    generation_ms=result_data.get("generation_ms"),
-                )
-                db.add(summary)
-                await db.commit()
+    prefix = imap_service.provider_message_id(folder, changes.uidvalidity, 0)[:-1]
+    result = await db.execute(
+        select(EmailMessage.provider_message_id).where(
+            EmailMessage.account_id == account_id,
+            EmailMessage.provider_message_id.startswith(prefix),
+        )
+    )
+    known = {int(pid[len(prefix):]): pid for pid in result.scalars().all()}
+    return [known[uid] for uid in imap_service.deleted_uids(changes, known)]
 
-                logger.info(f"信件 {msg.id} 分析完成（urgency={msg.urgency_score}，"
-                            f"model={model}，ms={result_data.get('generation_ms')}）")
 
-            except Exception:
-                await db.rollback()
-                logger.error(f"信件 {msg_id} 分析失敗", exc_info=True)
+async def _claim_fence(db: AsyncSession, account_id, lease: sync_lease.SyncLease) -> None:
+    """
+    以 fencing token 確認自己仍是最新的 lease 持有者
 
+    條件式 UPDATE 同時鎖住 sync_state 列；若已有更新的 fence 寫入過，
+    代表 lease 曾過期並被接手，這次同步的寫入全部放棄（rollback）。
+    """
+    lease.check()
+    result = await db.execute(
+        update(EmailSyncState)
+        .where(
+            EmailSyncState.account_id == account_id,
+            or_(
+                EmailSyncState.lease_fence == None,  # noqa: E711
+                EmailSyncState.lease_fence <= lease.fence,
+            ),
+        )
+        .values(lease_fence=lease.fence)
+    )
+    if result.rowcount == 0:
+        raise sync_lease.LeaseLostError(
+            f"帳號 {account_id} 的 fence {lease.fence} 已過期，放棄本次同步寫入"
+        )
+
+
+async def _insert_fenced_state(
+    db: AsyncSession, account_id, lease: sync_lease.SyncLease, **values
+) -> None:
+    """
+    首次同步：建立帶 fencing token 的 sync_state
+
+    同步期間其他流程（watch 註冊、另一個 lease 持有者）可能已建立這一列，
+    因此用 upsert，且只在既有的 fence 不比自己新時覆寫；否則視同 lease 已被接手。
+    """
+    lease.check()
+    stmt = pg_insert(EmailSyncState).values(
+        account_id=account_id, lease_fence=lease.fence, **values
+    )
+    result = await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[EmailSyncState.account_id],
+            set_={"lease_fence": lease.fence, **values},
+            where=or_(
+                EmailSyncState.lease_fence == None,  # noqa: E711
+                EmailSyncState.lease_fence <= lease.fence,
+            ),
+        ).returning(EmailSyncState.account_id)
+    )
+    if result.scalar_one_or_none() is None:
+        raise sync_lease.LeaseLostError(
+            f"帳號 {account_id} 的 fence {lease.fence} 已過期，放棄本次同步寫入"
+        )
+
+
+async def _filter_known_messages(
+    db: AsyncSession, account_id, provider_ids: list[str]
+) -> list[str]:
+    """回傳 DB 中尚未存在的 provider message id（單次 IN 查詢）"""
+    if not provider_ids:
+        return []
+
+    result = await db.execute(
+        select(EmailMessage.provider_message_id).where(
+            EmailMessage.account_id == account_id,
+            EmailMessage.provider_message_id.in_(provider_ids),
+        )
+    )
+    known = set(result.scalars().all())
+    return [pid for pid in provider_ids if pid not in known]
+
+
+async def _bulk_insert_messages(
+    db: AsyncSession, account_id, workspace_id, details: list[dict]
+) -> list[EmailMessage]:
+    """
+    批次寫入新信件
+
+    用 ix_email_messages_provider_unique 做 ON CONFLICT DO NOTHING，
+    RETURNING 只回傳實際寫入的列；其他同步先寫入的信件會被略過。
+    已下載的內文先寫入 body_store，信件列只存 body_hash；被略過的信件
+    帶進來的內文若沒有其他信件引用，在同一個 transaction 內刪除。
+    """
+    if not details:
+        return []
 
-async def analyze_new_messages(message_ids: list):
-    """對新信件執行 LLM 分析（並行，最多 5 封同時進行）"""
-    if not message_ids:
+    rows = []
+    with_body = []
+    for detail in details:
+        row = {"account_id": account_id, "workspace_id": workspace_id, **detail}
+        plain, html = row.pop("body_plain", None), row.pop("body_html", None)
+        row["body_hash"] = None
+        if row.get("body_fetched_at"):
+            with_body.append((row, plain, html))
+        rows.append(row)
+
+    hashes = await body_store.save(db, [(plain, html) for _, plain, html in with_body])
+    for (row, _, _), body_hash in zip(with_body, hashes):
+        row["body_hash"] = body_hash
+
+    stmt = (
+        pg_insert(EmailMessage)
+        .on_conflict_do_nothing(index_elements=["account_id", "provider_message_id"])
+        .returning(EmailMessage)
+    )
+    result = await db.scalars(stmt, rows)
+    inserted = list(result.all())
+
+    if len(inserted) < len(rows):
+        inserted_ids = {m.provider_message_id for m in inserted}
+        skipped_hashes = {
+            row["body_hash"] for row in rows
+            if row["body_hash"] and row["provider_message_id"] not in inserted_ids
+        }
+        await body_store.delete_orphans(db, list(skipped_hashes))
+    return inserted
+
+
+async def _apply_label_updates(
+    db: AsyncSession, account_id, label_updates: dict[str, list[str]]
+) -> None:
+    """將標籤變更（Gmail 標籤 / IMAP 旗標）套用到既有信件（is_read / is_starred / labels）"""
+    if not label_updates:
         return
 
-    llm = LLMService()
-    # Semaphore 限制最多同時 5 個 LLM 請求，避免超過 rate limit
-    semaphore = asyncio.Semaphore(5)
+    table = EmailMessage.__table__
+    stmt = (
+        update(table)
+        .where(
+            table.c.account_id == bindparam("b_account_id"),
+            table.c.provider_message_id == bindparam("b_provider_message_id"),
+        )
+        .values(
+            labels=bindparam("b_labels"),
+            is_read=bindparam("b_is_read"),
+            is_starred=bindparam("b_is_starred"),
+        )
+    )
+    await db.execute(stmt, [
+        {
+            "b_account_id": account_id,
+            "b_provider_message_id": provider_id,
+            "b_labels": labels,
+            "b_is_read": "UNREAD" not in labels,
+            "b_is_starred": "STARRED" in labels,
+        }
+        for provider_id, labels in label_updates.items()
+    ])
+
+
+async def _apply_deletions(db: AsyncSession, account_id, provider_ids: list[str]) -> None:
+    """刪除已從信箱移除的信件（連同摘要與主題關聯）"""
+    if not provider_ids:
+        return
 
-    logger.info(f"開始並行分析 {len(message_ids)} 封信件（concurrency=5）")
-    await asyncio.gather(
-        *[_analyze_single_message(msg_id, llm, semaphore) for msg_id in message_ids],
-        return_exceptions=True,  # 單封失敗不中斷其他封
+    result = await db.execute(
+        select(EmailMessage.id, EmailMessage.body_hash).where(
+            EmailMessage.account_id == account_id,
+            EmailMessage.provider_message_id.in_(provider_ids),
+        )
     )
-    logger.info(f"批次分析完成，共 {len(message_ids)} 封")
+    rows = result.all()
+    if not rows:
+        return
+    message_ids = [row.id for row in rows]
+
+    await db.execute(delete(EmailTopic).where(EmailTopic.message_id.in_(message_ids)))
+    await db.execute(delete(AnalysisJob).where(AnalysisJob.message_id.in_(message_ids)))
+    await db.execute(delete(SimhashEntry).where(SimhashEntry.message_id.in_(message_ids)))
+    await db.execute(delete(NearDuplicateMatch).where(or_(
+        NearDuplicateMatch.message_id.in_(message_ids),
+        NearDuplicateMatch.source_message_id.in_(message_ids),
+    )))
+    await db.execute(delete(EmailSummary).where(EmailSummary.message_id.in_(message_ids)))
+    await db.execute(delete(EmailMessage).where(EmailMessage.id.in_(message_ids)))
+    # 內文可能被其他帳號的同一封信共用，只刪除已無人引用的
+    await body_store.delete_orphans(db, [row.body_hash for row in rows if row.body_hash])
+    logger.info(f"刪除 {len(message_ids)} 封已從信箱移除的信件")
@@ -4,11 +4,23 @@ Worker 主程式 - APScheduler 管理所有排程任務
 import asyncio
 import logging
 import signal
+from datetime import datetime
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
 
-from app.workers.email_sync import sync_all_accounts
+from app.core.config import get_settings
+from app.workers.email_sync import (
+    close_idle_imap_connections,
+    consume_sync_requests,
+    log_worker_metrics,
+    refresh_expiring_tokens,
+    renew_gmail_watches,
+    sync_all_accounts,
+    watch_imap_accounts,
+)
+from app.workers.analysis import drain_analysis_queue, prune_llm_cache
+from app.workers.backfill import backfill_accounts
 from app.workers.digest import send_digest_for_all_users
 
 logging.basicConfig(
@@ -16,21 +28,34 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
 )
 logger = logging.getLogger(__name__)
+settings = get_settings()
 
 
 async def main():
     scheduler = AsyncIOScheduler()
 
-    # 每 2 分鐘同步一次信件
+    # 定時挑出到期帳號同步（每個帳號的間隔依流量自適應，失敗時指數退避）
     scheduler.add_job(
         sync_all_accounts,
-        trigger=IntervalTrigger(minutes=2),
+        trigger=IntervalTrigger(seconds=settings.sync_tick_seconds),
         id="email_sync",
         name="Email Sync",
         max_instances=1,
+        coalesce=True,
         misfire_grace_time=30,
     )
 
+    # Gmail 歷史信件回填（獨立 lease 與配額比例，不影響增量同步）
+    if settings.backfill_enabled:
+        scheduler.add_job(
+            backfill_accounts,
+            trigger=IntervalTrigger(seconds=settings.backfill_tick_seconds),
+            id="gmail_backfill",
+            name="Gmail History Backfill",
+            max_instances=1,
+            coalesce=True,
+        )
+
     # 每小時整點檢查是否有 Digest 要發送
     scheduler.add_job(
         send_digest_for_all_users,
@@ -40,14 +65,89 @@ async def main():
         max_instances=1,
     )
 
+    # 每小時檢查 Gmail watch，註冊新帳號並續約即將到期的 watch
+    if settings.gmail_push_topic:
+        scheduler.add_job(
+            renew_gmail_watches,
+            trigger=IntervalTrigger(hours=1),
+            id="gmail_watch_renew",
+            name="Gmail Watch Renew",
+            max_instances=1,
+            next_run_time=datetime.now(),
+        )
+
+    # 每分鐘記錄佇列深度與 process 指標
+    scheduler.add_job(
+        log_worker_metrics,
+        trigger=IntervalTrigger(minutes=1),
+        id="metrics_log",
+        name="Metrics Log",
+        max_instances=1,
+    )
+
+    # 每小時清理 LLM 結果快取（過期 / 超過上限的最久未用項目）
+    scheduler.add_job(
+        prune_llm_cache,
+        trigger=IntervalTrigger(hours=1),
+        id="llm_cache_prune",
+        name="LLM Cache Prune",
+        max_instances=1,
+    )
+
+    # Token 到期前背景 refresh（間隔需小於 token_refresh_margin_seconds）
+    scheduler.add_job(
+        refresh_expiring_tokens,
+        trigger=IntervalTrigger(minutes=5),
+        id="token_refresh",
+        name="OAuth Token Refresh",
+        max_instances=1,
+        next_run_time=datetime.now(),
+    )
+
+    # 關閉閒置的 IMAP pool 連線（有同步的帳號會跨週期重用連線）
+    scheduler.add_job(
+        close_idle_imap_connections,
+        trigger=IntervalTrigger(minutes=5),
+        id="imap_pool_cleanup",
+        name="IMAP Pool Cleanup",
+        max_instances=1,
+    )
+
     scheduler.start()
     logger.info("✅ Worker 啟動，排程任務已設定")
-    logger.info("  - Email 同步: 每 2 分鐘")
+    logger.info(
+        f"  - Email 同步: 每 {settings.sync_tick_seconds} 秒挑出到期帳號"
+        f"（間隔 {settings.sync_min_interval_seconds}-{settings.sync_max_interval_seconds} 秒，"
+        f"並行 {settings.sync_max_concurrency}，每用戶 {settings.sync_per_user_concurrency}）"
+    )
     logger.info("  - Digest 發送: 每小時整點檢查")
+    if settings.backfill_enabled:
+        logger.info(f"  - 歷史信件回填: 每 {settings.backfill_tick_seconds} 秒"
+                    f"（配額比例 {settings.backfill_quota_share:.0%}）")
 
     # 優雅關閉
     stop_event = asyncio.Event()
 
+    # push 通知 / OAuth callback 觸發的單一帳號同步
+    consumer = asyncio.create_task(consume_sync_requests(stop_event))
+    if settings.gmail_push_topic:
+        logger.info("  - Gmail Push: 已啟用（輪詢僅作為安全網）")
+
+    # LLM 分析佇列（可另外以 `python -m app.workers.analysis` 擴充分析 process）
+    analyzer = None
+    if settings.analysis_worker_inline:
+        analyzer = asyncio.create_task(drain_analysis_queue(stop_event))
+        logger.info(
+            f"  - LLM 分析: 消化 analysis_jobs（每次認領 {settings.analysis_claim_batch} 個，"
+            f"並行數由 llm_limiter 依模型調整）"
+        )
+
+    # IMAP IDLE：新信立即加入同步佇列
+    imap_watcher = None
+    if settings.imap_idle_enabled:
+        imap_watcher = asyncio.create_task(watch_imap_accounts(stop_event))
+        logger.info("  - IMAP IDLE: 已啟用")
+
     def handle_signal():
         logger.info("收到關閉訊號，停止 Worker...")
         stop_event.set()
@@ -58,6 +158,11 @@ async def main():
 
     await stop_event.wait()
     scheduler.shutdown()
+    await consumer
+    if analyzer:
+        await analyzer
+    if imap_watcher:
+        await imap_watcher
     logger.info("Worker 已停止")
 
 
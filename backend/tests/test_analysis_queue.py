@@ -0,0 +1,217 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.core import metrics
+from app.services import analysis_queue
+from app.services.analysis_queue import ClaimedJob
+
+NOW = datetime(2026, 10, 17, 12, 0, 0)
+
+
+class _Result:
+    def __init__(self, rows=(), rowcount=0):
+        self.rows = list(rows)
+        self.rowcount = rowcount
+
+    def all(self):
+        return self.rows
+
+
+class _QueueSession:
+    """依序回傳預先排好的結果，記錄 (statement, params) 與 commit"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.executed = []
+        self.commits = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt, params=None):
+        self.executed.append((stmt, params))
+        return self.results.pop(0)
+
+    async def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture(autouse=True)
+def queue_settings(monkeypatch):
+    s = analysis_queue.settings
+    monkeypatch.setattr(s, "analysis_max_attempts", 3)
+    monkeypatch.setattr(s, "analysis_lock_timeout_seconds", 600)
+    monkeypatch.setattr(s, "analysis_backoff_base_seconds", 60)
+    monkeypatch.setattr(s, "analysis_backoff_max_seconds", 200)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(*results):
+        db = _QueueSession(*results)
+        monkeypatch.setattr(analysis_queue, "AsyncSessionLocal", db)
+        return db
+
+    return install
+
+
+def _counter(name):
+    return metrics.snapshot()["counters"].get(name, 0)
+
+
+def _job(attempts=1):
+    return ClaimedJob(uuid.uuid4(), attempts, NOW)
+
+
+def test_claim_queries_skip_locked_rows():
+    for sql in (
+        analysis_queue._CLAIM_PENDING_SQL,
+        analysis_queue._CLAIM_STALE_SQL,
+        analysis_queue._DEAD_LETTER_STALE_SQL,
+    ):
+        assert "FOR UPDATE SKIP LOCKED" in sql.text
+    assert "attempts < :max_attempts" in analysis_queue._CLAIM_STALE_SQL.text
+    assert "attempts >= :max_attempts" in analysis_queue._DEAD_LETTER_STALE_SQL.text
+    assert "ORDER BY priority DESC, run_after" in analysis_queue._CLAIM_PENDING_SQL.text
+
+
+async def test_claim_takes_pending_then_fills_with_stale(session):
+    pending = [(uuid.uuid4(), 1, NOW), (uuid.uuid4(), 1, NOW)]
+    stale = [(uuid.uuid4(), 2, NOW)]
+    db = session(_Result(), _Result(pending), _Result(stale))
+
+    jobs = await analysis_queue.claim(5)
+
+    assert jobs == [ClaimedJob(*row) for row in pending + stale]
+    statements = [stmt for stmt, _ in db.executed]
+    assert statements == [
+        analysis_queue._DEAD_LETTER_STALE_SQL,
+        analysis_queue._CLAIM_PENDING_SQL,
+        analysis_queue._CLAIM_STALE_SQL,
+    ]
+    assert db.executed[1][1] == {"lock_timeout": 600, "max_attempts": 3, "limit": 5}
+    assert db.executed[2][1]["limit"] == 3
+    assert db.commits == 1
+
+
+async def test_claim_skips_stale_when_pending_fills_limit(session):
+    pending = [(uuid.uuid4(), 1, NOW)]
+    db = session(_Result(), _Result(pending))
+    assert len(await analysis_queue.claim(1)) == 1
+    assert len(db.executed) == 2
+
+
+async def test_claim_dead_letters_exhausted_stale_jobs(session):
+    before = _counter("analysis_queue.dead_lettered")
+    session(_Result([(uuid.uuid4(),), (uuid.uuid4(),)]), _Result(), _Result())
+    assert await analysis_queue.claim(5) == []
+    assert _counter("analysis_queue.dead_lettered") == before + 2
+
+
+def _compiled(stmt):
+    return stmt.compile(dialect=postgresql.dialect())
+
+
+async def test_complete_deletes_only_owned_claims(session):
+    jobs = [_job(), _job()]
+    db = session(_Result(rowcount=1))
+    before = _counter("analysis_queue.lost_ownership")
+
+    await analysis_queue.complete(jobs)
+
+    compiled = _compiled(db.executed[0][0])
+    sql = str(compiled)
+    assert sql.startswith("DELETE FROM analysis_jobs")
+    assert "analysis_jobs.status = %(status_1)s" in sql
+    assert "(analysis_jobs.message_id, analysis_jobs.locked_at) IN" in sql
+    assert compiled.params["status_1"] == "running"
+    assert _counter("analysis_queue.lost_ownership") == before + 1
+
+
+async def test_complete_nothing_is_noop(session):
+    db = session()
+    await analysis_queue.complete([])
+    assert db.executed == []
+
+
+@pytest.fixture
+def frozen(monkeypatch):
+    class _Frozen(datetime):
+        @classmethod
+        def utcnow(cls):
+            return NOW
+
+    monkeypatch.setattr(analysis_queue, "datetime", _Frozen)
+
+
+@pytest.mark.parametrize("attempts, delay", [(1, 60), (2, 120)])
+async def test_fail_schedules_backoff_retry(session, frozen, attempts, delay):
+    db = session(_Result(rowcount=1))
+    await analysis_queue.fail(_job(attempts), ValueError("bad json"))
+
+    params = _compiled(db.executed[0][0]).params
+    assert params["status"] == "pending"
+    assert params["run_after"] == NOW + timedelta(seconds=delay)
+    assert params["locked_at"] is None
+    assert params["last_error"] == "ValueError: bad json"
+
+
+async def test_fail_backoff_is_capped(session, frozen, monkeypatch):
+    monkeypatch.setattr(analysis_queue.settings, "analysis_max_attempts", 10)
+    db = session(_Result(rowcount=1))
+    await analysis_queue.fail(_job(5), ValueError("x"))
+    assert _compiled(db.executed[0][0]).params["run_after"] == NOW + timedelta(seconds=200)
+
+
+async def test_fail_after_max_attempts_is_dead(session):
+    db = session(_Result(rowcount=1))
+    before = _counter("analysis_queue.dead_lettered")
+    await analysis_queue.fail(_job(3), ValueError("x"))
+    params = _compiled(db.executed[0][0]).params
+    assert params["status"] == "dead" and "run_after" not in params
+    assert _counter("analysis_queue.dead_lettered") == before + 1
+
+
+async def test_fail_after_reclaim_does_not_overwrite(session):
+    job = _job(3)
+    db = session(_Result(rowcount=0))
+    dead_before = _counter("analysis_queue.dead_lettered")
+    lost_before = _counter("analysis_queue.lost_ownership")
+
+    await analysis_queue.fail(job, ValueError("x"))
+
+    compiled = _compiled(db.executed[0][0])
+    assert "(analysis_jobs.message_id, analysis_jobs.locked_at) IN" in str(compiled)
+    assert _counter("analysis_queue.lost_ownership") == lost_before + 1
+    assert _counter("analysis_queue.dead_lettered") == dead_before
+
+
+async def test_enqueue_ignores_already_queued_messages():
+    db = _QueueSession(_Result())
+    await analysis_queue.enqueue(db, [uuid.uuid4(), uuid.uuid4()], priority=0)
+    sql = str(_compiled(db.executed[0][0]))
+    assert "ON CONFLICT (message_id) DO NOTHING" in sql
+    assert db.commits == 0  # 由呼叫端 commit
+
+
+async def test_stats_reports_counts_and_oldest_pending(frozen):
+    class _StatsSession:
+        async def execute(self, stmt):
+            return _Result([("pending", 4), ("dead", 1)])
+
+        async def scalar(self, stmt):
+            return NOW - timedelta(seconds=30)
+
+    counts = await analysis_queue.stats(_StatsSession())
+    assert counts == {"pending": 4, "running": 0, "dead": 1, "oldest_pending_seconds": 30.0}
+    assert metrics.snapshot()["gauges"]["analysis_queue.pending"] == 4
+
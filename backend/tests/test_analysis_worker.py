@@ -0,0 +1,172 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.pretriage import Decision
+from app.workers import analysis
+
+
+@pytest.fixture(autouse=True)
+def batch_settings(monkeypatch):
+    s = analysis.settings
+    monkeypatch.setattr(s, "analysis_batch_enabled", True)
+    monkeypatch.setattr(s, "analysis_batch_min_backlog", 2)
+    monkeypatch.setattr(s, "analysis_batch_item_max_tokens", 50)
+    monkeypatch.setattr(s, "analysis_batch_token_budget", 100)
+    monkeypatch.setattr(s, "analysis_batch_max_items", 3)
+    # 測試用：一個字元算一個 token
+    monkeypatch.setattr(analysis, "count_tokens", lambda text, model: len(text))
+
+
+def test_pack_batches_respects_token_budget_and_item_cap():
+    items = [(i, "x" * size, None) for i, size in enumerate([40, 40, 30, 10, 10, 10, 10])]
+    batches = analysis._pack_batches(items, "m")
+    assert [[i for i, _, _ in batch] for batch in batches] == [[0, 1], [2, 3, 4], [5, 6]]
+
+
+class _Session:
+    def __init__(self, messages):
+        self.messages = messages
+        self.commits = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: self.messages))
+
+    async def commit(self):
+        self.commits += 1
+
+
+class FakeLLM:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.batches = []
+
+    async def analyze_emails_batch(self, emails, style, model, language):
+        self.batches.append([pid for pid, _ in emails])
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return {pid: {"summary": f"summary {pid}"} for pid in outcome}
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    calls = SimpleNamespace(saved=[], cached=[], messages=[])
+
+    async def evaluate(db, messages, record_metrics=True):
+        return {msg.id: Decision() for msg in messages}
+
+    async def cache_get(db, key):
+        return None
+
+    async def cache_put(db, key, result):
+        calls.cached.append(key)
+
+    def save_result(db, msg, result, style, model):
+        calls.saved.append((msg.id, result["summary"]))
+
+    monkeypatch.setattr(analysis.pretriage, "evaluate", evaluate)
+    monkeypatch.setattr(analysis.pretriage, "record", lambda decision: None)
+    monkeypatch.setattr(analysis, "_analysis_params", lambda msg, d: ("m", "s", "zh-TW"))
+    monkeypatch.setattr(analysis.message_body, "analysis_content", lambda msg: msg.content)
+    monkeypatch.setattr(analysis.near_duplicate, "fingerprint", lambda msg, content: None)
+    monkeypatch.setattr(analysis.llm_cache, "get", cache_get)
+    monkeypatch.setattr(analysis.llm_cache, "put", cache_put)
+    monkeypatch.setattr(analysis, "_save_result", save_result)
+
+    def install(contents):
+        calls.messages = [
+            SimpleNamespace(id=f"m{i}", subject="", content=content)
+            for i, content in enumerate(contents)
+        ]
+        calls.session = _Session(calls.messages)
+        monkeypatch.setattr(analysis, "AsyncSessionLocal", calls.session)
+        return [msg.id for msg in calls.messages]
+
+    calls.install = install
+    return calls
+
+
+async def test_missing_items_fall_back_to_single_analysis(pipeline):
+    ids = pipeline.install(["short a", "short b", "short c", "x" * 60])
+    llm = FakeLLM(["m0", "m2"])
+
+    done = await analysis._analyze_short_messages(ids, llm)
+
+    assert llm.batches == [["m0", "m1", "m2"]]  # 長信不進批次
+    assert done == {"m0", "m2"}
+    assert pipeline.saved == [("m0", "summary m0"), ("m2", "summary m2")]
+    assert len(pipeline.cached) == 2
+    assert pipeline.session.commits == 1
+
+
+async def test_failed_batch_leaves_items_for_single_analysis(pipeline):
+    ids = pipeline.install(["x" * 40] * 4)
+    llm = FakeLLM(RuntimeError("bad json"), ["m2", "m3"])
+
+    done = await analysis._analyze_short_messages(ids, llm)
+
+    assert llm.batches == [["m0", "m1"], ["m2", "m3"]]
+    assert done == {"m2", "m3"}
+
+
+async def test_single_item_batches_are_not_sent(pipeline):
+    ids = pipeline.install(["x" * 40, "y" * 60])
+    llm = FakeLLM()
+    assert await analysis._analyze_short_messages(ids, llm) == set()
+    assert llm.batches == []
+
+
+@pytest.fixture
+def new_messages(monkeypatch):
+    calls = SimpleNamespace(single=[], batch_result=set())
+
+    async def ensure_bodies(db, messages):
+        pass
+
+    async def short(message_ids, llm):
+        if isinstance(calls.batch_result, Exception):
+            raise calls.batch_result
+        return calls.batch_result
+
+    async def single(msg_id, llm):
+        calls.single.append(msg_id)
+        if msg_id == "bad":
+            raise ValueError("llm error")
+
+    monkeypatch.setattr(analysis, "AsyncSessionLocal", _Session([]))
+    monkeypatch.setattr(analysis.message_body, "ensure_bodies", ensure_bodies)
+    monkeypatch.setattr(analysis, "LLMService", lambda: object())
+    monkeypatch.setattr(analysis, "_analyze_short_messages", short)
+    monkeypatch.setattr(analysis, "_analyze_single_message", single)
+    return calls
+
+
+async def test_batched_messages_skip_single_analysis(new_messages):
+    new_messages.batch_result = {"a", "c"}
+    outcomes = await analysis.analyze_new_messages(["a", "b", "c", "bad"])
+    assert new_messages.single == ["b", "bad"]
+    assert outcomes[:3] == [None, None, None]
+    assert isinstance(outcomes[3], ValueError)
+
+
+async def test_batch_failure_falls_back_to_single_for_all(new_messages):
+    new_messages.batch_result = RuntimeError("batch crashed")
+    await analysis.analyze_new_messages(["a", "b"])
+    assert new_messages.single == ["a", "b"]
+
+
+async def test_small_backlog_is_not_batched(new_messages, monkeypatch):
+    monkeypatch.setattr(analysis.settings, "analysis_batch_min_backlog", 5)
+    new_messages.batch_result = {"a"}
+    await analysis.analyze_new_messages(["a", "b"])
+    assert new_messages.single == ["a", "b"]
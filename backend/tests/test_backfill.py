@@ -0,0 +1,183 @@
+import uuid
+from types import SimpleNamespace
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from sqlalchemy.dialects import postgresql
+
+from app.services import sync_lease
+from app.workers import backfill
+
+
+class _BackfillSession:
+    """SELECT 回傳帳號；UPDATE（斷點）記錄寫入的值"""
+
+    def __init__(self, account, rowcount=1):
+        self.account = account
+        self.rowcount = rowcount
+        self.checkpoints = []
+        self.commits = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        if stmt.is_select:
+            return SimpleNamespace(scalar_one_or_none=lambda: self.account)
+        self.checkpoints.append(stmt.compile(dialect=postgresql.dialect()).params)
+        return SimpleNamespace(rowcount=self.rowcount)
+
+    async def commit(self):
+        self.commits += 1
+
+
+class FakeClient:
+    def __init__(self, pages, errors=None):
+        self.pages = pages  # page_token → (ids, next_token)
+        self.errors = errors or {}
+        self.listed = []
+        self.fetched = []
+
+    async def list_messages_page(self, page_token, page_size=100, query=""):
+        self.listed.append(page_token)
+        if page_token in self.errors:
+            raise self.errors.pop(page_token)
+        return self.pages[page_token]
+
+    async def get_message_details_batch(self, ids, format="full"):
+        self.fetched.append((list(ids), format))
+        return [{"provider_message_id": pid} for pid in ids], []
+
+
+def _invalid_page_token():
+    return HttpError(httplib2.Response({"status": 400}), b"Invalid pageToken")
+
+
+@pytest.fixture
+def world(monkeypatch):
+    state = SimpleNamespace(backfill_completed_at=None, backfill_page_token=None)
+    account = SimpleNamespace(
+        id=uuid.uuid4(), user_id=uuid.uuid4(), email_address="a@example.com",
+        sync_state=state, user=SimpleNamespace(workspace_id="ws"),
+    )
+    calls = SimpleNamespace(enqueued=[], sleeps=[], client=None, known=set())
+
+    async def client_for_account(acc):
+        return calls.client
+
+    async def filter_known(db, account_id, ids):
+        return [pid for pid in ids if pid not in calls.known]
+
+    async def bulk_insert(db, account_id, workspace_id, details):
+        assert workspace_id == "ws"
+        return [SimpleNamespace(id=d["provider_message_id"]) for d in details]
+
+    async def classify(db, messages, user_id):
+        pass
+
+    async def enqueue(db, ids, priority):
+        calls.enqueued.append((ids, priority))
+
+    async def sleep(seconds):
+        calls.sleeps.append(seconds)
+
+    monkeypatch.setattr(backfill, "client_for_account", client_for_account)
+    monkeypatch.setattr(backfill, "_filter_known_messages", filter_known)
+    monkeypatch.setattr(backfill, "_bulk_insert_messages", bulk_insert)
+    monkeypatch.setattr(backfill, "_classify_messages_to_topics", classify)
+    monkeypatch.setattr(backfill.analysis_queue, "enqueue", enqueue)
+    monkeypatch.setattr(backfill.asyncio, "sleep", sleep)
+    s = backfill.settings
+    monkeypatch.setattr(s, "backfill_pages_per_run", 5)
+    monkeypatch.setattr(s, "backfill_analyze", True)
+    monkeypatch.setattr(s, "gmail_user_quota_units_per_second", 250)
+    monkeypatch.setattr(s, "backfill_quota_share", 0.2)
+    monkeypatch.setattr(backfill.time, "monotonic", lambda: 0.0)
+
+    db = _BackfillSession(account)
+    monkeypatch.setattr(backfill, "AsyncSessionLocal", db)
+    calls.account, calls.db = account, db
+    return calls
+
+
+def _lease(fence=4):
+    return sync_lease.SyncLease("k", "v", fence, 30000)
+
+
+async def test_resumes_from_checkpoint_until_mailbox_end(world):
+    world.account.sync_state.backfill_page_token = "p2"
+    world.known = {"m3"}
+    world.client = FakeClient({"p2": (["m3", "m4"], "p3"), "p3": (["m5"], None)})
+
+    total = await backfill._backfill_locked(world.account.id, _lease())
+
+    assert total == 2
+    assert world.client.listed == ["p2", "p3"]
+    assert world.client.fetched[0][0] == ["m4"]
+    assert [c["backfill_page_token"] for c in world.db.checkpoints] == ["p3", None]
+    assert all(c["backfill_fence"] == 4 for c in world.db.checkpoints)
+    assert "backfill_completed_at" in world.db.checkpoints[-1]
+    assert "backfill_completed_at" not in world.db.checkpoints[0]
+    assert world.db.commits == 2
+    assert world.enqueued == [(["m4"], 0), (["m5"], 0)]
+
+
+async def test_pages_per_run_and_quota_throttle(world, monkeypatch):
+    monkeypatch.setattr(backfill.settings, "backfill_pages_per_run", 2)
+    world.client = FakeClient({
+        None: (["a", "b"], "p2"),
+        "p2": (["c"], "p3"),
+    })
+
+    await backfill._backfill_locked(world.account.id, _lease())
+
+    assert world.client.listed == [None, "p2"]
+    assert world.db.checkpoints[-1]["backfill_page_token"] == "p3"
+    # 250 units/s * 0.2 = 50 units/s；messages.list 5 + messages.get 5 * 筆數
+    assert world.sleeps == [(5 + 5 * 2) / 50, (5 + 5 * 1) / 50]
+
+
+async def test_invalid_page_token_restarts_listing(world):
+    world.account.sync_state.backfill_page_token = "expired"
+    world.client = FakeClient(
+        {None: (["a"], None)}, errors={"expired": _invalid_page_token()}
+    )
+    assert await backfill._backfill_locked(world.account.id, _lease()) == 1
+    assert world.client.listed == ["expired", None]
+
+
+async def test_other_list_errors_propagate(world):
+    world.client = FakeClient({}, errors={None: HttpError(
+        httplib2.Response({"status": 500}), b"backend error"
+    )})
+    with pytest.raises(HttpError):
+        await backfill._backfill_locked(world.account.id, _lease())
+
+
+async def test_newer_fence_aborts_page(world):
+    world.db.rowcount = 0
+    world.client = FakeClient({None: (["a"], "p2")})
+    with pytest.raises(sync_lease.LeaseLostError):
+        await backfill._backfill_locked(world.account.id, _lease())
+    assert world.db.commits == 0
+
+
+async def test_completed_account_is_skipped(world):
+    world.account.sync_state.backfill_completed_at = "done"
+    world.client = FakeClient({})
+    assert await backfill._backfill_locked(world.account.id, _lease()) == 0
+    assert world.client.listed == []
+
+
+async def test_backfill_analysis_can_be_disabled(world, monkeypatch):
+    monkeypatch.setattr(backfill.settings, "backfill_analyze", False)
+    world.client = FakeClient({None: (["a"], None)})
+    await backfill._backfill_locked(world.account.id, _lease())
+    assert world.enqueued == []
@@ -0,0 +1,78 @@
+from sqlalchemy.dialects import postgresql
+
+from app.models.email import EmailBody
+from app.services import body_store
+
+
+def _sql(stmt):
+    return str(stmt.compile(dialect=postgresql.dialect()))
+
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def all(self):
+        return self.value
+
+    def scalars(self):
+        return self
+
+
+class _RecordingSession:
+    """依序回傳預先排好的查詢結果，並記錄執行過的 SQL"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.statements = []
+
+    async def execute(self, stmt, params=None):
+        self.statements.append(stmt)
+        return _Result(self.results.pop(0))
+
+
+def test_content_hash_separates_plain_and_html():
+    assert body_store.content_hash("ab", "") != body_store.content_hash("a", "b")
+    assert body_store.content_hash("ab", None) == body_store.content_hash("ab", "")
+
+
+def test_pack_dedups_and_orders_rows_by_hash():
+    bodies = [("b", None), ("a", "<p>a</p>"), ("b", None)]
+    hashes, rows = body_store._pack(bodies)
+    assert hashes == [body_store.content_hash(p, h) for p, h in bodies]
+    assert [r["content_hash"] for r in rows] == sorted(set(hashes))
+    row = next(r for r in rows if r["content_hash"] == hashes[1])
+    body = EmailBody(plain_z=row["plain_z"], html_z=row["html_z"])
+    assert (body.body_plain, body.body_html) == ("a", "<p>a</p>")
+    assert row["raw_size"] == len("a") + len("<p>a</p>")
+
+
+def test_empty_text_is_stored_as_null():
+    _, rows = body_store._pack([("", None)])
+    assert rows[0]["plain_z"] is None and rows[0]["html_z"] is None
+
+
+async def test_save_locks_existing_bodies_without_rewriting():
+    db = _RecordingSession([("h",)])
+    hashes = await body_store.save(db, [("x", None), ("y", None)])
+    assert hashes == [body_store.content_hash("x", None), body_store.content_hash("y", None)]
+    sql = _sql(db.statements[0])
+    assert "ON CONFLICT (content_hash) DO UPDATE" in sql
+    assert "WHERE false" in sql
+
+
+async def test_delete_orphans_locks_before_checking_references():
+    db = _RecordingSession(["h1"], None)
+    await body_store.delete_orphans(db, ["h1", "h2", "h1"])
+    lock, delete = (_sql(stmt) for stmt in db.statements)
+    assert lock.endswith("FOR UPDATE")
+    assert "ORDER BY email_bodies.content_hash" in lock
+    assert delete.startswith("DELETE FROM email_bodies")
+    assert "NOT (EXISTS" in delete
+    assert db.statements[1].compile().params["content_hash_1"] == ["h1"]
+
+
+async def test_delete_orphans_skips_delete_when_nothing_locked():
+    db = _RecordingSession([])
+    await body_store.delete_orphans(db, ["gone"])
+    assert len(db.statements) == 1
@@ -0,0 +1,127 @@
+import pytest
+
+from app.services import content_normalizer as cn
+
+NEWSLETTER_FOOTER = """本週重點：新版 API 上線，速率上限提高一倍。
+
+詳細說明請見部落格文章。
+
+You are receiving this email because you signed up at example.com.
+Unsubscribe | Manage preferences | Privacy
+如不想再收到此類信件，請取消訂閱
+"""
+
+
+def test_newsletter_footer_lines_are_removed():
+    text = cn.clean_text(NEWSLETTER_FOOTER)
+    assert text == "本週重點：新版 API 上線，速率上限提高一倍。\n\n詳細說明請見部落格文章。"
+
+
+def test_view_in_browser_header_is_removed():
+    text = cn.clean_text("View this email in your browser\n\n十月活動開跑\n報名到月底")
+    assert text == "十月活動開跑\n報名到月底"
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "How do I unsubscribe a user from the API?",
+        "We need a way for admins to unsubscribe users in bulk.",
+        "請問要怎麼取消訂閱這個方案？",
+        "我們上週已經退訂了那個服務，但還是被扣款。",
+        "取消訂閱這個方案會退款嗎",
+        "Unsubscribe flow: the user clicks the link and we call the API.",
+        "Can you view the report in your browser?",
+        "The contract says this email is confidential until the launch.",
+    ],
+)
+def test_real_content_mentioning_footer_words_survives(line):
+    body = f"Hi team,\n\n{line}\n\nThanks,\nAmy"
+    assert line in cn.clean_text(body)
+    assert line in cn.normalize(body, None)
+
+
+def test_footer_words_in_the_middle_of_long_mail_survive():
+    paragraphs = [f"第 {i} 段內容。" for i in range(30)]
+    paragraphs[10] = "Unsubscribe here"
+    text = cn.clean_text("\n".join(paragraphs))
+    assert "Unsubscribe here" in text
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "Unsubscribe",
+        "Unsubscribe here",
+        "To unsubscribe from this list, click the link below.",
+        "unsubscribe: https://example.com/u/123",
+        "取消訂閱",
+        "取消訂閱請點此",
+        "如欲取消訂閱，請回覆此信",
+        "This message may be confidential and is intended for the recipient only.",
+        "本郵件內容為機密資訊，僅供收件人使用",
+    ],
+)
+def test_footer_lines_are_removed(line):
+    assert cn.clean_text(f"會議改到週四。\n{line}") == "會議改到週四。"
+
+
+def test_long_line_is_never_treated_as_footer():
+    line = "Unsubscribe " + "x" * 400
+    assert line in cn.clean_text(f"內容\n{line}")
+
+
+def test_quoted_history_is_cut():
+    body = (
+        "好的，明天見。\n\n"
+        "On Mon, Oct 12, 2026 at 9:00 AM Bob <bob@example.com> wrote:\n"
+        "> 明天開會？"
+    )
+    assert cn.clean_text(body) == "好的，明天見。"
+
+
+def test_signature_is_cut_but_whole_forward_is_kept():
+    assert cn.clean_text("收到\n\nSent from my iPhone") == "收到"
+    only_quote = "---------- Forwarded message ---------\n請看附件"
+    assert "請看附件" in cn.clean_text(only_quote)
+
+
+def test_quote_lines_are_dropped_and_long_urls_shortened():
+    url = "https://tracking.example.com/" + "a" * 80
+    text = cn.clean_text(f"請點連結 {url}\n> 舊的引用")
+    assert text == "請點連結 [連結]"
+
+
+def test_html_to_text_drops_hidden_and_quoted_content():
+    html = """
+    <html><head><style>p{}</style><title>t</title></head><body>
+    <p>第一段</p><div style="display: none">preheader</div>
+    <script>track()</script><img src="x.gif">
+    <div>第二段</div>
+    <div class="gmail_quote">舊信</div><blockquote>引用</blockquote>
+    </body></html>
+    """
+    text = cn.clean_text(cn.html_to_text(html))
+    assert text == "第一段\n\n第二段"
+
+
+def test_normalize_prefers_html_when_plain_is_a_stub():
+    html = "<p>" + "完整的 HTML 內文。" * 10 + "</p>"
+    assert cn.normalize("請用 HTML 檢視", html).startswith("完整的 HTML 內文。")
+    plain = "純文字內文。" * 50
+    assert cn.normalize(plain, html) == plain
+    assert cn.normalize(None, None) == ""
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({"list-unsubscribe": "<mailto:u@example.com>"}, True),
+        ({"list-id": "<news.example.com>"}, True),
+        ({"precedence": " Bulk "}, True),
+        ({"precedence": "first-class"}, False),
+        ({}, False),
+    ],
+)
+def test_is_list_mail(headers, expected):
+    assert cn.is_list_mail(headers) is expected
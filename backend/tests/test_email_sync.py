@@ -0,0 +1,508 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.services.imap_service import ImapChanges
+from app.workers import email_sync
+from app.workers.email_sync import _next_interval
+
+NOW = datetime(2026, 10, 17, 12, 0, 0)
+
+
+@pytest.fixture(autouse=True)
+def intervals(monkeypatch):
+    s = email_sync.settings
+    monkeypatch.setattr(s, "sync_safety_poll_seconds", 900)
+    monkeypatch.setattr(s, "sync_min_interval_seconds", 60)
+    monkeypatch.setattr(s, "sync_interval_seconds", 120)
+    monkeypatch.setattr(s, "sync_max_interval_seconds", 1800)
+
+
+def _account(provider="gmail", interval=None, watch_expires_at=None):
+    state = SimpleNamespace(watch_expires_at=watch_expires_at)
+    return SimpleNamespace(provider=provider, sync_interval_seconds=interval, sync_state=state)
+
+
+def test_watched_gmail_account_uses_safety_poll():
+    account = _account(interval=60, watch_expires_at=NOW + timedelta(days=1))
+    assert _next_interval(account, 5, NOW) == 900
+    assert _next_interval(account, 0, NOW) == 900
+
+
+def test_expired_watch_uses_adaptive_interval():
+    account = _account(interval=120, watch_expires_at=NOW - timedelta(seconds=1))
+    assert _next_interval(account, 0, NOW) == 180
+    assert _next_interval(account, 3, NOW) == 60
+
+
+def test_gmail_without_sync_state_uses_adaptive_interval():
+    account = SimpleNamespace(provider="gmail", sync_interval_seconds=None, sync_state=None)
+    assert _next_interval(account, 0, NOW) == 180
+
+
+def test_imap_account_ignores_watch_state():
+    account = _account(provider="imap", interval=400, watch_expires_at=NOW + timedelta(days=1))
+    assert _next_interval(account, 0, NOW) == 600
+    assert _next_interval(account, 1, NOW) == 60
+
+
+def test_idle_interval_is_capped():
+    account = _account(provider="imap", interval=1500)
+    assert _next_interval(account, 0, NOW) == 1800
+
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self.value
+
+
+class _ScriptedSession:
+    """依序回傳預先排好的查詢結果，並記錄執行過的語句"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.statements = []
+
+    async def execute(self, stmt, params=None):
+        self.statements.append(stmt)
+        return _Result(self.results.pop(0))
+
+
+async def test_imap_deletions_compare_stored_uids_with_server():
+    db = _ScriptedSession(["INBOX:7:3", "INBOX:7:4", "INBOX:7:10"])
+    changes = ImapChanges(uidvalidity=7, present_uids={4, 11})
+    assert await email_sync._imap_deleted_ids(db, "acc", "INBOX", changes) == [
+        "INBOX:7:3", "INBOX:7:10",
+    ]
+
+
+async def test_imap_deletions_use_vanished_ranges():
+    db = _ScriptedSession(["INBOX:7:3", "INBOX:7:4", "INBOX:7:10"])
+    changes = ImapChanges(uidvalidity=7, vanished=[(4, 9)])
+    assert await email_sync._imap_deleted_ids(db, "acc", "INBOX", changes) == ["INBOX:7:4"]
+
+
+async def test_imap_deletions_skip_query_without_vanished():
+    db = _ScriptedSession()
+    assert await email_sync._imap_deleted_ids(db, "acc", "INBOX", ImapChanges(uidvalidity=7)) == []
+    assert db.statements == []
+
+
+class _SessionFactory:
+    def __init__(self, accounts):
+        self.accounts = accounts
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return _ScriptedSession(self.accounts)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+async def test_imap_idle_watchers_are_capped(monkeypatch):
+    accounts = [
+        SimpleNamespace(id=uuid.uuid4(), user_id=uuid.uuid4(), imap_host="imap.example.com")
+        for _ in range(5)
+    ]
+    watching = []
+
+    async def idle_watch(account, on_new_mail, stop_event):
+        watching.append(account.id)
+        await stop_event.wait()
+        watching.remove(account.id)
+
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", _SessionFactory(accounts))
+    monkeypatch.setattr(email_sync.imap_service, "idle_watch", idle_watch)
+    monkeypatch.setattr(email_sync.settings, "imap_idle_max_connections", 3)
+
+    stop_event = asyncio.Event()
+    task = asyncio.create_task(email_sync.watch_imap_accounts(stop_event))
+    for _ in range(5):
+        await asyncio.sleep(0)
+    assert watching == [a.id for a in accounts[:3]]
+
+    stop_event.set()
+    await asyncio.wait_for(task, 2)
+    assert watching == []
+
+
+class _BulkSession:
+    """_bulk_insert_messages 用：ON CONFLICT 略過 existing 中的 provider_message_id"""
+
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+        self.inserted_rows = None
+        self.statement = None
+
+    async def scalars(self, stmt, rows):
+        self.statement = stmt
+        self.inserted_rows = rows
+        return _Result([
+            SimpleNamespace(**row) for row in rows
+            if row["provider_message_id"] not in self.existing
+        ])
+
+
+@pytest.fixture
+def bodies(monkeypatch):
+    calls = SimpleNamespace(saved=[], orphans=[])
+
+    async def save(db, pairs):
+        calls.saved.extend(pairs)
+        return [f"h-{plain}" for plain, _ in pairs]
+
+    async def delete_orphans(db, hashes):
+        calls.orphans.append(sorted(hashes))
+
+    monkeypatch.setattr(email_sync.body_store, "save", save)
+    monkeypatch.setattr(email_sync.body_store, "delete_orphans", delete_orphans)
+    return calls
+
+
+def _detail(pid, body=None):
+    detail = {"provider_message_id": pid, "subject": pid, "body_fetched_at": None}
+    if body is not None:
+        detail.update(body_plain=body, body_html=None, body_fetched_at=NOW)
+    return detail
+
+
+async def test_bulk_insert_cleans_bodies_of_conflicting_rows(bodies):
+    db = _BulkSession(existing={"m2", "m3"})
+    details = [_detail("m1", "a"), _detail("m2", "b"), _detail("m3", "a"), _detail("m4")]
+    inserted = await email_sync._bulk_insert_messages(db, "acc", "ws", details)
+
+    assert [m.provider_message_id for m in inserted] == ["m1", "m4"]
+    assert [row["body_hash"] for row in db.inserted_rows] == ["h-a", "h-b", "h-a", None]
+    # m3 的內文和已寫入的 m1 相同，由 delete_orphans 的引用檢查保留
+    assert bodies.orphans == [["h-a", "h-b"]]
+
+
+async def test_bulk_insert_is_one_on_conflict_statement(bodies):
+    db = _BulkSession()
+    details = [_detail("m1", "a"), _detail("m2")]
+    await email_sync._bulk_insert_messages(db, "acc", "ws", details)
+
+    sql = str(db.statement.compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (account_id, provider_message_id) DO NOTHING" in sql
+    assert "RETURNING" in sql
+    # 內文只寫進 body_store，信件列不帶 body_plain / body_html
+    assert db.inserted_rows[0] == {
+        "account_id": "acc", "workspace_id": "ws", "provider_message_id": "m1",
+        "subject": "m1", "body_fetched_at": NOW, "body_hash": "h-a",
+    }
+    assert db.inserted_rows[1]["body_hash"] is None
+    assert bodies.saved == [("a", None)]
+
+
+async def test_bulk_insert_empty_batch_does_nothing(bodies):
+    db = _BulkSession()
+    assert await email_sync._bulk_insert_messages(db, "acc", "ws", []) == []
+    assert db.statement is None and bodies.saved == []
+
+
+async def test_filter_known_messages_is_single_query_preserving_order():
+    db = _ScriptedSession(["m2", "m4"])
+    ids = ["m1", "m2", "m3", "m4"]
+    assert await email_sync._filter_known_messages(db, "acc", ids) == ["m1", "m3"]
+    assert len(db.statements) == 1
+    assert "IN" in str(db.statements[0].compile(dialect=postgresql.dialect()))
+
+
+async def test_filter_known_messages_skips_query_for_empty_input():
+    db = _ScriptedSession()
+    assert await email_sync._filter_known_messages(db, "acc", []) == []
+    assert db.statements == []
+
+
+async def test_bulk_insert_without_conflicts_skips_orphan_check(bodies):
+    db = _BulkSession()
+    inserted = await email_sync._bulk_insert_messages(db, "acc", "ws", [_detail("m1", "a")])
+    assert len(inserted) == 1
+    assert bodies.orphans == []
+
+
+class _UserLookup:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.lookups = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def scalar(self, stmt):
+        self.lookups += 1
+        return self.user_id
+
+
+@pytest.fixture
+def limited_sync(monkeypatch):
+    synced = []
+
+    async def sync_account(account_id):
+        synced.append(account_id)
+        return 0
+
+    async def record(account_id, new_count, error):
+        pass
+
+    monkeypatch.setattr(email_sync, "sync_account", sync_account)
+    monkeypatch.setattr(email_sync, "_record_sync_result", record)
+    monkeypatch.setattr(email_sync, "_user_limits", email_sync.defaultdict(asyncio.Semaphore))
+    return synced
+
+
+async def test_missing_user_id_is_resolved_from_account(limited_sync, monkeypatch):
+    user_id, account_id = uuid.uuid4(), uuid.uuid4()
+    lookup = _UserLookup(user_id)
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", lookup)
+    await email_sync._run_limited_sync(account_id, None)
+    assert limited_sync == [account_id]
+    assert list(email_sync._user_limits) == [user_id]
+
+
+async def test_unknown_account_skips_user_limit(limited_sync, monkeypatch):
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", _UserLookup(None))
+    await email_sync._run_limited_sync(uuid.uuid4(), None)
+    assert len(limited_sync) == 1
+    assert None not in email_sync._user_limits
+
+
+async def test_known_user_id_skips_lookup(limited_sync, monkeypatch):
+    lookup = _UserLookup(uuid.uuid4())
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", lookup)
+    user_id = uuid.uuid4()
+    await email_sync._run_limited_sync(uuid.uuid4(), user_id)
+    assert lookup.lookups == 0
+    assert list(email_sync._user_limits) == [user_id]
+
+
+class _DueAccounts(_UserLookup):
+    def __init__(self, rows):
+        super().__init__(None)
+        self.rows = rows
+
+    async def execute(self, stmt):
+        return _Result(self.rows)
+
+
+async def test_sync_all_accounts_respects_global_and_per_user_limits(monkeypatch):
+    users = [uuid.uuid4(), uuid.uuid4()]
+    rows = [
+        SimpleNamespace(id=uuid.uuid4(), user_id=users[i % 2], next_sync_at=NOW)
+        for i in range(8)
+    ]
+    running = {"all": 0, users[0]: 0, users[1]: 0}
+    peak = {"all": 0, users[0]: 0, users[1]: 0}
+    owner = {row.id: row.user_id for row in rows}
+    synced = []
+
+    async def sync_account(account_id):
+        user = owner[account_id]
+        for key in ("all", user):
+            running[key] += 1
+            peak[key] = max(peak[key], running[key])
+        await asyncio.sleep(0.01)
+        for key in ("all", user):
+            running[key] -= 1
+        synced.append(account_id)
+        return 0
+
+    async def record(account_id, new_count, error):
+        pass
+
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", _DueAccounts(rows))
+    monkeypatch.setattr(email_sync, "sync_account", sync_account)
+    monkeypatch.setattr(email_sync, "_record_sync_result", record)
+    monkeypatch.setattr(email_sync, "_global_limit", asyncio.Semaphore(3))
+    monkeypatch.setattr(
+        email_sync, "_user_limits", email_sync.defaultdict(lambda: asyncio.Semaphore(2))
+    )
+
+    await email_sync.sync_all_accounts()
+    assert sorted(synced) == sorted(row.id for row in rows)
+    assert peak["all"] == 3
+    assert peak[users[0]] == 2 and peak[users[1]] == 2
+
+
+async def test_one_failing_account_does_not_stop_the_cycle(monkeypatch):
+    rows = [SimpleNamespace(id=uuid.uuid4(), user_id=uuid.uuid4(), next_sync_at=NOW)
+            for _ in range(3)]
+    results = {}
+
+    async def sync_account(account_id):
+        if account_id == rows[0].id:
+            raise RuntimeError("gmail down")
+        return 1
+
+    async def record(account_id, new_count, error):
+        results[account_id] = (new_count, error)
+
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", _DueAccounts(rows))
+    monkeypatch.setattr(email_sync, "sync_account", sync_account)
+    monkeypatch.setattr(email_sync, "_record_sync_result", record)
+
+    await email_sync.sync_all_accounts()
+    assert isinstance(results[rows[0].id][1], RuntimeError)
+    assert results[rows[1].id] == (1, None) and results[rows[2].id] == (1, None)
+
+
+class _FrozenDatetime(datetime):
+    @classmethod
+    def utcnow(cls):
+        return NOW
+
+
+class _AccountSession:
+    """_record_sync_result 用：db.get 回傳同一個帳號物件並記錄 commit"""
+
+    def __init__(self, account):
+        self.account = account
+        self.commits = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def get(self, model, account_id, options=None):
+        return self.account
+
+    async def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture
+def scheduled(monkeypatch):
+    account = SimpleNamespace(
+        provider="imap", email_address="a@example.com", sync_state=None,
+        sync_interval_seconds=120, sync_failures=0, sync_error=None,
+        next_sync_at=None, quarantined_at=None,
+    )
+    session = _AccountSession(account)
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", session)
+    monkeypatch.setattr(email_sync, "datetime", _FrozenDatetime)
+    monkeypatch.setattr(email_sync.settings, "sync_backoff_base_seconds", 120)
+    monkeypatch.setattr(email_sync.settings, "sync_backoff_max_seconds", 1000)
+    monkeypatch.setattr(email_sync.settings, "sync_quarantine_after", 3)
+    return account
+
+
+async def test_failures_back_off_exponentially_up_to_max(scheduled):
+    delays = []
+    for _ in range(5):
+        await email_sync._record_sync_result("acc", 0, RuntimeError("timeout"))
+        delays.append((scheduled.next_sync_at - NOW).total_seconds())
+    assert delays == [120, 240, 480, 960, 1000]
+    assert scheduled.sync_failures == 5
+    assert scheduled.sync_error == "RuntimeError: timeout"
+    # 暫時性錯誤不會隔離帳號
+    assert scheduled.quarantined_at is None
+
+
+async def test_success_resets_failures_and_uses_adaptive_interval(scheduled):
+    scheduled.sync_failures = 4
+    await email_sync._record_sync_result("acc", 2, None)
+    assert scheduled.sync_failures == 0
+    assert scheduled.sync_interval_seconds == 60
+    assert scheduled.next_sync_at == NOW + timedelta(seconds=60)
+
+    await email_sync._record_sync_result("acc", 0, None)
+    assert scheduled.sync_interval_seconds == 90
+
+
+async def test_persistent_auth_errors_quarantine_account(scheduled):
+    error = email_sync.imap_service.LoginError("bad password")
+    for _ in range(2):
+        await email_sync._record_sync_result("acc", 0, error)
+    assert scheduled.quarantined_at is None
+    await email_sync._record_sync_result("acc", 0, error)
+    assert scheduled.quarantined_at == NOW
+
+
+async def test_missing_account_is_ignored(scheduled, monkeypatch):
+    session = _AccountSession(None)
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", session)
+    await email_sync._record_sync_result("acc", 0, None)
+    assert session.commits == 0
+
+
+class _FenceSession:
+    def __init__(self, rowcount=1, returned="acc"):
+        self.rowcount = rowcount
+        self.returned = returned
+        self.statements = []
+
+    async def execute(self, stmt):
+        self.statements.append(stmt)
+        return SimpleNamespace(
+            rowcount=self.rowcount, scalar_one_or_none=lambda: self.returned
+        )
+
+
+def _lease(fence=7, lost=False):
+    lease = email_sync.sync_lease.SyncLease("k", "v", fence, 30000)
+    lease.lost = lost
+    return lease
+
+
+def _sql(stmt):
+    return str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+async def test_claim_fence_is_conditional_update():
+    db = _FenceSession()
+    await email_sync._claim_fence(db, "acc", _lease(fence=7))
+    sql = _sql(db.statements[0])
+    assert "SET lease_fence=7" in sql
+    assert "lease_fence IS NULL OR email_sync_states.lease_fence <= 7" in sql
+
+
+async def test_claim_fence_rejects_newer_fence():
+    with pytest.raises(email_sync.sync_lease.LeaseLostError):
+        await email_sync._claim_fence(_FenceSession(rowcount=0), "acc", _lease())
+
+
+async def test_lost_lease_never_writes():
+    db = _FenceSession()
+    with pytest.raises(email_sync.sync_lease.LeaseLostError):
+        await email_sync._claim_fence(db, "acc", _lease(lost=True))
+    with pytest.raises(email_sync.sync_lease.LeaseLostError):
+        await email_sync._insert_fenced_state(db, "acc", _lease(lost=True), last_history_id=1)
+    assert db.statements == []
+
+
+async def test_insert_fenced_state_upserts_only_over_older_fence():
+    db = _FenceSession()
+    await email_sync._insert_fenced_state(db, uuid.uuid4(), _lease(fence=3), last_history_id=9)
+    sql = _sql(db.statements[0])
+    assert "ON CONFLICT (account_id) DO UPDATE" in sql
+    assert "WHERE email_sync_states.lease_fence IS NULL" in sql
+    assert "email_sync_states.lease_fence <= 3" in sql
+
+    with pytest.raises(email_sync.sync_lease.LeaseLostError):
+        await email_sync._insert_fenced_state(
+            _FenceSession(returned=None), uuid.uuid4(), _lease(), last_history_id=9
+        )
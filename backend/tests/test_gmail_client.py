@@ -0,0 +1,316 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from app.services import gmail_client
+from app.services.gmail_client import AsyncGmailClient
+
+
+def _http_error(status, reason=""):
+    return HttpError(httplib2.Response({"status": status}), reason.encode())
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+
+    async def sleep(seconds):
+        recorded.append(seconds)
+
+    async def run_inline(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    monkeypatch.setattr(gmail_client.asyncio, "sleep", sleep)
+    monkeypatch.setattr(gmail_client, "run_in_gmail_pool", run_inline)
+    monkeypatch.setattr(gmail_client.settings, "gmail_rate_limit_retries", 2)
+    monkeypatch.setattr(gmail_client.settings, "gmail_rate_limit_backoff_base_seconds", 2)
+    return recorded
+
+
+def _client(quota_key="acc"):
+    client = AsyncGmailClient("token", quota_key=quota_key)
+    client._service = object()
+    client._http = lambda: None
+    return client
+
+
+def _flaky(*errors):
+    remaining = list(errors)
+    calls = []
+
+    def fn(service, *args, http=None, quota=None, **kwargs):
+        calls.append(quota)
+        if remaining:
+            raise remaining.pop(0)
+        return "ok"
+
+    return fn, calls
+
+
+async def test_local_backoff_when_quota_report_fails(sleeps, monkeypatch):
+    async def broken(user_key):
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(gmail_client.gmail_quota, "report_rate_limited", broken)
+    fn, calls = _flaky(_http_error(429), _http_error(429))
+    assert await _client()._call(fn) == "ok"
+    assert len(calls) == 3
+    assert sleeps == [2, 4]
+
+
+async def test_shared_backoff_is_slept_locally(sleeps, monkeypatch):
+    async def report(user_key):
+        return 8
+
+    monkeypatch.setattr(gmail_client.gmail_quota, "report_rate_limited", report)
+    fn, _ = _flaky(_http_error(403, "userRateLimitExceeded"))
+    assert await _client()._call(fn) == "ok"
+    assert sleeps == [8]
+
+
+async def test_backoff_never_below_base(sleeps, monkeypatch):
+    async def report(user_key):
+        return 0
+
+    monkeypatch.setattr(gmail_client.gmail_quota, "report_rate_limited", report)
+    fn, _ = _flaky(_http_error(429))
+    await _client()._call(fn)
+    assert sleeps == [2]
+
+
+async def test_without_quota_uses_exponential_backoff(sleeps):
+    fn, calls = _flaky(_http_error(429), _http_error(429))
+    assert await _client(quota_key=None)._call(fn) == "ok"
+    assert calls == [None, None, None]
+    assert sleeps == [2, 4]
+
+
+async def test_gives_up_after_retries(sleeps):
+    fn, calls = _flaky(*[_http_error(429)] * 3)
+    with pytest.raises(HttpError):
+        await _client(quota_key=None)._call(fn)
+    assert len(calls) == 3
+
+
+async def test_non_rate_limit_errors_are_not_retried(sleeps):
+    fn, calls = _flaky(_http_error(404))
+    with pytest.raises(HttpError):
+        await _client(quota_key=None)._call(fn)
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+# ── thread pool（Gmail I/O 不佔用 event loop） ───────────────────
+
+
+async def test_blocking_gmail_call_does_not_block_event_loop():
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    task = asyncio.create_task(ticker())
+    thread_name = await gmail_client.run_in_gmail_pool(
+        lambda: (time.sleep(0.2), threading.current_thread().name)[1]
+    )
+    task.cancel()
+    assert thread_name.startswith("gmail")
+    assert ticks >= 5
+
+
+async def test_each_pool_thread_reuses_its_own_http():
+    def grab():
+        time.sleep(0.05)  # 讓多個 thread 同時存在
+        return threading.get_ident(), gmail_client._thread_http()
+
+    results = await asyncio.gather(*(gmail_client.run_in_gmail_pool(grab) for _ in range(4)))
+    by_thread = {}
+    for ident, http in results:
+        by_thread.setdefault(ident, set()).add(id(http))
+    assert all(len(https) == 1 for https in by_thread.values())
+    assert len({next(iter(h)) for h in by_thread.values()}) == len(by_thread)
+
+
+async def test_client_methods_run_in_pool_with_thread_http(monkeypatch):
+    seen = {}
+
+    def fetch_changes(service, max_results, after_history_id, http=None, quota=None):
+        seen.update(
+            thread=threading.current_thread().name,
+            http=http.http,
+            thread_http=gmail_client._thread_http(),
+            args=(max_results, after_history_id),
+        )
+        return "changes"
+
+    monkeypatch.setattr(gmail_client.gmail_service, "fetch_changes", fetch_changes)
+    client = AsyncGmailClient("token")
+    client._service = object()
+    assert await client.fetch_changes(max_results=10, after_history_id=5) == "changes"
+    assert seen["thread"].startswith("gmail")
+    assert seen["http"] is seen["thread_http"]
+    assert seen["args"] == (10, 5)
+
+
+# ── client_for_account 快取 ──────────────────────────────────
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    built = []
+
+    def build_service(name, version, credentials):
+        built.append(credentials.token)
+        return object()
+
+    async def run_inline(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    monkeypatch.setattr(gmail_client, "_clients", {})
+    monkeypatch.setattr(gmail_client, "run_in_gmail_pool", run_inline)
+    monkeypatch.setattr(gmail_client.gmail_service, "build_service", build_service)
+    monkeypatch.setattr(gmail_client.token_manager, "decrypt", lambda c: c and f"plain-{c}")
+    monkeypatch.setattr(gmail_client.settings, "gmail_client_idle_seconds", 60)
+    return built
+
+
+def _gmail_account(access="a1", refresh="r1", expires_in=3600):
+    return SimpleNamespace(
+        id="acc",
+        encrypted_access_token=access,
+        encrypted_refresh_token=refresh,
+        token_expires_at=datetime.utcnow() + timedelta(seconds=expires_in),
+    )
+
+
+async def test_client_is_cached_per_account(cache):
+    account = _gmail_account()
+    first = await gmail_client.client_for_account(account)
+    assert await gmail_client.client_for_account(account) is first
+    assert cache == ["plain-a1"]
+    assert first.quota_key == "acc"
+
+
+async def test_newer_access_token_is_swapped_in_without_rebuild(cache):
+    first = await gmail_client.client_for_account(_gmail_account())
+    # 其他 process refresh 過：DB 有較新的 access token 與到期時間
+    account = _gmail_account(access="a2", expires_in=7200)
+    client = await gmail_client.client_for_account(account)
+    assert client is first
+    assert client.credentials.token == "plain-a2"
+    assert client.credentials.expiry == account.token_expires_at
+    assert cache == ["plain-a1"]
+
+
+async def test_reauthorization_rebuilds_client(cache):
+    first = await gmail_client.client_for_account(_gmail_account())
+    second = await gmail_client.client_for_account(_gmail_account(access="a2", refresh="r2"))
+    assert second is not first
+    assert second.credentials.refresh_token == "plain-r2"
+    assert cache == ["plain-a1", "plain-a2"]
+
+
+async def test_idle_clients_are_evicted(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(gmail_client.time, "monotonic", lambda: now[0])
+    first = await gmail_client.client_for_account(_gmail_account())
+    now[0] += 61
+    assert await gmail_client.client_for_account(_gmail_account()) is not first
+
+
+async def test_account_without_token_has_no_client(cache):
+    assert await gmail_client.client_for_account(_gmail_account(access=None)) is None
+    assert cache == []
+
+
+def test_discovery_document_is_parsed_once(monkeypatch):
+    reads = []
+
+    def get_static_doc(name, version):
+        reads.append((name, version))
+        return '{"name": "gmail"}'
+
+    service_module = gmail_client.gmail_service
+    monkeypatch.setattr(service_module, "_discovery_docs", {})
+    monkeypatch.setattr(service_module.discovery_cache, "get_static_doc", get_static_doc)
+    first = service_module._discovery_document("gmail", "v1")
+    assert service_module._discovery_document("gmail", "v1") is first
+    assert reads == [("gmail", "v1")]
+
+
+def test_build_service_does_not_fetch_discovery_over_network():
+    service = gmail_client.gmail_service.build_service(
+        "gmail", "v1", gmail_client.gmail_service.build_credentials("token")
+    )
+    assert hasattr(service, "users")
+
+
+# ── Token refresh ────────────────────────────────────────────
+
+
+class _Creds:
+    def __init__(self, expires_in):
+        self.token = "old"
+        self.refresh_token = "r1"
+        self.expiry = datetime.utcnow() + timedelta(seconds=expires_in)
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = f"new-{self.refreshes}"
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+@pytest.fixture
+def persisted(monkeypatch):
+    calls = []
+
+    async def persist(account_id, creds, previous_refresh_token):
+        await asyncio.sleep(0)
+        calls.append((account_id, creds.token, previous_refresh_token))
+
+    async def run_inline(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    monkeypatch.setattr(gmail_client.token_manager, "persist", persist)
+    monkeypatch.setattr(gmail_client, "run_in_gmail_pool", run_inline)
+    monkeypatch.setattr(gmail_client, "_refresh_locks", gmail_client.defaultdict(asyncio.Lock))
+    return calls
+
+
+async def test_refresh_only_when_within_margin(persisted):
+    creds = _Creds(expires_in=3600)
+    assert await gmail_client._refresh("acc", creds, margin_seconds=300) is False
+    assert await gmail_client._refresh("acc", creds, margin_seconds=7200) is True
+    assert persisted == [("acc", "new-1", "r1")]
+
+
+async def test_concurrent_refreshes_hit_token_endpoint_once(persisted):
+    creds = _Creds(expires_in=10)
+    results = await asyncio.gather(
+        *(gmail_client._refresh("acc", creds, margin_seconds=300) for _ in range(3))
+    )
+    assert sorted(results) == [False, False, True]
+    assert creds.refreshes == 1 and len(persisted) == 1
+
+
+async def test_refresh_account_token_uses_margin(persisted, monkeypatch):
+    creds = _Creds(expires_in=120)
+    client = SimpleNamespace(credentials=creds)
+
+    async def client_for_account(account):
+        return client
+
+    monkeypatch.setattr(gmail_client, "client_for_account", client_for_account)
+    monkeypatch.setattr(gmail_client.settings, "token_refresh_margin_seconds", 300)
+    assert await gmail_client.refresh_account_token(SimpleNamespace(id="acc")) is True
+    assert creds.refreshes == 1
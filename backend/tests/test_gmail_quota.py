@@ -0,0 +1,120 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from app.core import metrics
+from app.core import redis as redis_module
+from app.services import gmail_quota
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(redis_module, "_client", client)
+    s = gmail_quota.settings
+    # user：100 units/s、容量 10；project：1000 units/s、容量 100
+    monkeypatch.setattr(s, "gmail_user_quota_units_per_second", 100)
+    monkeypatch.setattr(s, "gmail_project_quota_units_per_second", 1000)
+    monkeypatch.setattr(s, "gmail_quota_headroom", 1.0)
+    monkeypatch.setattr(s, "gmail_quota_burst_seconds", 0.1)
+    monkeypatch.setattr(s, "gmail_rate_limit_backoff_base_seconds", 2)
+    monkeypatch.setattr(s, "gmail_rate_limit_backoff_max_seconds", 60)
+    monkeypatch.setattr(s, "google_client_id", "client")
+    return client
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        recorded.append(seconds)
+        await real_sleep(seconds)
+
+    monkeypatch.setattr(gmail_quota.asyncio, "sleep", sleep)
+    return recorded
+
+
+async def _tokens(redis, key):
+    return float(await redis.hget(key, "tokens"))
+
+
+async def test_acquire_deducts_from_user_and_project_buckets(redis, sleeps):
+    await gmail_quota.acquire("u1", 4)
+    assert await _tokens(redis, "mailcake:gmail_quota:user:u1") == pytest.approx(6, abs=0.5)
+    assert await _tokens(redis, "mailcake:gmail_quota:project:client") == pytest.approx(
+        96, abs=5
+    )
+    assert sleeps == []
+
+
+async def test_exhausted_user_bucket_waits_for_refill(redis, sleeps):
+    await gmail_quota.acquire("u1", 10)
+    await gmail_quota.acquire("u1", 5)
+    # 5 units / 100 units/s ≈ 50ms
+    assert len(sleeps) >= 1 and 0 < sleeps[0] <= 0.05
+    # 其他用戶有自己的 bucket
+    sleeps.clear()
+    await gmail_quota.acquire("u2", 10)
+    assert sleeps == []
+
+
+async def test_request_larger_than_capacity_passes_when_full(redis, sleeps):
+    await gmail_quota.acquire("u1", 25)
+    assert sleeps == []
+    # 扣成負值，後續呼叫被延後
+    assert await _tokens(redis, "mailcake:gmail_quota:user:u1") < 0
+
+
+async def test_project_bucket_is_shared_between_users(redis, sleeps, monkeypatch):
+    # project：200 units/s、容量 20
+    monkeypatch.setattr(gmail_quota.settings, "gmail_project_quota_units_per_second", 200)
+    await gmail_quota.acquire("u1", 10)
+    await gmail_quota.acquire("u2", 10)
+    assert sleeps == []
+    await gmail_quota.acquire("u3", 10)
+    assert sleeps  # 各用戶 bucket 仍有餘額，但 project 容量已用完
+
+
+async def test_rate_limit_backoff_grows_and_is_capped(redis):
+    delays = [await gmail_quota.report_rate_limited("u1") for _ in range(7)]
+    assert delays == [2, 4, 8, 16, 32, 60, 60]
+    assert 0 < await redis.pttl("mailcake:gmail_quota:backoff:u1") <= 60000
+
+
+async def test_acquire_waits_while_user_is_backing_off(redis, sleeps, monkeypatch):
+    monkeypatch.setattr(gmail_quota.settings, "gmail_rate_limit_backoff_base_seconds", 0.05)
+    await gmail_quota.report_rate_limited("u1")
+    await gmail_quota.acquire("u1", 1)
+    assert sleeps and sleeps[0] <= 0.05
+    sleeps.clear()
+    await gmail_quota.acquire("u2", 1)
+    assert sleeps == []
+
+
+async def test_limiter_fails_open_without_redis(monkeypatch, sleeps):
+    class _Down:
+        async def eval(self, *args):
+            raise ConnectionError("redis down")
+
+        async def incr(self, key):
+            raise ConnectionError("redis down")
+
+    monkeypatch.setattr(redis_module, "_client", _Down())
+    monkeypatch.setattr(gmail_quota.settings, "gmail_rate_limit_backoff_base_seconds", 2)
+    before = metrics.snapshot()["counters"].get("gmail_quota.limiter_errors", 0)
+
+    await gmail_quota.acquire("u1", 5)
+    assert sleeps == []
+    assert metrics.snapshot()["counters"]["gmail_quota.limiter_errors"] == before + 1
+    assert await gmail_quota.report_rate_limited("u1") == 2
+
+
+async def test_quota_charger_blocks_pool_thread_until_acquired(redis):
+    charger = gmail_quota.QuotaCharger("u1", asyncio.get_running_loop())
+    await asyncio.to_thread(charger.charge, 4)
+    await asyncio.to_thread(charger.backoff)
+    assert await _tokens(redis, "mailcake:gmail_quota:user:u1") == pytest.approx(6, abs=0.5)
+    assert await redis.exists("mailcake:gmail_quota:backoff:u1")
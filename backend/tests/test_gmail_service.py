@@ -0,0 +1,352 @@
+import base64
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from app.services import gmail_service
+
+
+def _http_error(status, reason=""):
+    return HttpError(httplib2.Response({"status": status}), reason.encode())
+
+
+def _message(message_id, labels=("INBOX", "UNREAD"), body="hello"):
+    data = base64.urlsafe_b64encode(body.encode()).decode()
+    return {
+        "id": message_id,
+        "threadId": f"t-{message_id}",
+        "labelIds": list(labels),
+        "snippet": body,
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": [
+                {"name": "Subject", "value": f"subject {message_id}"},
+                {"name": "From", "value": "Alice <alice@example.com>"},
+            ],
+            "body": {"data": data},
+        },
+    }
+
+
+class _Request:
+    def __init__(self, gmail, method, kwargs):
+        self.gmail = gmail
+        self.method = method
+        self.kwargs = kwargs
+
+    def execute(self, http=None):
+        self.gmail.calls.append((self.method, self.kwargs))
+        outcome = self.gmail.responses[self.method].pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class _Resource:
+    def __init__(self, gmail, name):
+        self.gmail = gmail
+        self.name = name
+
+    def get(self, **kwargs):
+        return _Request(self.gmail, f"{self.name}.get", kwargs)
+
+    def list(self, **kwargs):
+        return _Request(self.gmail, f"{self.name}.list", kwargs)
+
+
+class _Batch:
+    def __init__(self, gmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request.kwargs))
+
+    def execute(self, http=None):
+        self.gmail.batches.append([rid for rid, _ in self.requests])
+        if self.gmail.batch_errors:
+            raise self.gmail.batch_errors.pop(0)
+        for request_id, _ in self.requests:
+            outcome = self.gmail.outcomes[request_id].pop(0)
+            if isinstance(outcome, Exception):
+                self.callback(request_id, None, outcome)
+            else:
+                self.callback(request_id, outcome, None)
+
+
+class FakeGmail:
+    """googleapiclient Gmail service 的最小替身：每個方法依序回傳預先排好的結果"""
+
+    def __init__(self, responses=None, outcomes=None, batch_errors=()):
+        self.responses = responses or {}
+        self.outcomes = outcomes or {}
+        self.batch_errors = list(batch_errors)
+        self.calls = []
+        self.batches = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Resource(self, "messages")
+
+    def history(self):
+        return _Resource(self, "history")
+
+    def getProfile(self, **kwargs):  # noqa: N802
+        return _Request(self, "getProfile", kwargs)
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback)
+
+
+class FakeQuota:
+    def __init__(self):
+        self.charged = []
+        self.backoffs = 0
+
+    def charge(self, units):
+        self.charged.append(units)
+
+    def backoff(self):
+        self.backoffs += 1
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(gmail_service._time, "sleep", sleeps.append)
+    return sleeps
+
+
+# ── get_message_details_batch ─────────────────────────────────
+
+
+def test_batch_retries_only_failed_subrequests(no_sleep):
+    gmail = FakeGmail(outcomes={
+        "m1": [_message("m1")],
+        "m2": [_http_error(429), _message("m2")],
+        "m3": [_http_error(404)],
+    })
+    details, failed = gmail_service.get_message_details_batch(gmail, ["m1", "m2", "m3"])
+    assert [d["provider_message_id"] for d in details] == ["m1", "m2"]
+    assert failed == ["m3"]
+    assert gmail.batches == [["m1", "m2", "m3"], ["m2"]]
+    assert no_sleep == [2]
+
+
+def test_batch_splits_into_chunks_and_dedups(monkeypatch):
+    ids = ["a", "b", "c", "a", "d", "e"]
+    gmail = FakeGmail(outcomes={i: [_message(i)] for i in set(ids)})
+    quota = FakeQuota()
+    details, failed = gmail_service.get_message_details_batch(
+        gmail, ids, batch_size=2, quota=quota
+    )
+    assert gmail.batches == [["a", "b"], ["c", "d"], ["e"]]
+    assert quota.charged == [10, 10, 5]
+    assert [d["provider_message_id"] for d in details] == ["a", "b", "c", "a", "d", "e"]
+    assert failed == []
+
+
+def test_batch_rate_limit_notifies_quota_limiter():
+    gmail = FakeGmail(outcomes={
+        "m1": [_http_error(403, "userRateLimitExceeded"), _message("m1")],
+    })
+    quota = FakeQuota()
+    details, _ = gmail_service.get_message_details_batch(gmail, ["m1"], quota=quota)
+    assert len(details) == 1
+    assert quota.backoffs == 1
+
+
+def test_whole_batch_failure_is_retried():
+    gmail = FakeGmail(
+        outcomes={"m1": [_message("m1")], "m2": [_message("m2")]},
+        batch_errors=[_http_error(503)],
+    )
+    details, failed = gmail_service.get_message_details_batch(gmail, ["m1", "m2"])
+    assert len(details) == 2 and failed == []
+    assert gmail.batches == [["m1", "m2"], ["m1", "m2"]]
+
+
+def test_whole_batch_non_retryable_error_is_raised():
+    gmail = FakeGmail(batch_errors=[_http_error(401)])
+    with pytest.raises(HttpError):
+        gmail_service.get_message_details_batch(gmail, ["m1"])
+
+
+def test_batch_gives_up_after_max_retries(no_sleep):
+    gmail = FakeGmail(outcomes={"m1": [_http_error(500)] * 3})
+    details, failed = gmail_service.get_message_details_batch(gmail, ["m1"], max_retries=2)
+    assert details == [] and failed == ["m1"]
+    assert len(gmail.batches) == 3
+    assert no_sleep == [2, 4]
+
+
+def test_unparseable_message_is_reported_as_failed():
+    gmail = FakeGmail(outcomes={"m1": [{"payload": {}}], "m2": [_message("m2")]})
+    details, failed = gmail_service.get_message_details_batch(gmail, ["m1", "m2"])
+    assert [d["provider_message_id"] for d in details] == ["m2"]
+    assert failed == ["m1"]
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (_http_error(429), True),
+        (_http_error(503), True),
+        (_http_error(403, "rateLimitExceeded"), True),
+        (_http_error(403, "userRateLimitExceeded"), True),
+        (_http_error(403, "dailyLimitExceeded"), False),
+        (_http_error(404), False),
+        (ValueError("x"), False),
+    ],
+)
+def test_is_retryable(error, expected):
+    assert gmail_service._is_retryable(error) is expected
+
+
+# ── fetch_changes ─────────────────────────────────────────────
+
+
+def _ref(message_id, labels=("INBOX",)):
+    return {"message": {"id": message_id, "labelIds": list(labels)}}
+
+
+def test_history_merges_pages_and_uses_last_history_id():
+    gmail = FakeGmail(responses={"history.list": [
+        {
+            "history": [
+                {"messagesAdded": [_ref("a"), _ref("draft", ("DRAFT",))]},
+                {"labelsAdded": [_ref("old", ("INBOX", "STARRED"))]},
+                {"messagesAdded": [_ref("gone")]},
+            ],
+            "historyId": "110",
+            "nextPageToken": "p2",
+        },
+        {
+            "history": [
+                {"messagesDeleted": [_ref("gone")]},
+                {"labelsRemoved": [_ref("a", ())]},
+                {"labelsRemoved": [_ref("old", ("INBOX",))]},
+                {"messagesAdded": [_ref("b")]},
+            ],
+            "historyId": "120",
+        },
+    ]})
+    changes = gmail_service.fetch_changes(gmail, after_history_id=100)
+
+    assert changes.added == ["a", "b"]
+    assert changes.deleted == ["gone"]
+    # 新信件會抓完整內容，不需要套用標籤變更；舊信件保留最後一次的完整標籤
+    assert changes.label_updates == {"old": ["INBOX"]}
+    assert changes.history_id == 120
+    assert changes.full_resync is False
+    assert [kwargs["pageToken"] for _, kwargs in gmail.calls] == [None, "p2"]
+    assert all(kwargs["startHistoryId"] == 100 for _, kwargs in gmail.calls)
+
+
+def test_history_deleted_then_readded_is_added():
+    gmail = FakeGmail(responses={"history.list": [{
+        "history": [
+            {"messagesDeleted": [_ref("m")]},
+            {"messagesAdded": [_ref("m")]},
+        ],
+    }]})
+    changes = gmail_service.fetch_changes(gmail, after_history_id=100)
+    assert changes.added == ["m"] and changes.deleted == []
+    # 回應沒有 historyId 時維持原本的起點
+    assert changes.history_id == 100
+
+
+def test_history_charges_quota_per_page():
+    gmail = FakeGmail(responses={"history.list": [
+        {"nextPageToken": "p2"},
+        {"historyId": "101"},
+    ]})
+    quota = FakeQuota()
+    gmail_service.fetch_changes(gmail, after_history_id=100, quota=quota)
+    units = gmail_service.QUOTA_UNITS["history.list"]
+    assert quota.charged == [units, units]
+
+
+def test_expired_history_falls_back_to_capped_full_sync(monkeypatch):
+    monkeypatch.setattr(gmail_service.settings, "gmail_full_resync_max", 3)
+    gmail = FakeGmail(responses={
+        "history.list": [_http_error(404)],
+        "getProfile": [{"historyId": "500"}],
+        "messages.list": [
+            {"messages": [{"id": "x1"}, {"id": "x2"}], "nextPageToken": "p2"},
+            {"messages": [{"id": "x3"}], "nextPageToken": "p3"},
+        ],
+    })
+    changes = gmail_service.fetch_changes(gmail, after_history_id=100)
+
+    assert changes.full_resync is True
+    assert changes.added == ["x1", "x2", "x3"]
+    assert changes.history_id == 500
+    lists = [kwargs for method, kwargs in gmail.calls if method == "messages.list"]
+    assert [(k["maxResults"], k["pageToken"]) for k in lists] == [(3, None), (1, "p2")]
+    assert all(k["q"] == "in:inbox" for k in lists)
+
+
+def test_other_history_errors_are_raised():
+    gmail = FakeGmail(responses={"history.list": [_http_error(500)]})
+    with pytest.raises(HttpError):
+        gmail_service.fetch_changes(gmail, after_history_id=100)
+
+
+def test_first_sync_lists_recent_messages():
+    gmail = FakeGmail(responses={
+        "getProfile": [{"historyId": "42"}],
+        "messages.list": [{"messages": [{"id": "m1"}]}],
+    })
+    changes = gmail_service.fetch_changes(gmail, max_results=10)
+    assert changes.added == ["m1"] and changes.history_id == 42 and changes.full_resync
+    assert [method for method, _ in gmail.calls] == ["getProfile", "messages.list"]
+
+
+# ── metadata-first 解析 ──────────────────────────────────────
+
+
+def test_metadata_message_has_no_body():
+    msg = _message("m1", labels=("INBOX", "STARRED"))
+    del msg["payload"]["body"]
+    msg["payload"]["mimeType"] = "multipart/mixed"
+    detail = gmail_service._parse_message(msg)
+
+    assert detail["body_plain"] is None and detail["body_html"] is None
+    assert detail["analysis_text"] is None
+    assert detail["body_fetched_at"] is None
+    assert detail["has_attachments"] is True
+    assert detail["subject"] == "subject m1"
+    assert detail["is_read"] is True and detail["is_starred"] is True
+
+
+def test_full_message_records_body_and_fetch_time():
+    detail = gmail_service._parse_message(_message("m1", body="hello there"))
+    assert detail["body_plain"] == "hello there"
+    assert detail["analysis_text"] == "hello there"
+    assert detail["body_fetched_at"] is not None
+    assert detail["is_read"] is False
+
+
+class _RecordingBatch(_Batch):
+    def __init__(self, gmail, callback, requests):
+        super().__init__(gmail, callback)
+        self.recorded = requests
+
+    def add(self, request, request_id):
+        self.recorded.append(request.kwargs)
+        super().add(request, request_id)
+
+
+def test_batch_requests_metadata_format():
+    gmail = FakeGmail(outcomes={"m1": [_message("m1")]})
+    requests = []
+    gmail.new_batch_http_request = lambda callback: _RecordingBatch(gmail, callback, requests)
+    gmail_service.get_message_details_batch(gmail, ["m1"], format="metadata")
+    assert requests[0]["format"] == "metadata"
+    assert requests[0]["fields"] == gmail_service.METADATA_FIELDS
+    assert requests[0]["metadataHeaders"] == gmail_service.METADATA_HEADERS
@@ -0,0 +1,282 @@
+import asyncio
+import socket
+import threading
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import imap_service
+from app.services.imap_service import _fetch_changes, _PooledConnection
+
+
+class FakeIMAPClient:
+    """只實作 _fetch_changes 用到的 select_folder / search / fetch"""
+
+    def __init__(
+        self, uids, uidvalidity=7, uidnext=None, highest_modseq=None, flags=None, vanished=()
+    ):
+        self.uids = sorted(uids)
+        self.status = {b"UIDVALIDITY": uidvalidity}
+        if uidnext is not None:
+            self.status[b"UIDNEXT"] = uidnext
+        if highest_modseq is not None:
+            self.status[b"HIGHESTMODSEQ"] = highest_modseq
+        self.flags = flags or {}
+        self.vanished = list(vanished)
+        self.searches = []
+        self.fetches = []
+        self._imap = SimpleNamespace(untagged_responses={})
+
+    def select_folder(self, folder, readonly=False):
+        assert readonly
+        return self.status
+
+    def search(self, criteria):
+        self.searches.append(criteria)
+        if criteria == "ALL":
+            return list(self.uids)
+        start = int(criteria[1].split(":")[0])
+        found = [uid for uid in self.uids if uid >= start]
+        # 和真實伺服器一樣：`n:*` 沒有新信時仍回傳最後一封
+        return found or self.uids[-1:]
+
+    def fetch(self, messages, data, modifiers=None):
+        self.fetches.append((messages, data, modifiers))
+        if modifiers and "VANISHED" in modifiers and self.vanished:
+            self._imap.untagged_responses["VANISHED"] = self.vanished
+        return {uid: {b"FLAGS": flags} for uid, flags in self.flags.items()}
+
+
+def _conn(client, capabilities=("IMAP4REV1", "CONDSTORE")):
+    return _PooledConnection(
+        client=client,
+        password_hash=0,
+        lock=threading.Lock(),
+        last_used=0.0,
+        capabilities=frozenset(capabilities),
+    )
+
+
+def test_first_sync_takes_latest_max_results():
+    client = FakeIMAPClient(range(1, 101), uidnext=101)
+    changes = _fetch_changes(_conn(client), "INBOX", None, None, None, max_results=10)
+    assert changes.full_resync
+    assert changes.new_uids == list(range(91, 101))
+    assert (changes.uidvalidity, changes.uidnext) == (7, 101)
+
+
+def test_uidvalidity_change_forces_resync():
+    client = FakeIMAPClient([5, 6, 7], uidvalidity=8, uidnext=8)
+    changes = _fetch_changes(_conn(client), "INBOX", 7, 50, None, max_results=50)
+    assert changes.full_resync
+    assert changes.new_uids == [5, 6, 7]
+
+
+QRESYNC = ("IMAP4REV1", "CONDSTORE", "QRESYNC")
+
+
+def test_incremental_sync_fetches_only_new_uids():
+    client = FakeIMAPClient([10, 11, 12, 13], uidnext=14)
+    changes = _fetch_changes(_conn(client, QRESYNC), "INBOX", 7, 12, None, max_results=50)
+    assert not changes.full_resync
+    assert changes.new_uids == [12, 13]
+    assert client.searches == [["UID", "12:*"]]
+    assert changes.present_uids is None
+
+
+def test_no_new_mail_filters_star_range_result():
+    client = FakeIMAPClient([10, 11], uidnext=12)
+    changes = _fetch_changes(_conn(client, QRESYNC), "INBOX", 7, 12, None, max_results=50)
+    assert changes.new_uids == []
+
+
+def test_without_qresync_lists_all_uids_for_deletion_check():
+    client = FakeIMAPClient([10, 12, 13], uidnext=14)
+    changes = _fetch_changes(_conn(client), "INBOX", 7, 12, None, max_results=50)
+    assert client.searches == ["ALL"]
+    assert changes.new_uids == [12, 13]
+    assert imap_service.deleted_uids(changes, [9, 10, 11, 12]) == [9, 11]
+
+
+def test_qresync_requests_vanished_with_changedsince():
+    client = FakeIMAPClient(
+        [1, 5],
+        uidnext=9,
+        highest_modseq=130,
+        flags={5: (b"\\Seen",)},
+        vanished=[b"(EARLIER) 2,7:6", b"8"],
+    )
+    changes = _fetch_changes(_conn(client, QRESYNC), "INBOX", 7, 9, 100, max_results=50)
+    assert client.fetches == [("1:8", ["FLAGS"], ["CHANGEDSINCE 100", "VANISHED"])]
+    assert changes.vanished == [(2, 2), (6, 7), (8, 8)]
+    assert changes.label_updates == {"INBOX:7:5": []}
+    assert imap_service.deleted_uids(changes, [1, 2, 3, 5, 7, 8]) == [2, 7, 8]
+    assert "VANISHED" not in client._imap.untagged_responses
+
+
+def test_qresync_without_modseq_change_reports_no_deletions():
+    client = FakeIMAPClient([1, 2], uidnext=3, highest_modseq=100)
+    changes = _fetch_changes(_conn(client, QRESYNC), "INBOX", 7, 3, 100, max_results=50)
+    assert client.fetches == []
+    assert imap_service.deleted_uids(changes, [1, 2]) == []
+
+
+def test_condstore_fetches_changed_flags_only():
+    client = FakeIMAPClient(
+        [1, 2, 3],
+        uidnext=4,
+        highest_modseq=120,
+        flags={1: (b"\\Seen",), 2: (b"\\Flagged",)},
+    )
+    changes = _fetch_changes(_conn(client), "INBOX", 7, 4, 100, max_results=50)
+    assert client.fetches == [("1:3", ["FLAGS"], ["CHANGEDSINCE 100"])]
+    assert changes.highest_modseq == 120
+    assert changes.label_updates == {
+        "INBOX:7:1": [],
+        "INBOX:7:2": ["UNREAD", "STARRED"],
+    }
+
+
+def test_flags_not_fetched_without_condstore_or_modseq_change():
+    client = FakeIMAPClient([1, 2], uidnext=3, highest_modseq=100, flags={1: ()})
+    _fetch_changes(_conn(client, capabilities=("IMAP4REV1",)), "INBOX", 7, 3, 90, 50)
+    _fetch_changes(_conn(client), "INBOX", 7, 3, 100, 50)
+    assert client.fetches == []
+
+
+def _resolves_to(monkeypatch, *addresses):
+    def getaddrinfo(host, port, *args, **kwargs):
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (a, port)) for a in addresses]
+
+    monkeypatch.setattr(imap_service.socket, "getaddrinfo", getaddrinfo)
+
+
+@pytest.mark.parametrize(
+    "address", ["127.0.0.1", "10.1.2.3", "169.254.169.254", "192.168.0.5", "::1", "fe80::1%eth0"]
+)
+def test_check_host_rejects_internal_addresses(monkeypatch, address):
+    _resolves_to(monkeypatch, address)
+    with pytest.raises(ValueError):
+        imap_service.check_host("imap.example.com", 993)
+
+
+def test_check_host_rejects_if_any_address_is_internal(monkeypatch):
+    _resolves_to(monkeypatch, "93.184.216.34", "10.0.0.1")
+    with pytest.raises(ValueError):
+        imap_service.check_host("imap.example.com", 993)
+
+
+def test_check_host_rejects_disallowed_port(monkeypatch):
+    _resolves_to(monkeypatch, "93.184.216.34")
+    with pytest.raises(ValueError):
+        imap_service.check_host("imap.example.com", 6379)
+
+
+def test_check_host_returns_validated_address(monkeypatch):
+    _resolves_to(monkeypatch, "93.184.216.34")
+    assert imap_service.check_host("imap.example.com", 993) == "93.184.216.34"
+
+
+def test_check_host_allowlist_skips_address_check(monkeypatch):
+    _resolves_to(monkeypatch, "10.0.0.5")
+    monkeypatch.setattr(imap_service.settings, "imap_allowed_hosts", ["GreenMail"])
+    assert imap_service.check_host("greenmail", 143) == "greenmail"
+
+
+class _ConnectAttemptedError(Exception):
+    pass
+
+
+@pytest.fixture
+def rebinding(monkeypatch):
+    """第一次解析到公開位址，之後改指向內網；記錄實際連線的位址與 TLS 主機名稱"""
+    answers = iter(["93.184.216.34", "10.0.0.1"])
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        address = next(answers)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))]
+
+    seen = {}
+
+    def create_connection(address, timeout=None):
+        seen["address"] = address
+        if "tls" not in seen:
+            raise _ConnectAttemptedError
+        return object()
+
+    def wrap_socket(sock, ssl_context, host):
+        seen["server_hostname"] = host
+        raise _ConnectAttemptedError
+
+    monkeypatch.setattr(imap_service.socket, "getaddrinfo", getaddrinfo)
+    monkeypatch.setattr(imap_service.socket, "create_connection", create_connection)
+    monkeypatch.setattr(imap_service.tls, "wrap_socket", wrap_socket)
+    return seen
+
+
+def test_connect_uses_checked_address(rebinding):
+    with pytest.raises(_ConnectAttemptedError):
+        imap_service._connect("imap.example.com", 143, False, "u", "p")
+    assert rebinding["address"] == ("93.184.216.34", 143)
+
+
+def test_tls_connect_keeps_hostname_for_sni(rebinding):
+    rebinding["tls"] = True
+    with pytest.raises(_ConnectAttemptedError):
+        imap_service._connect("imap.example.com", 993, True, "u", "p")
+    assert rebinding["address"] == ("93.184.216.34", 993)
+    assert rebinding["server_hostname"] == "imap.example.com"
+
+
+class FakeIdleClient:
+    def __init__(self):
+        self.idling = threading.Event()
+        self.logged_out = False
+        self.responses = []
+
+    def select_folder(self, folder, readonly=False):
+        return {}
+
+    def idle(self):
+        self.idling.set()
+
+    def idle_check(self, timeout):
+        threading.Event().wait(0.01)
+        responses, self.responses = self.responses, []
+        return responses
+
+    def idle_done(self):
+        pass
+
+    def logout(self):
+        self.logged_out = True
+
+
+async def test_idle_watch_stop_event_ends_thread(monkeypatch):
+    client = FakeIdleClient()
+    monkeypatch.setattr(imap_service, "_connect", lambda *args: (client, frozenset()))
+    monkeypatch.setattr(imap_service.token_manager, "decrypt", lambda token: "pw")
+    account = SimpleNamespace(
+        id=uuid.uuid4(),
+        imap_host="imap.example.com",
+        imap_port=993,
+        imap_use_ssl=True,
+        email_address="you@example.com",
+        encrypted_access_token="x",
+    )
+    notified = asyncio.Event()
+
+    async def on_new_mail():
+        notified.set()
+
+    stop_event = asyncio.Event()
+    task = asyncio.create_task(imap_service.idle_watch(account, on_new_mail, stop_event))
+    assert await asyncio.to_thread(client.idling.wait, 2)
+    client.responses = [(3, b"EXISTS")]
+    await asyncio.wait_for(notified.wait(), 2)
+
+    stop_event.set()
+    await asyncio.wait_for(task, 2)
+    assert client.logged_out
+    assert not any(t.name == f"imap-idle-{account.id}" for t in threading.enumerate())
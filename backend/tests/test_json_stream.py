@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from app.services.json_stream import JsonObjectStream
+
+DOC = {
+    "urgency_score": 4,
+    "importance_score": 3,
+    "action_required": True,
+    "category": "工作",
+    "reply_suggestions": ["好的，{收到}", "我明天回覆, 謝謝"],
+    "meta": {"nested": [1, {"a": "}"}]},
+    "summary": 'Line 1\n"quoted" \\ path — 中文摘要 é',
+}
+TEXT = json.dumps(DOC, ensure_ascii=False)
+
+
+def _feed_all(text, size):
+    stream = JsonObjectStream()
+    fields = []
+    for i in range(0, len(text), size):
+        fields.extend(stream.feed(text[i:i + size]))
+    return stream, fields
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(TEXT)])
+def test_chunking_does_not_change_result(size):
+    stream, fields = _feed_all(TEXT, size)
+    assert stream.done
+    assert stream.result == DOC
+    assert [name for name, _ in fields] == list(DOC)
+
+
+def test_fields_are_emitted_when_complete():
+    stream = JsonObjectStream()
+    assert stream.feed('{"urgency_score": 4') == []
+    assert stream.feed(", ") == [("urgency_score", 4)]
+    assert stream.feed('"summary": "ab') == []
+    assert stream.feed('c"}') == [("summary", "abc")]
+    assert stream.done
+
+
+def test_leading_noise_and_trailing_text_are_ignored():
+    stream, _ = _feed_all('```json\n{"a": 1}\n```', 4)
+    assert stream.result == {"a": 1}
+    assert stream.feed('{"b": 2}') == []
+
+
+def test_partial_returns_summary_so_far():
+    stream = JsonObjectStream()
+    stream.feed('{"urgency_score": 4, "summary": "第一點\\n第二')
+    assert stream.partial() == ("summary", "第一點\n第二")
+
+
+@pytest.mark.parametrize("tail", ["\\", "\\u00", "\\u00e"])
+def test_partial_drops_incomplete_escape(tail):
+    stream = JsonObjectStream()
+    stream.feed('{"summary": "abc' + tail)
+    assert stream.partial() == ("summary", "abc")
+
+
+def test_partial_is_none_outside_string_value():
+    stream = JsonObjectStream()
+    assert stream.partial() is None
+    stream.feed('{"urgency_score": 4')
+    assert stream.partial() is None
+    stream.feed(', "sum')
+    assert stream.partial() is None  # 還在欄位名稱內
+
+
+def test_invalid_member_is_skipped():
+    stream, fields = _feed_all('{"a": tru, "b": 2}', 1)
+    assert fields == [("b", 2)]
+    assert stream.result == {"b": 2}
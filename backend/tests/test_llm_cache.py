@@ -0,0 +1,187 @@
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.core import redis as redis_module
+from app.services import llm_cache
+
+RESULT = {
+    "summary": "weekly newsletter", "urgency_score": 1, "importance_score": 2,
+    "action_required": False, "category": "newsletter", "sentiment": "neutral",
+    "reply_suggestions": [], "model_used": "claude-haiku",
+    "tokens_used": 321, "generation_ms": 900,
+}
+
+
+class _CacheSession:
+    """db.scalar 回傳 Postgres 中的快取列；execute 記錄語句"""
+
+    def __init__(self, entry=None, rowcounts=()):
+        self.entry = entry
+        self.rowcounts = list(rowcounts)
+        self.lookups = 0
+        self.statements = []
+        self.commits = 0
+
+    async def scalar(self, stmt):
+        self.lookups += 1
+        return self.entry
+
+    async def execute(self, stmt):
+        self.statements.append(stmt)
+        return SimpleNamespace(rowcount=self.rowcounts.pop(0) if self.rowcounts else 0)
+
+    async def commit(self):
+        self.commits += 1
+
+
+class _DownRedis:
+    async def get(self, key):
+        raise ConnectionError("redis down")
+
+    async def hincrby(self, key, field, amount):
+        raise ConnectionError("redis down")
+
+    def pipeline(self, transaction=True):
+        raise ConnectionError("redis down")
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(redis_module, "_client", client)
+    s = llm_cache.settings
+    monkeypatch.setattr(s, "llm_cache_enabled", True)
+    monkeypatch.setattr(s, "llm_cache_ttl_seconds", 3600)
+    monkeypatch.setattr(s, "llm_cache_max_entries", 3)
+    monkeypatch.setattr(s, "llm_cache_db_max_entries", 100)
+    return client
+
+
+def test_cache_key_ignores_whitespace_but_not_settings():
+    key = llm_cache.cache_key("Hello   world\n", "concise", "claude-haiku", "zh-TW")
+    assert key == llm_cache.cache_key(" Hello world", "concise", "claude-haiku", "zh-TW")
+    assert key != llm_cache.cache_key("Hello world", "detailed", "claude-haiku", "zh-TW")
+    assert key != llm_cache.cache_key("Hello world", "concise", "gpt-4o", "zh-TW")
+    assert key != llm_cache.cache_key("Hello world", "concise", "claude-haiku", "en")
+
+
+async def test_put_then_get_hits_redis_without_db(redis):
+    db = _CacheSession()
+    await llm_cache.put(db, "k1", RESULT)
+
+    cached = await llm_cache.get(db, "k1")
+    assert cached["summary"] == "weekly newsletter"
+    assert "tokens_used" not in cached and "generation_ms" not in cached
+    assert db.lookups == 0
+    assert 0 < await redis.ttl("mailcake:llm_cache:k1") <= 3600
+
+
+async def test_put_upserts_postgres_row(redis):
+    db = _CacheSession()
+    await llm_cache.put(db, "k1", RESULT)
+    sql = str(db.statements[0].compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (cache_key) DO UPDATE" in sql
+
+
+async def test_db_hit_backfills_redis_with_remaining_ttl(redis):
+    entry = SimpleNamespace(
+        result={"summary": "from db"}, hit_count=2, last_hit_at=None,
+        expires_at=datetime.utcnow() + timedelta(seconds=600),
+    )
+    db = _CacheSession(entry)
+
+    assert await llm_cache.get(db, "k1") == {"summary": "from db"}
+    assert entry.hit_count == 3 and entry.last_hit_at is not None
+    assert 590 <= await redis.ttl("mailcake:llm_cache:k1") <= 600
+    # 之後直接命中 Redis
+    await llm_cache.get(db, "k1")
+    assert db.lookups == 1
+
+
+async def test_miss_and_hit_rate(redis):
+    db = _CacheSession()
+    assert await llm_cache.get(db, "missing") is None
+    await llm_cache.put(db, "k1", RESULT)
+    await llm_cache.get(db, "k1")
+    stats = await llm_cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["hit_rate"] == 0.5
+    assert stats["redis_entries"] == 1
+
+
+async def test_least_recently_used_entries_are_evicted(redis, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: clock[0])
+    db = _CacheSession()
+    for key in ("k1", "k2", "k3"):
+        clock[0] += 1
+        await llm_cache.put(db, key, RESULT)
+    clock[0] += 1
+    await llm_cache.get(db, "k1")  # k1 變成最近使用
+    clock[0] += 1
+    await llm_cache.put(db, "k4", RESULT)
+
+    assert await redis.exists("mailcake:llm_cache:k2") == 0
+    for key in ("k1", "k3", "k4"):
+        assert await redis.exists(f"mailcake:llm_cache:{key}") == 1
+    assert await redis.zcard("mailcake:llm_cache:lru") == 3
+
+
+async def test_redis_outage_falls_back_to_postgres(redis, monkeypatch):
+    monkeypatch.setattr(redis_module, "_client", _DownRedis())
+    entry = SimpleNamespace(
+        result={"summary": "from db"}, hit_count=0, last_hit_at=None,
+        expires_at=datetime.utcnow() + timedelta(seconds=600),
+    )
+    db = _CacheSession(entry)
+    assert await llm_cache.get(db, "k1") == {"summary": "from db"}
+
+    await llm_cache.put(db, "k2", RESULT)
+    assert len(db.statements) == 1
+
+
+async def test_disabled_cache_is_bypassed(redis, monkeypatch):
+    monkeypatch.setattr(llm_cache.settings, "llm_cache_enabled", False)
+    db = _CacheSession()
+    await llm_cache.put(db, "k1", RESULT)
+    assert await llm_cache.get(db, "k1") is None
+    assert db.statements == [] and db.lookups == 0
+
+
+async def test_prune_deletes_expired_and_overflow_rows(redis):
+    await redis.zadd("mailcake:llm_cache:lru", {"old": time.time() - 7200, "new": time.time()})
+    db = _CacheSession(rowcounts=[3, 2])
+
+    assert await llm_cache.prune(db) == 5
+    expired_sql, overflow_sql = (
+        str(stmt.compile(dialect=postgresql.dialect())) for stmt in db.statements
+    )
+    assert "llm_cache_entries.expires_at <=" in expired_sql
+    assert "ORDER BY llm_cache_entries.last_hit_at DESC" in overflow_sql
+    assert "OFFSET" in overflow_sql
+    assert db.commits == 1
+    assert await redis.zrange("mailcake:llm_cache:lru", 0, -1) == ["new"]
+
+
+class FakeLLM:
+    def __init__(self):
+        self.calls = 0
+
+    async def analyze_email(self, content, style, model, language):
+        self.calls += 1
+        return dict(RESULT)
+
+
+async def test_analyze_email_reuses_cached_result(redis):
+    llm, db = FakeLLM(), _CacheSession()
+    first = await llm_cache.analyze_email(db, llm, "body", "concise", "claude-haiku", "zh-TW")
+    second = await llm_cache.analyze_email(db, llm, "body ", "concise", "claude-haiku", "zh-TW")
+
+    assert llm.calls == 1
+    assert first["tokens_used"] == 321
+    assert second["cached"] is True and second["tokens_used"] == 0
+    assert second["summary"] == first["summary"]
@@ -0,0 +1,155 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from app.services import llm_limiter
+from app.services.llm_limiter import ModelLimiter
+
+
+@pytest.fixture(autouse=True)
+def limiter_settings(monkeypatch):
+    s = llm_limiter.settings
+    monkeypatch.setattr(s, "llm_rate_share", 0.5)
+    monkeypatch.setattr(s, "llm_expected_latency_seconds", 6.0)
+    monkeypatch.setattr(s, "llm_expected_tokens_per_request", 2000)
+    monkeypatch.setattr(s, "llm_concurrency_default", 5)
+    monkeypatch.setattr(s, "llm_concurrency_min", 1)
+    monkeypatch.setattr(s, "llm_concurrency_max", 32)
+    monkeypatch.setattr(s, "llm_latency_target_seconds", 20.0)
+    monkeypatch.setattr(s, "llm_latency_backoff", 0.9)
+    monkeypatch.setattr(s, "llm_rate_limit_backoff", 0.5)
+    monkeypatch.setattr(s, "llm_decrease_cooldown_seconds", 5.0)
+    monkeypatch.setattr(llm_limiter, "_limiters", {})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_limiter.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _rate_limit_error():
+    response = httpx.Response(429, request=httpx.Request("POST", "http://litellm/chat"))
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+def test_model_rates_sums_deployments(tmp_path, monkeypatch):
+    config = tmp_path / "litellm_config.yaml"
+    config.write_text(
+        "model_list:\n"
+        "  - model_name: claude-haiku\n"
+        "    litellm_params: {model: anthropic/claude-3-haiku, rpm: 50}\n"
+        "  - model_name: claude-haiku\n"
+        "    rpm: 30\n"
+        "    tpm: 100000\n"
+        "  - model_name: llama3.2-local\n"
+        "    litellm_params: {model: ollama/llama3.2}\n"
+    )
+    monkeypatch.setattr(llm_limiter.settings, "litellm_config_path", str(config))
+    llm_limiter._model_rates.cache_clear()
+    try:
+        rates = llm_limiter._model_rates()
+    finally:
+        llm_limiter._model_rates.cache_clear()
+    assert rates == {"claude-haiku": (80, 100000), "llama3.2-local": (None, None)}
+
+
+@pytest.mark.parametrize(
+    "rates, expected",
+    [
+        ({"m": (100, None)}, 5),  # 100 * 0.5 / 60 * 6 = 5
+        ({"m": (None, 400000)}, 10),  # 400000 * 0.5 / 2000 / 60 * 6 = 10
+        ({"m": (100, 40000)}, 1),  # 取較小的 tpm 估計（1.0）
+        ({"m": (10000, None)}, 32),  # 上限
+        ({"m": (1, None)}, 1),  # 下限
+        ({}, 5),  # 未設定 → llm_concurrency_default
+    ],
+)
+def test_initial_limit(monkeypatch, rates, expected):
+    monkeypatch.setattr(llm_limiter, "_model_rates", lambda: rates)
+    assert llm_limiter.initial_limit("m") == expected
+
+
+def test_additive_increase_only_when_saturated():
+    limiter = ModelLimiter("m", 2)
+    limiter.in_flight = 1
+    limiter.on_success(1.0)
+    assert limiter.limit == 2.0
+
+    limiter.in_flight = 2
+    limiter.on_success(1.0)
+    assert limiter.limit == pytest.approx(2.5)
+    limiter.in_flight = 2
+    limiter.on_success(None)  # 串流呼叫不量延遲，仍可成長
+    assert limiter.limit == pytest.approx(2.9)
+
+
+def test_increase_is_capped(monkeypatch):
+    monkeypatch.setattr(llm_limiter.settings, "llm_concurrency_max", 4)
+    limiter = ModelLimiter("m", 4)
+    limiter.in_flight = 4
+    limiter.on_success(1.0)
+    assert limiter.limit == 4.0
+
+
+def test_rate_limit_halves_with_cooldown(clock):
+    limiter = ModelLimiter("m", 8)
+    limiter.on_rate_limited()
+    assert limiter.limit == 4.0
+    clock[0] += 1
+    limiter.on_rate_limited()  # 同一波 429 只下調一次
+    assert limiter.limit == 4.0
+    clock[0] += 5
+    limiter.on_rate_limited()
+    assert limiter.limit == 2.0
+
+
+def test_slow_success_and_timeout_use_latency_backoff(clock):
+    limiter = ModelLimiter("m", 10)
+    limiter.on_success(25.0)
+    assert limiter.limit == pytest.approx(9.0)
+    clock[0] += 10
+    limiter.on_timeout()
+    assert limiter.limit == pytest.approx(8.1)
+
+
+def test_decrease_never_goes_below_min(clock):
+    limiter = ModelLimiter("m", 1)
+    limiter.on_rate_limited()
+    assert limiter.limit == 1.0
+
+
+async def test_slot_blocks_at_capacity(monkeypatch):
+    monkeypatch.setattr(llm_limiter, "initial_limit", lambda model: 2)
+    running, peak = 0, 0
+
+    async def call():
+        nonlocal running, peak
+        async with llm_limiter.slot("m"):
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*(call() for _ in range(6)))
+    assert peak == 2
+    assert llm_limiter.stats()["m"]["in_flight"] == 0
+
+
+async def test_slot_rate_limit_error_decreases_and_reraises(monkeypatch):
+    monkeypatch.setattr(llm_limiter, "initial_limit", lambda model: 8)
+    with pytest.raises(openai.RateLimitError):
+        async with llm_limiter.slot("m"):
+            raise _rate_limit_error()
+    assert llm_limiter.stats()["m"] == {"limit": 4.0, "in_flight": 0, "waiting": 0}
+
+
+async def test_slot_other_errors_do_not_adjust(monkeypatch):
+    monkeypatch.setattr(llm_limiter, "initial_limit", lambda model: 8)
+    with pytest.raises(ValueError):
+        async with llm_limiter.slot("m"):
+            raise ValueError("bad json")
+    assert llm_limiter.stats()["m"]["limit"] == 8.0
@@ -0,0 +1,178 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import llm_service, token_counter
+from app.services.llm_service import LLMService
+
+
+def _item(message_id, **overrides):
+    item = {
+        "id": message_id, "summary": f"summary {message_id}", "urgency_score": 3,
+        "importance_score": 2, "action_required": False, "category": "work",
+        "sentiment": "neutral", "reply_suggestions": [],
+    }
+    item.update(overrides)
+    return item
+
+
+class FakeLLM(LLMService):
+    def __init__(self, payload, total_tokens=1000):
+        self.payload = payload
+        self.total_tokens = total_tokens
+        self.requests = []
+
+    async def chat_completion(self, **kwargs):
+        self.requests.append(kwargs)
+        content = self.payload if isinstance(self.payload, str) else json.dumps(self.payload)
+        usage = SimpleNamespace(total_tokens=self.total_tokens) if self.total_tokens else None
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage
+        )
+
+
+@pytest.fixture(autouse=True)
+def batch_settings(monkeypatch):
+    monkeypatch.setattr(llm_service.settings, "analysis_batch_output_tokens_per_item", 350)
+    monkeypatch.setattr(llm_service.settings, "analysis_batch_max_output_tokens", 1000)
+
+
+async def test_batch_prompt_and_output_budget():
+    llm = FakeLLM({"results": []})
+    await llm.analyze_emails_batch([("a", "first"), ("b", "second")], model="m")
+
+    request = llm.requests[0]
+    assert request["max_tokens"] == 700
+    assert request["response_format"] == {"type": "json_object"}
+    user = request["messages"][1]["content"]
+    assert '<email id="a">\nfirst\n</email>' in user and '<email id="b">' in user
+
+    await llm.analyze_emails_batch([(str(i), "x") for i in range(5)], model="m")
+    assert llm.requests[1]["max_tokens"] == 1000
+
+
+async def test_batch_keeps_only_valid_expected_items():
+    llm = FakeLLM({"results": [
+        _item("a"),
+        _item("a", summary="duplicate"),
+        _item("b", summary=""),
+        _item("c", urgency_score=9),
+        _item("d", importance_score="high"),
+        _item("zzz"),
+        "not an object",
+        _item("e", urgency_score="4", summary=["one", "two"]),
+    ]})
+    emails = [(pid, f"content {pid}") for pid in "abcdef"]
+
+    results = await llm.analyze_emails_batch(emails, model="m")
+
+    assert set(results) == {"a", "e"}  # f 缺漏、b/c/d 不合格 → 呼叫端改用單封分析
+    assert results["a"]["summary"] == "summary a"
+    assert "id" not in results["a"]
+    assert results["a"]["model_used"] == "m"
+    assert results["e"]["urgency_score"] == 4
+    assert results["e"]["summary"] == "• one\n• two"
+
+
+async def test_batch_splits_tokens_by_content_length():
+    llm = FakeLLM({"results": [_item("a"), _item("b")]}, total_tokens=900)
+    results = await llm.analyze_emails_batch([("a", "x" * 100), ("b", "x" * 200)], model="m")
+    assert results["a"]["tokens_used"] == 300
+    assert results["b"]["tokens_used"] == 600
+
+    llm = FakeLLM({"results": [_item("a")]}, total_tokens=None)
+    results = await llm.analyze_emails_batch([("a", "x")], model="m")
+    assert results["a"]["tokens_used"] is None
+
+
+@pytest.mark.parametrize("payload", [{"results": "oops"}, {}, {"results": [None]}])
+async def test_batch_malformed_results_yield_nothing(payload):
+    assert await FakeLLM(payload).analyze_emails_batch([("a", "x")], model="m") == {}
+
+
+async def test_batch_invalid_json_raises():
+    with pytest.raises(json.JSONDecodeError):
+        await FakeLLM("not json").analyze_emails_batch([("a", "x")], model="m")
+
+
+# ── 長信件 map-reduce ─────────────────────────────────────────
+
+
+class LongEmailLLM(LLMService):
+    """_analyze_chunk / _analyze_content 的替身：記錄每次呼叫的內容"""
+
+    def __init__(self):
+        self.chunk_calls = []
+        self.master_calls = []
+
+    async def _analyze_chunk(self, chunk, index, total, model, language):
+        self.chunk_calls.append(chunk)
+        return {"notes": [f"note {len(self.chunk_calls)}"], "urgency_score": 2}, 10
+
+    async def _analyze_content(self, user_content, style, model, language, topic_skill):
+        self.master_calls.append(user_content)
+        return {"summary": "merged", "urgency_score": 1, "importance_score": 3,
+                "action_required": False, "tokens_used": 50}
+
+
+@pytest.fixture
+def long_email(monkeypatch):
+    monkeypatch.setattr(llm_service.settings, "long_email_max_chunks", 4)
+    monkeypatch.setattr(llm_service.settings, "long_email_max_total_chunks", 64)
+    monkeypatch.setattr(llm_service.settings, "model_token_budgets", {"m": 100})
+    # 離線估算：每個中文字 1 token
+    monkeypatch.setattr(token_counter, "_encoding", lambda name: None)
+
+
+def _paragraphs(count):
+    return "\n\n".join(f"第{i:02d}段" + "內容" * 40 for i in range(count))
+
+
+async def test_long_email_is_reduced_in_levels_without_dropping_content(long_email):
+    llm = LongEmailLLM()
+    user_content, parts, truncated = await llm._map_long_email(
+        _paragraphs(20), "m", "zh-TW", 100
+    )
+
+    assert not truncated
+    first_level = llm.chunk_calls[:20]
+    assert all(f"第{i:02d}段" in first_level[i] for i in range(20))
+    # 20 段 → 5 組 → 2 組（每層最多合併 4 段）
+    assert len(llm.chunk_calls) == 20 + 5 + 2
+    assert len(parts) == 27
+    assert user_content.count("<part index=") == 2
+
+
+async def test_long_email_tail_beyond_total_cap_is_truncated(long_email, monkeypatch):
+    monkeypatch.setattr(llm_service.settings, "long_email_max_total_chunks", 6)
+    llm = LongEmailLLM()
+    _, _, truncated = await llm._map_long_email(_paragraphs(10), "m", "zh-TW", 100)
+    assert truncated
+    assert len([c for c in llm.chunk_calls if c.startswith("第")]) == 6
+
+
+async def test_analyze_email_routes_long_content_through_map_reduce(long_email):
+    llm = LongEmailLLM()
+    result = await llm.analyze_email(_paragraphs(3), model="m")
+
+    assert len(llm.chunk_calls) == 3
+    assert llm.master_calls[0].startswith("以下是一封長信件分成 3 段")
+    assert result["urgency_score"] == 2  # 取各段與合併結果的最大值
+    assert result["tokens_used"] == 3 * 10 + 50
+
+    short = LongEmailLLM()
+    await short.analyze_email("短信件", model="m")
+    assert short.chunk_calls == [] and short.master_calls == ["<email>\n短信件\n</email>"]
+
+
+def test_merge_long_email_takes_max_scores_and_marks_truncation():
+    parts = [({"urgency_score": 4, "action_required": True}, 10), ({"urgency_score": 9}, None)]
+    result = LLMService._merge_long_email(
+        {"summary": "s", "urgency_score": 2, "importance_score": 3, "tokens_used": 5},
+        parts, truncated=True, language="en",
+    )
+    assert result["urgency_score"] == 4  # 超出 1-5 的評分忽略
+    assert result["action_required"] is True
+    assert result["tokens_used"] == 15
+    assert result["summary"].endswith("(Email truncated: only the beginning was analyzed)")
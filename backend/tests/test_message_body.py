@@ -0,0 +1,144 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+from app.models import EmailAccount, EmailBody, EmailMessage
+from app.services import body_store, message_body
+
+NOW = datetime(2026, 10, 17, 12, 0, 0)
+
+
+class _Session:
+    def __init__(self):
+        self.flushes = 0
+
+    async def flush(self):
+        self.flushes += 1
+
+
+class FakeClient:
+    def __init__(self, failed=(), error=None):
+        self.failed = set(failed)
+        self.error = error
+        self.requests = []
+
+    async def get_message_details_batch(self, ids, format="full"):
+        self.requests.append((list(ids), format))
+        if self.error:
+            raise self.error
+        details = [
+            {
+                "provider_message_id": pid,
+                "body_plain": f"body {pid}",
+                "body_html": None,
+                "analysis_text": f"text {pid}",
+                "has_attachments": pid.endswith("att"),
+                "body_fetched_at": NOW,
+            }
+            for pid in ids if pid not in self.failed
+        ]
+        return details, [pid for pid in ids if pid in self.failed]
+
+
+@pytest.fixture
+def store(monkeypatch):
+    saved = []
+
+    async def save(db, bodies):
+        saved.extend(bodies)
+        return [body_store.content_hash(plain, html) for plain, html in bodies]
+
+    async def load(db, hashes):
+        rows = {row["content_hash"]: row for row in body_store._pack(saved)[1]}
+        return {h: EmailBody(**rows[h]) for h in hashes}
+
+    monkeypatch.setattr(body_store, "save", save)
+    monkeypatch.setattr(body_store, "load", load)
+    return saved
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    by_account = {}
+
+    async def client_for_account(account):
+        return by_account.get(account.id)
+
+    monkeypatch.setattr(message_body, "client_for_account", client_for_account)
+    return by_account
+
+
+def _account(provider="gmail"):
+    return EmailAccount(id=uuid.uuid4(), provider=provider, email_address="a@example.com")
+
+
+def _message(account, pid, fetched=False):
+    return EmailMessage(
+        id=uuid.uuid4(),
+        account=account,
+        account_id=account.id,
+        provider_message_id=pid,
+        snippet=f"snippet {pid}",
+        body_fetched_at=NOW if fetched else None,
+    )
+
+
+async def test_ensure_bodies_batches_per_account_and_attaches_body(store, clients):
+    first, second = _account(), _account()
+    clients[first.id], clients[second.id] = FakeClient(), FakeClient()
+    messages = [
+        _message(first, "m1"), _message(second, "m2"),
+        _message(first, "m3att"), _message(first, "done", fetched=True),
+    ]
+    db = _Session()
+
+    await message_body.ensure_bodies(db, messages)
+
+    assert clients[first.id].requests == [(["m1", "m3att"], "full")]
+    assert clients[second.id].requests == [(["m2"], "full")]
+    m1 = messages[0]
+    assert m1.body_plain == "body m1"
+    assert m1.body_hash == body_store.content_hash("body m1", None)
+    assert m1.analysis_text == "text m1" and m1.body_fetched_at == NOW
+    assert messages[2].has_attachments is True
+    assert messages[3].body_hash is None  # 已下載過的不再請求
+    assert db.flushes == 1
+
+
+async def test_failed_downloads_keep_metadata_only(store, clients):
+    account = _account()
+    clients[account.id] = FakeClient(failed={"m2"})
+    messages = [_message(account, "m1"), _message(account, "m2")]
+
+    await message_body.ensure_bodies(_Session(), messages)
+
+    assert messages[0].body_fetched_at == NOW
+    assert messages[1].body_fetched_at is None and messages[1].body_hash is None
+    assert message_body.analysis_content(messages[1]) == "snippet m2"
+
+
+async def test_client_error_skips_only_that_account(store, clients):
+    broken, ok = _account(), _account()
+    clients[broken.id] = FakeClient(error=RuntimeError("gmail down"))
+    clients[ok.id] = FakeClient()
+    messages = [_message(broken, "m1"), _message(ok, "m2")]
+
+    await message_body.ensure_bodies(_Session(), messages)
+
+    assert messages[0].body_fetched_at is None
+    assert messages[1].body_plain == "body m2"
+
+
+async def test_non_gmail_and_disconnected_accounts_are_skipped(store, clients):
+    imap, gone = _account(provider="imap"), _account()
+    messages = [_message(imap, "INBOX:1:1"), _message(gone, "m1")]
+    await message_body.ensure_bodies(_Session(), messages)
+    assert store == []
+    assert all(m.body_fetched_at is None for m in messages)
+
+
+def test_analysis_content_prefers_normalized_text():
+    msg = EmailMessage(analysis_text="clean", snippet="snip", body_fetched_at=NOW)
+    assert message_body.analysis_content(msg) == "clean"
+    assert message_body.analysis_content(EmailMessage(snippet="snip")) == "snip"
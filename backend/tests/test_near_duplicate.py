@@ -0,0 +1,151 @@
+import random
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import near_duplicate as nd
+
+RECEIPT = """
+親愛的 {name} 您好，感謝您在 Example 商店購物。
+訂單編號 {order}，付款金額 NT$ {amount}，預計 {date} 送達。
+商品會由宅配送到您指定的地址，出貨後會再寄送追蹤連結給您。
+如需協助請回覆此信或來電客服專線，我們將盡快為您處理。
+Example 商店 敬上
+"""
+
+
+@pytest.fixture(autouse=True)
+def near_settings(monkeypatch):
+    s = nd.settings
+    monkeypatch.setattr(s, "near_duplicate_enabled", True)
+    monkeypatch.setattr(s, "near_duplicate_scope", "sender_domain")
+    monkeypatch.setattr(s, "near_duplicate_max_distance", 3)
+    monkeypatch.setattr(s, "near_duplicate_min_tokens", 20)
+
+
+def _flip(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+def test_bands_split_value_into_16_bit_segments():
+    value = 0x1234_5678_9ABC_DEF0
+    assert nd._bands(value) == [0xDEF0, 0x9ABC, 0x5678, 0x1234]
+    assert sum(band << (16 * i) for i, band in enumerate(nd._bands(value))) == value
+
+
+def test_any_value_within_distance_3_shares_a_band():
+    rng = random.Random(17)
+    for _ in range(2000):
+        value = rng.getrandbits(64)
+        other = _flip(value, rng.sample(range(64), rng.randint(0, 3)))
+        assert nd.hamming(value, other) <= 3
+        assert any(a == b for a, b in zip(nd._bands(value), nd._bands(other)))
+
+
+def test_distance_4_can_miss_every_band():
+    # 每一段各翻一個 bit：距離 4，沒有任何一段相同（門檻上限必須 ≤ 3）
+    value = 0
+    other = _flip(value, [0, 16, 32, 48])
+    assert not any(a == b for a, b in zip(nd._bands(value), nd._bands(other)))
+
+
+@pytest.mark.parametrize("value", [0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1])
+def test_signed_roundtrip_fits_bigint(value):
+    signed = nd._to_signed(value)
+    assert -(1 << 63) <= signed < (1 << 63)
+    assert nd._to_unsigned(signed) == value
+
+
+def test_variable_tokens_are_normalized():
+    tokens = nd._tokens("Order A-1029 total $42.50 https://x.example/t?id=9 mail bob@x.example")
+    assert tokens == ["order", "#", "total", "#", "url", "mail", "email"]
+    assert nd._tokens("中文ab") == ["中", "文", "ab"]
+
+
+def test_templated_receipts_differing_only_in_numbers_match():
+    a = nd.simhash(nd._tokens(RECEIPT.format(
+        name="王小明", order="A10293", amount="1,280", date="10/20"
+    )))
+    b = nd.simhash(nd._tokens(RECEIPT.format(
+        name="王小明", order="B77120", amount="560", date="11/02"
+    )))
+    assert nd.hamming(a, b) <= 3
+
+
+def test_unrelated_texts_are_far():
+    a = nd.simhash(nd._tokens(RECEIPT.format(name="王", order="1", amount="1", date="1")))
+    b = nd.simhash(nd._tokens(
+        "Hi team, the quarterly planning meeting moved to Thursday afternoon. "
+        "Please review the roadmap draft and bring questions about hiring and budget."
+    ))
+    assert nd.hamming(a, b) > 10
+
+
+def _fp(simhash, user_id, domain="shop.example"):
+    return nd.Fingerprint(simhash=simhash, user_id=user_id, sender_domain=domain)
+
+
+def test_is_near_respects_scope(monkeypatch):
+    user = uuid.uuid4()
+    assert nd.is_near(_fp(0, user), _fp(0b111, user))
+    assert not nd.is_near(_fp(0, user), _fp(0b1111, user))
+    assert not nd.is_near(_fp(0, user), _fp(0, uuid.uuid4()))
+    assert not nd.is_near(_fp(0, user), _fp(0, user, "other.example"))
+    monkeypatch.setattr(nd.settings, "near_duplicate_scope", "user")
+    assert nd.is_near(_fp(0, user), _fp(0, user, "other.example"))
+
+
+def test_fingerprint_skips_short_content():
+    msg = SimpleNamespace(account=SimpleNamespace(user_id=uuid.uuid4()), sender="a@shop.example")
+    assert nd.fingerprint(msg, "too short") is None
+    fp = nd.fingerprint(msg, RECEIPT.format(name="王", order="1", amount="1", date="1"))
+    assert fp is not None and fp.sender_domain == "shop.example"
+
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def all(self):
+        return self.value
+
+    def scalars(self):
+        return self
+
+    def scalar_one_or_none(self):
+        return self.value
+
+
+class _ScriptedSession:
+    """依序回傳預先排好的查詢結果"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    async def execute(self, stmt):
+        return _Result(self.results.pop(0))
+
+
+async def test_find_match_skips_candidates_without_usable_summary():
+    user = uuid.uuid4()
+    fp = _fp(0, user)
+    nearest, second, far = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    source = SimpleNamespace(id=second, summary=SimpleNamespace(model_used="claude-haiku"))
+    db = _ScriptedSession(
+        [(far, nd._to_signed(0b1111)), (second, nd._to_signed(0b11)), (nearest, 1)],
+        [second],  # 最近的候選沒有可沿用的摘要
+        source,
+    )
+    match = await nd.find_match(db, uuid.uuid4(), fp)
+    assert match is not None
+    assert match.source is source
+    assert match.distance == 2
+
+
+async def test_find_match_misses_when_no_candidate_is_usable():
+    fp = _fp(0, uuid.uuid4())
+    db = _ScriptedSession([(uuid.uuid4(), 1), (uuid.uuid4(), 3)], [])
+    assert await nd.find_match(db, uuid.uuid4(), fp) is None
@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.models.email import EmailMessage
+from app.services import pretriage
+
+RULES = {
+    "enabled": True,
+    "promotions": "skip",
+    "social": "cheap",
+    "list_mail": "cheap",
+    "no_reply": "cheap",
+    "low_reputation": "skip",
+    "reputation_min_messages": 5,
+    "reputation_max_importance": 1.5,
+}
+
+
+def _msg(labels=(), sender="Alice <alice@example.com>", is_list_mail=False):
+    return EmailMessage(labels=list(labels), sender=sender, is_list_mail=is_list_mail)
+
+
+def test_plain_mail_gets_full_analysis():
+    decision = pretriage.decide(_msg(["INBOX"]), RULES)
+    assert decision.action == "full"
+    assert decision.signals == []
+
+
+@pytest.mark.parametrize(
+    "msg, signal, action",
+    [
+        (_msg(["CATEGORY_PROMOTIONS"]), "promotions", "skip"),
+        (_msg(["CATEGORY_SOCIAL"]), "social", "cheap"),
+        (_msg(is_list_mail=True), "list_mail", "cheap"),
+        (_msg(sender="GitHub <noreply@github.com>"), "no_reply", "cheap"),
+        (_msg(sender="notifications@service.example"), "no_reply", "cheap"),
+        (_msg(sender="Do Not Reply <do-not-reply@bank.example>"), "no_reply", "cheap"),
+    ],
+)
+def test_single_signal(msg, signal, action):
+    decision = pretriage.decide(msg, RULES)
+    assert decision.signals == [signal]
+    assert decision.action == action
+
+
+def test_cheapest_action_wins_across_signals():
+    msg = _msg(["CATEGORY_PROMOTIONS"], sender="no-reply@shop.example", is_list_mail=True)
+    decision = pretriage.decide(msg, RULES)
+    assert decision.signals == ["promotions", "list_mail", "no_reply"]
+    assert decision.action == "skip"
+
+
+@pytest.mark.parametrize("flag", ["STARRED", "IMPORTANT"])
+def test_starred_or_important_is_never_skipped(flag):
+    assert pretriage.decide(_msg(["CATEGORY_PROMOTIONS", flag]), RULES).action == "cheap"
+
+
+@pytest.mark.parametrize(
+    "reputation, expected",
+    [
+        ((10, 1.2), ["low_reputation"]),
+        ((10, 1.5), ["low_reputation"]),
+        ((10, 2.0), []),
+        ((4, 1.0), []),  # 分析過的信件太少，不判斷
+        ((10, None), []),
+    ],
+)
+def test_reputation_threshold(reputation, expected):
+    assert pretriage.decide(_msg(), RULES, reputation).signals == expected
+
+
+def test_disabled_rules_always_full():
+    msg = _msg(["CATEGORY_PROMOTIONS"])
+    assert pretriage.decide(msg, {**RULES, "enabled": False}).action == "full"
+
+
+def test_unknown_action_falls_back_to_full():
+    msg = _msg(["CATEGORY_SOCIAL"])
+    assert pretriage.decide(msg, {**RULES, "social": "bogus"}).action == "full"
+
+
+def test_user_overrides_only_known_keys():
+    user = SimpleNamespace(pretriage_rules={"promotions": "full", "unknown": "skip"})
+    rules = pretriage.rules_for(user)
+    assert rules["promotions"] == "full"
+    assert "unknown" not in rules
+    assert pretriage.rules_for(None) == pretriage.default_rules()
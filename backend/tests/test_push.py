@@ -0,0 +1,256 @@
+import asyncio
+import base64
+import json
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from httpx import ASGITransport, AsyncClient
+
+from app.api.v1 import push
+from app.core import redis as redis_module
+from app.core.database import get_db
+from app.services import sync_queue
+from app.workers import email_sync
+
+TOKEN = "push-secret"
+
+
+class _FakeResult:
+    def __init__(self, accounts):
+        self._accounts = accounts
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self._accounts
+
+
+class _FakeSession:
+    def __init__(self, accounts):
+        self.accounts = accounts
+
+    async def execute(self, stmt):
+        return _FakeResult(self.accounts)
+
+
+def _account(last_history_id=None):
+    state = SimpleNamespace(last_history_id=last_history_id) if last_history_id else None
+    return SimpleNamespace(id=uuid.uuid4(), user_id=uuid.uuid4(), sync_state=state)
+
+
+def _envelope(history_id, email="you@gmail.com"):
+    data = json.dumps({"emailAddress": email, "historyId": history_id}).encode()
+    return {
+        "message": {"data": base64.b64encode(data).decode(), "messageId": "1"},
+        "subscription": "projects/p/subscriptions/s",
+    }
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    calls = []
+
+    async def request_sync(account_id, user_id=None):
+        calls.append(account_id)
+        return True
+
+    monkeypatch.setattr(push.sync_queue, "request_sync", request_sync)
+    monkeypatch.setattr(push.settings, "gmail_push_verification_token", TOKEN)
+    return calls
+
+
+def _client(accounts):
+    app = FastAPI()
+    app.include_router(push.router, prefix="/api/v1")
+    app.dependency_overrides[get_db] = lambda: _FakeSession(accounts)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("token", ["", "wrong"])
+def test_rejects_bad_token(queued, token):
+    response = _client([_account()]).post(
+        f"/api/v1/push/gmail?token={token}", json=_envelope(200)
+    )
+    assert response.status_code == 403
+    assert queued == []
+
+
+def test_rejects_when_token_not_configured(queued, monkeypatch):
+    monkeypatch.setattr(push.settings, "gmail_push_verification_token", "")
+    response = _client([_account()]).post("/api/v1/push/gmail?token=", json=_envelope(200))
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {},
+        {"message": {"data": "not base64 json"}},
+        {"message": {"data": base64.b64encode(b'{"emailAddress": "a@b.c"}').decode()}},
+        {"message": {"data": base64.b64encode(
+            b'{"emailAddress": "a@b.c", "historyId": "abc"}'
+        ).decode()}},
+    ],
+)
+def test_malformed_payload_is_acknowledged(queued, body):
+    # 格式錯誤回 2xx，避免 Pub/Sub 無限重送
+    response = _client([_account()]).post(f"/api/v1/push/gmail?token={TOKEN}", json=body)
+    assert response.status_code == 200
+    assert response.json() == {"ok": False}
+    assert queued == []
+
+
+def test_skips_already_synced_history_id(queued):
+    accounts = [_account(last_history_id=500), _account(last_history_id=300)]
+    response = _client(accounts).post(f"/api/v1/push/gmail?token={TOKEN}", json=_envelope(400))
+    assert response.json() == {"ok": True, "queued": 1}
+    assert queued == [accounts[1].id]
+
+
+def test_equal_history_id_is_not_queued(queued):
+    response = _client([_account(last_history_id=400)]).post(
+        f"/api/v1/push/gmail?token={TOKEN}", json=_envelope(400)
+    )
+    assert response.json() == {"ok": True, "queued": 0}
+
+
+def test_queues_account_without_sync_state(queued):
+    account = _account()
+    response = _client([account]).post(f"/api/v1/push/gmail?token={TOKEN}", json=_envelope(1))
+    assert response.json() == {"ok": True, "queued": 1}
+    assert queued == [account.id]
+
+
+# ── 端到端：push 通知 → Redis 同步佇列 → Worker 同步 ─────────────
+
+
+class _AccountStore:
+    """push API 與 _record_sync_result 共用的假 DB（只有一個 Gmail 帳號）"""
+
+    def __init__(self, account):
+        self.account = account
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        return _FakeResult([self.account])
+
+    async def get(self, model, ident, options=None):
+        return self.account if ident == self.account.id else None
+
+    async def commit(self):
+        pass
+
+
+def _gmail_account(last_history_id, watch_expires_at):
+    state = SimpleNamespace(last_history_id=last_history_id, watch_expires_at=watch_expires_at)
+    return SimpleNamespace(
+        id=uuid.uuid4(),
+        user_id=uuid.uuid4(),
+        provider="gmail",
+        email_address="you@gmail.com",
+        sync_state=state,
+        sync_interval_seconds=None,
+        sync_failures=0,
+        next_sync_at=None,
+    )
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """真實的 sync_queue / sync_lease（fakeredis 執行 Lua）+ 假 DB + 假 Gmail 同步"""
+    monkeypatch.setattr(redis_module, "_client", fakeredis.FakeAsyncRedis(decode_responses=True))
+    monkeypatch.setattr(push.settings, "gmail_push_verification_token", TOKEN)
+    monkeypatch.setattr(email_sync.settings, "sync_safety_poll_seconds", 900)
+    monkeypatch.setattr(email_sync.settings, "sync_min_interval_seconds", 60)
+
+    original_next_request = sync_queue.next_request
+
+    async def next_request(timeout=5):
+        return await original_next_request(timeout=0.05)
+
+    monkeypatch.setattr(email_sync.sync_queue, "next_request", next_request)
+
+    synced = []
+
+    async def gmail_stand_in(account_id, lease):
+        # 模擬 _sync_gmail：同步到通知的 historyId，回傳新信件數
+        synced.append((account_id, lease.fence))
+        store.account.sync_state.last_history_id = store.pending_history_id
+        return 2
+
+    monkeypatch.setattr(email_sync, "_sync_account_locked", gmail_stand_in)
+
+    store = _AccountStore(None)
+    monkeypatch.setattr(email_sync, "AsyncSessionLocal", store)
+    return SimpleNamespace(store=store, synced=synced)
+
+
+async def _notify(store, history_id):
+    app = FastAPI()
+    app.include_router(push.router, prefix="/api/v1")
+    app.dependency_overrides[get_db] = lambda: store
+    store.pending_history_id = history_id
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(
+            f"/api/v1/push/gmail?token={TOKEN}", json=_envelope(history_id)
+        )
+    return response.json()
+
+
+async def _drain(pipeline, expected_syncs):
+    stop_event = asyncio.Event()
+    task = asyncio.create_task(email_sync.consume_sync_requests(stop_event))
+    for _ in range(200):
+        if len(pipeline.synced) >= expected_syncs and await sync_queue.queue_depth() == 0:
+            break
+        await asyncio.sleep(0.01)
+    stop_event.set()
+    await asyncio.wait_for(task, 2)
+
+
+async def test_push_to_sync_dedups_and_uses_safety_poll(pipeline):
+    now = datetime.utcnow()
+    account = _gmail_account(last_history_id=300, watch_expires_at=now + timedelta(days=3))
+    pipeline.store.account = account
+
+    # 同一帳號連續兩個通知：pending 標記去重，佇列只有一筆
+    assert await _notify(pipeline.store, 400) == {"ok": True, "queued": 1}
+    assert await _notify(pipeline.store, 401) == {"ok": True, "queued": 0}
+    assert await sync_queue.queue_depth() == 1
+
+    await _drain(pipeline, 1)
+    assert [aid for aid, _ in pipeline.synced] == [account.id]
+    assert account.sync_state.last_history_id == 401
+    # watch 有效：下次排程退回安全網輪詢
+    assert account.sync_interval_seconds == 900
+    assert account.next_sync_at >= now + timedelta(seconds=900)
+
+    # 已同步過的 historyId 不再排入；較新的通知在標記刪除後可以重新排入
+    assert await _notify(pipeline.store, 401) == {"ok": True, "queued": 0}
+    assert await _notify(pipeline.store, 450) == {"ok": True, "queued": 1}
+    await _drain(pipeline, 2)
+    fences = [fence for _, fence in pipeline.synced]
+    assert len(fences) == 2 and fences[1] > fences[0]
+
+
+async def test_push_sync_without_watch_uses_adaptive_interval(pipeline):
+    account = _gmail_account(last_history_id=None, watch_expires_at=None)
+    pipeline.store.account = account
+
+    assert await _notify(pipeline.store, 10) == {"ok": True, "queued": 1}
+    await _drain(pipeline, 1)
+    assert account.sync_interval_seconds == 60
@@ -0,0 +1,79 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from app.core import redis as redis_module
+from app.services import sync_lease
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(redis_module, "_client", client)
+    return client
+
+
+async def test_second_acquire_is_refused_while_held(redis):
+    lease = await sync_lease.acquire("acc", ttl_seconds=30)
+    assert lease is not None
+    assert await sync_lease.acquire("acc", ttl_seconds=30) is None
+    # 其他帳號 / 其他種類的 lease 互不影響
+    assert await sync_lease.acquire("other", ttl_seconds=30) is not None
+    assert await sync_lease.acquire("acc", kind="backfill", ttl_seconds=30) is not None
+
+
+async def test_fence_increases_with_every_acquire(redis):
+    first = await sync_lease.acquire("acc", ttl_seconds=30)
+    await first.release()
+    second = await sync_lease.acquire("acc", ttl_seconds=30)
+    assert second.fence > first.fence
+
+
+async def test_release_only_deletes_own_lease(redis):
+    stale = await sync_lease.acquire("acc", ttl_seconds=30)
+    # stale 的 lease 過期後被接手
+    await redis.delete(stale.key)
+    current = await sync_lease.acquire("acc", ttl_seconds=30)
+
+    await stale.release()
+    assert await redis.get(current.key) is not None
+    await current.release()
+    assert await redis.get(current.key) is None
+
+
+async def test_context_manager_renews_and_releases(redis):
+    lease = await sync_lease.acquire("acc", ttl_seconds=0.3)
+    async with lease:
+        await asyncio.sleep(0.45)  # 超過原本的 TTL，靠續約維持
+        assert await redis.get(lease.key) is not None
+        lease.check()
+    assert await redis.get(lease.key) is None
+
+
+async def test_renewal_detects_takeover(redis):
+    lease = await sync_lease.acquire("acc", ttl_seconds=0.3)
+    async with lease:
+        await redis.set(lease.key, "someone-else")
+        await asyncio.sleep(0.15)
+        assert lease.lost
+        with pytest.raises(sync_lease.LeaseLostError):
+            lease.check()
+    # 已被接手的 lease 不會被誤刪
+    assert await redis.get(lease.key) == "someone-else"
+
+
+async def test_renewal_errors_are_retried(redis, monkeypatch):
+    lease = await sync_lease.acquire("acc", ttl_seconds=0.3)
+    real_eval = redis.eval
+    failures = [ConnectionError("redis down")]
+
+    async def flaky_eval(*args):
+        if failures:
+            raise failures.pop()
+        return await real_eval(*args)
+
+    monkeypatch.setattr(redis, "eval", flaky_eval)
+    async with lease:
+        await asyncio.sleep(0.25)
+        assert not failures and not lease.lost
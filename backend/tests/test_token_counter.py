@@ -0,0 +1,88 @@
+import pytest
+
+from app.services import token_counter
+from app.services.token_counter import count_tokens, split_by_tokens
+
+
+class FakeEncoding:
+    """一個空白分隔的字 = 一個 token"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    monkeypatch.setattr(token_counter, "_encoding", lambda name: None)
+
+
+@pytest.fixture
+def encodings(monkeypatch):
+    loaded = []
+
+    def encoding(name):
+        loaded.append(name)
+        return FakeEncoding(name)
+
+    monkeypatch.setattr(token_counter, "_encoding", encoding)
+    return loaded
+
+
+def test_fallback_counts_cjk_per_character(offline):
+    assert count_tokens("請確認明天的會議", "claude-haiku") == 8
+    assert count_tokens("a" * 400, "claude-haiku") == 100
+    # 混合內容：4 個中文字 + 8 個其他字元
+    assert count_tokens("會議通知 meeting", "gpt-4o") == 4 + 2
+    assert count_tokens("", "claude-haiku") == 0
+
+
+def test_encoding_and_family_factor(encodings):
+    text = " ".join(["word"] * 100)
+    assert count_tokens(text, "gpt-4o") == 100
+    assert count_tokens(text, "claude-haiku") == 115
+    assert count_tokens(text, "llama3.2-local") == 110
+    assert encodings == ["o200k_base", "cl100k_base", "cl100k_base"]
+
+
+def test_encoding_load_failure_is_cached_as_none(monkeypatch):
+    import tiktoken
+
+    attempts = []
+
+    def get_encoding(name):
+        attempts.append(name)
+        raise OSError("offline")
+
+    monkeypatch.setattr(tiktoken, "get_encoding", get_encoding)
+    token_counter._encoding.cache_clear()
+    try:
+        assert token_counter._encoding("cl100k_base") is None
+        assert token_counter._encoding("cl100k_base") is None
+        assert count_tokens("請確認", "claude-haiku") == 3
+    finally:
+        token_counter._encoding.cache_clear()
+    assert attempts == ["cl100k_base"]
+
+
+def test_split_keeps_every_paragraph_within_budget(offline):
+    paragraphs = [f"段落{i}" + "內容" * 10 for i in range(10)]
+    text = "\n\n".join(paragraphs)
+    chunks = split_by_tokens(text, 50, "claude-haiku")
+
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk, "claude-haiku") <= 50 for chunk in chunks)
+    assert "\n\n".join(chunks) == text
+
+
+def test_split_hard_cuts_oversized_line(offline):
+    line = "字" * 250
+    chunks = split_by_tokens(line, 100, "claude-haiku")
+    assert all(count_tokens(chunk) <= 100 for chunk in chunks)
+    assert "".join(chunks).replace("\n\n", "") == line
+
+
+def test_split_skips_blank_paragraphs(offline):
+    assert split_by_tokens("a\n\n\n\n   \n\nb", 100) == ["a\n\nb"]
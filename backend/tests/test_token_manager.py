@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.services import crypto_service, token_manager
+
+
+@pytest.fixture(autouse=True)
+def token_cache(monkeypatch):
+    monkeypatch.setattr(token_manager, "_plaintext", {})
+    monkeypatch.setattr(token_manager.settings, "token_cache_ttl_seconds", 60)
+    now = [1000.0]
+    monkeypatch.setattr(token_manager.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def decrypts(monkeypatch):
+    calls = []
+    real = crypto_service.decrypt
+
+    def decrypt(ciphertext):
+        calls.append(ciphertext)
+        return real(ciphertext)
+
+    monkeypatch.setattr(crypto_service, "decrypt", decrypt)
+    return calls
+
+
+def test_decrypt_is_cached_until_ttl(token_cache, decrypts):
+    ciphertext = crypto_service.encrypt("secret")
+    assert token_manager.decrypt(ciphertext) == "secret"
+    assert token_manager.decrypt(ciphertext) == "secret"
+    assert len(decrypts) == 1
+
+    token_cache[0] += 61
+    assert token_manager.decrypt(ciphertext) == "secret"
+    assert len(decrypts) == 2
+
+
+def test_encrypt_primes_cache_and_expired_entries_are_dropped(token_cache, decrypts):
+    old = token_manager.encrypt("old")
+    token_cache[0] += 61
+    new = token_manager.encrypt("new")
+    assert token_manager.decrypt(new) == "new"
+    assert decrypts == []
+    assert old not in token_manager._plaintext
+
+
+def test_empty_token_is_not_decrypted(decrypts):
+    assert token_manager.decrypt(None) == ""
+    assert token_manager.decrypt("") == ""
+    assert decrypts == []
+
+
+@pytest.mark.parametrize(
+    "expiry, expected",
+    [
+        (None, True),
+        (timedelta(seconds=100), True),
+        (timedelta(seconds=400), False),
+        (timedelta(seconds=-10), True),
+    ],
+)
+def test_expires_within(expiry, expected):
+    creds = SimpleNamespace(expiry=expiry and datetime.utcnow() + expiry)
+    assert token_manager.expires_within(creds, 300) is expected
+
+
+class _UpdateSession:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        self.statements.append(stmt)
+
+    async def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture
+def session(monkeypatch):
+    db = _UpdateSession()
+    monkeypatch.setattr(token_manager, "AsyncSessionLocal", db)
+    return db
+
+
+def _updated_columns(db):
+    compiled = db.statements[0].compile(dialect=postgresql.dialect())
+    return set(compiled.params) - {"id_1"}
+
+
+async def test_persist_writes_access_token_and_expiry(session):
+    expiry = datetime(2026, 10, 17, 13, 0, 0)
+    creds = SimpleNamespace(token="new-access", refresh_token="r1", expiry=expiry)
+    await token_manager.persist("acc", creds, previous_refresh_token="r1")
+
+    assert _updated_columns(session) == {"encrypted_access_token", "token_expires_at"}
+    params = session.statements[0].compile(dialect=postgresql.dialect()).params
+    assert token_manager.decrypt(params["encrypted_access_token"]) == "new-access"
+    assert params["token_expires_at"] == expiry
+    assert session.commits == 1
+
+
+async def test_persist_stores_rotated_refresh_token(session):
+    creds = SimpleNamespace(token="a", refresh_token="r2", expiry=None)
+    await token_manager.persist("acc", creds, previous_refresh_token="r1")
+    assert "encrypted_refresh_token" in _updated_columns(session)
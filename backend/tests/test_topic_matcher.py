@@ -0,0 +1,168 @@
+import json
+import random
+import uuid
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+from app.core import redis as redis_module
+from app.services import topic_matcher
+from app.services.topic_matcher import AhoCorasick, TopicMatcher
+
+
+def _topic(rules):
+    auto_rules = rules if isinstance(rules, str) or rules is None else json.dumps(rules)
+    return SimpleNamespace(id=uuid.uuid4(), auto_rules=auto_rules)
+
+
+def _baseline(topics, sender, subject, labels):
+    """改寫前 _classify_email_to_topics 的逐條比對語意"""
+    sender_lower = (sender or "").lower()
+    subject_lower = (subject or "").lower()
+    msg_labels = [lb.lower() for lb in (labels or [])]
+    matched = set()
+    for topic in topics:
+        try:
+            rules = json.loads(topic.auto_rules)
+        except Exception:
+            continue
+        if (
+            any(p.lower() in sender_lower for p in rules.get("senders", []))
+            or any(k.lower() in subject_lower for k in rules.get("subject_contains", []))
+            or any(lb.lower() in msg_labels for lb in rules.get("labels", []))
+        ):
+            matched.add(topic.id)
+    return matched
+
+
+def test_aho_corasick_finds_overlapping_and_nested_patterns():
+    ac = AhoCorasick({"he": {1}, "she": {2}, "hers": {3}, "his": {4}, "x": {5}})
+    assert ac.search("ushers") == {1, 2, 3}
+    assert ac.search("this") == {4}
+    assert ac.search("nothing") == set()
+
+
+def test_aho_corasick_merges_payloads_of_same_pattern():
+    ac = AhoCorasick({"ab": {1, 2}, "b": {3}, "": {4}})
+    assert ac.search("xab") == {1, 2, 3}
+
+
+def test_matcher_is_case_insensitive_and_handles_missing_fields():
+    billing = _topic({"senders": ["@Billing.example.com"], "labels": ["Finance"]})
+    travel = _topic({"subject_contains": ["行程", "Itinerary"]})
+    matcher = TopicMatcher([billing, travel])
+
+    assert matcher.match("Bot <bot@billing.EXAMPLE.com>", None, None) == {billing.id}
+    assert matcher.match(None, "Your ITINERARY / 行程確認", ["inbox"]) == {travel.id}
+    assert matcher.match("a@b.c", "hi", ["FINANCE"]) == {billing.id}
+    assert matcher.match(None, None, None) == set()
+
+
+def test_labels_match_exactly_not_as_substring():
+    topic = _topic({"labels": ["work"]})
+    matcher = TopicMatcher([topic])
+    assert matcher.match("", "", ["homework"]) == set()
+    assert matcher.match("", "", ["Work"]) == {topic.id}
+
+
+def test_empty_pattern_matches_every_message_like_baseline():
+    topic = _topic({"senders": [""]})
+    matcher = TopicMatcher([topic])
+    assert not matcher.is_empty
+    assert matcher.match(None, None, None) == {topic.id}
+    assert _baseline([topic], None, None, None) == {topic.id}
+
+
+def test_invalid_rules_are_skipped():
+    good = _topic({"senders": ["a@x"]})
+    matcher = TopicMatcher([_topic("{not json"), _topic("null"), _topic(None), good])
+    assert matcher.match("a@x", "", []) == {good.id}
+    assert TopicMatcher([_topic("{not json")]).is_empty
+
+
+def test_matcher_agrees_with_baseline_on_random_rules():
+    rng = random.Random(20261017)
+    alphabet = "abAB@.行程 "
+
+    def word(max_len):
+        return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, max_len)))
+
+    for _ in range(200):
+        topics = [
+            _topic({
+                "senders": [word(3) for _ in range(rng.randint(0, 2))],
+                "subject_contains": [word(3) for _ in range(rng.randint(0, 2))],
+                "labels": [word(2) for _ in range(rng.randint(0, 2))],
+            })
+            for _ in range(rng.randint(1, 4))
+        ]
+        matcher = TopicMatcher(topics)
+        for _ in range(10):
+            sender = rng.choice([None, word(12)])
+            subject = rng.choice([None, word(12)])
+            labels = rng.choice([None, [word(2) for _ in range(rng.randint(0, 3))]])
+            assert matcher.match(sender, subject, labels) == _baseline(
+                topics, sender, subject, labels
+            ), (topics, sender, subject, labels)
+
+
+# ── get_matcher 快取 ─────────────────────────────────────────
+
+
+class _TopicSession:
+    def __init__(self, topics):
+        self.topics = topics
+        self.queries = 0
+
+    async def execute(self, stmt):
+        self.queries += 1
+        return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: self.topics))
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(redis_module, "_client", client)
+    monkeypatch.setattr(topic_matcher, "_cache", {})
+    return client
+
+
+async def test_get_matcher_caches_until_rules_version_changes(redis):
+    user_id = uuid.uuid4()
+    db = _TopicSession([_topic({"senders": ["a@x"]})])
+
+    first = await topic_matcher.get_matcher(db, user_id)
+    assert await topic_matcher.get_matcher(db, user_id) is first
+    assert db.queries == 1
+
+    # 其他 process（API）更新規則：只遞增 Redis 版本，本地快取仍在
+    await redis.incr(topic_matcher._VERSION_KEY.format(user_id=user_id))
+    assert await topic_matcher.get_matcher(db, user_id) is not first
+    assert db.queries == 2
+
+
+async def test_get_matcher_rebuilds_after_ttl(redis, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(topic_matcher.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(topic_matcher.settings, "topic_matcher_ttl_seconds", 60)
+    db = _TopicSession([])
+    user_id = uuid.uuid4()
+
+    await topic_matcher.get_matcher(db, user_id)
+    now[0] += 59
+    await topic_matcher.get_matcher(db, user_id)
+    assert db.queries == 1
+    now[0] += 2
+    await topic_matcher.get_matcher(db, user_id)
+    assert db.queries == 2
+
+
+async def test_invalidate_drops_local_cache_and_bumps_version(redis):
+    user_id = uuid.uuid4()
+    db = _TopicSession([])
+    await topic_matcher.get_matcher(db, user_id)
+
+    await topic_matcher.invalidate(user_id)
+    assert user_id not in topic_matcher._cache
+    assert await redis.get(topic_matcher._VERSION_KEY.format(user_id=user_id)) == "1"